@@ -0,0 +1,161 @@
+import collections
+import sqlite3
+import threading
+import time
+
+from shards import ConnectionPool
+
+
+class RateLimitStore:
+    """Token buckets in a small SQLite file, so every worker on the host draws from the same ones.
+
+    A take is one UPSERT ... RETURNING statement, which refills the bucket for
+    the time since its last take and spends a token only if one is there, so
+    concurrent workers can't both spend the last token. The file is a scratch
+    store: it runs with synchronous=OFF, and losing it only refills the buckets.
+    """
+
+    def __init__(self, database, timeout=0.05, pool_size=8):
+        self.database = database
+        self.timeout = timeout
+        self.errors = 0
+        self.pool = ConnectionPool(self.connect, size=pool_size)
+
+    def connect(self):
+        conn = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA synchronous = OFF')
+        return conn
+
+    def init(self):
+        conn = self.connect()
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+        finally:
+            conn.close()
+
+    def take(self, key, rate, burst, now=None):
+        """Spend one token of `key`'s bucket; 0 if there was one, else seconds until there will be.
+
+        The bucket holds up to `burst` tokens and refills at `rate` per second.
+        If the store is unavailable the request is let through and counted in
+        `errors`: a limiter outage should not become a site outage.
+        """
+        now = time.time() if now is None else now
+        conn = self.pool.acquire()
+        try:
+            row = conn.execute('''
+                INSERT INTO rate_buckets (key, tokens, updated) VALUES (:key, :burst - 1, :now)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = MIN(:burst, tokens + (:now - updated) * :rate) - 1,
+                    updated = :now
+                WHERE MIN(:burst, tokens + (:now - updated) * :rate) >= 1
+                RETURNING tokens
+            ''', {"key": key, "burst": burst, "now": now, "rate": rate}).fetchone()
+            if row is not None:
+                return 0
+            row = conn.execute('SELECT tokens, updated FROM rate_buckets WHERE key = ?', (key,)).fetchone()
+            tokens = min(burst, row[0] + (now - row[1]) * rate) if row else burst
+            return max((1 - tokens) / rate, 0.001)
+        except sqlite3.Error:
+            self.errors += 1
+            return 0
+        finally:
+            self.pool.release(conn)
+
+    def prune(self, idle, now=None):
+        """Forget buckets untouched for `idle` seconds; they would be full again anyway"""
+        now = time.time() if now is None else now
+        conn = self.pool.acquire()
+        try:
+            return conn.execute('DELETE FROM rate_buckets WHERE updated < ?', (now - idle,)).rowcount
+        finally:
+            self.pool.release(conn)
+
+
+class Admission:
+    """Rate limits plus a concurrency cap for one class of expensive endpoints.
+
+    `limits` are (scope, rate, burst) token buckets, one per client identity
+    in that scope ('ip', 'session', ...), shared by all workers through the
+    store. The concurrency cap is per worker process, since it protects that
+    worker's threads: at most `concurrency` requests run at once, up to
+    `max_waiting` more wait up to `queue_timeout` seconds for a slot, and the
+    rest are turned away at once instead of piling up.
+    """
+
+    def __init__(self, name, store, limits=(), concurrency=4, queue_timeout=1.0, max_waiting=None):
+        self.name = name
+        self.store = store
+        self.limits = limits
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.max_waiting = concurrency * 4 if max_waiting is None else max_waiting
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rate_limited = collections.Counter()
+        self.rejected_full = 0
+        self.timed_out = 0
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+
+    def check_rate(self, identities):
+        """Seconds the client should wait if any of its buckets is empty, else 0"""
+        for scope, rate, burst in self.limits:
+            identity = identities.get(scope)
+            if identity is None:
+                continue
+            retry_after = self.store.take(f'{self.name}:{scope}:{identity}', rate, burst)
+            if retry_after:
+                with self._lock:
+                    self.rate_limited[scope] += 1
+                return retry_after
+        return 0
+
+    def enter(self):
+        """Take a slot, waiting up to queue_timeout; False if none came free"""
+        if self._slots.acquire(blocking=False):
+            return self._entered()
+        with self._lock:
+            if self.waiting >= self.max_waiting:
+                self.rejected_full += 1
+                return False
+            self.waiting += 1
+        acquired = self._slots.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self.waiting -= 1
+            if not acquired:
+                self.timed_out += 1
+        return acquired and self._entered()
+
+    def _entered(self):
+        with self._lock:
+            self.running += 1
+            self.admitted += 1
+        return True
+
+    def leave(self):
+        with self._lock:
+            self.running -= 1
+        self._slots.release()
+
+    def metrics(self):
+        return {
+            "concurrency": self.concurrency,
+            "queue_timeout": self.queue_timeout,
+            "max_waiting": self.max_waiting,
+            "limits": [{"scope": scope, "rate": rate, "burst": burst} for scope, rate, burst in self.limits],
+            "running": self.running,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rate_limited": dict(self.rate_limited),
+            "rejected_full": self.rejected_full,
+            "timed_out": self.timed_out,
+        }
@@ -1,33 +1,331 @@
+import csv
+import functools
+import inspect
+import io
+import math
+import os
+import queue
+import random
+import re
 import sqlite3
-from flask import Flask, render_template, request, redirect, url_for, session, g, jsonify
+import threading
+import time
+from contextlib import closing
+from flask import (Flask, render_template, request, redirect, url_for, session, g, jsonify, send_file, Response,
+                   copy_current_request_context)
 import secrets
+import click
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from admission import Admission, RateLimitStore
+from autocomplete import AutocompleteCache
+from background import PeriodicTask
+from blocking import BlockingExecutor
+from catalog import CATALOG_TABLES, CatalogCache, TITLE_ALIASES, title_key, title_key_variants
+from catalog_store import attach_catalog, connect_catalog, publish_catalog
+from group_commit import GroupCommitWriter, WriterOverloaded
+from image_cache import ImageCache, VARIANTS as IMAGE_VARIANTS, sniff_content_type
+from json_provider import FastJSONProvider, RawJSON, RawJSONList, iter_json_list
+from lfu_cache import LFUCache, MISSING
+from maintenance import MaintenanceScheduler
+from recommendations import RecommendationJob
+from shards import ConnectionPool, ShardMigrating, UserDirectory, attach_shard, reshard, shard_path
+from trending import TrendingEngine, WINDOWS as TRENDING_WINDOWS, MEDIA_TYPES
+from warmup import Warmup
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 app.secret_key = secrets.token_hex(16)
 
 # Database setup
 DATABASE = 'ChibiBytes_users.db'
 
+# Users and watchlists are spread over this many files: shard 0 is DATABASE,
+# shard i is ChibiBytes_users_shard<i>.db. Each shard takes writes independently.
+USER_SHARDS = int(os.environ.get('USER_SHARDS', 1))
+# Every shard but one is attached to shard 0 connections, and SQLite attaches at most 10 files
+if not 1 <= USER_SHARDS <= 10:
+    raise ValueError("USER_SHARDS must be between 1 and 10")
+SHARD_DATABASES = [shard_path(DATABASE, shard) for shard in range(USER_SHARDS)]
+
+# Which shard each user lives on, plus unique usernames/emails and user ids
+DIRECTORY_DATABASE = os.environ.get('DIRECTORY_DATABASE', 'ChibiBytes_directory.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+# Threads per worker running the SQLite work of async views; more would only wait on the pools
+BLOCKING_THREADS = int(os.environ.get('BLOCKING_THREADS', DB_POOL_SIZE))
+
+# Anime/movie catalog, a separate file opened read-only and replaced by atomic swap
+CATALOG_DATABASE = os.environ.get('CATALOG_DATABASE', 'ChibiBytes_catalog.db')
+
+# Batch watchlist writes from concurrent requests into shared commits
+WATCHLIST_GROUP_COMMIT = os.environ.get('WATCHLIST_GROUP_COMMIT') == '1'
+
+# Local copies of catalog images, shared by all workers on the host
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+IMAGE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Precomputed recommendations: how often a worker rescores users whose watchlist changed, and
+# how many processes it spawns to score them. 0 turns the in-process job off, for deployments
+# that run `flask recommend` from cron instead; scoring never runs on a web worker's own threads
+RECOMMENDATION_INTERVAL = float(os.environ.get('RECOMMENDATION_INTERVAL', 900))
+RECOMMENDATION_PROCESSES = int(os.environ.get('RECOMMENDATION_PROCESSES', 1))
+
+# Admission control for endpoints that can saturate a worker: per-client token buckets shared
+# by all workers through RATE_LIMIT_DATABASE, and a cap on concurrent requests per worker
+RATE_LIMIT_DATABASE = os.environ.get('RATE_LIMIT_DATABASE', 'ChibiBytes_limits.db')
+CHATBOT_CONCURRENCY = int(os.environ.get('CHATBOT_CONCURRENCY', 4))
+# Password hashing is CPU bound, so more concurrent logins only queue on the GIL
+AUTH_CONCURRENCY = int(os.environ.get('AUTH_CONCURRENCY', 2))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 0.5))
+# Reverse proxies in front of the app whose X-Forwarded-For/-Proto are trusted. Rate limits key on
+# the client address, so behind a proxy this must be set or every client shares the proxy's buckets;
+# when nothing is in front it must stay 0, or clients could pick their own address
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 0))
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+
+
+def connect_db(shard=0):
+    db = sqlite3.connect(shard_path(DATABASE, shard), uri=True, check_same_thread=False)
+    db.row_factory = sqlite3.Row  # Enable dictionary-style access
+    # Read-only catalog tables for joins: catalog.anime, catalog.movies
+    attach_catalog(db, CATALOG_DATABASE)
+    if shard == 0:
+        # The other shards as shard1, shard2, ... for listings that sum title_stats over all of them
+        for other in range(1, USER_SHARDS):
+            attach_shard(db, shard_path(DATABASE, other), f'shard{other}')
+    return db
+
+
+def connect_catalog_db():
+    return connect_catalog(CATALOG_DATABASE)
+
+
+def catalog_generation():
+    """Identity of the catalog file; it changes when a new catalog is swapped in"""
+    try:
+        stat = os.stat(CATALOG_DATABASE)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
 
-def get_db():
-    db = getattr(g, '_database', None)
+
+# Pooled connections keep their ATTACH of the catalog, so they are retired when it is replaced
+db_pools = {}
+
+
+def db_pool(shard):
+    pool = db_pools.get(shard)
+    if pool is None:
+        pool = db_pools.setdefault(shard, ConnectionPool(lambda: connect_db(shard), size=DB_POOL_SIZE,
+                                                         generation=catalog_generation))
+    return pool
+
+
+def get_db(shard=0):
+    """The request's connection to a user shard, taken from that shard's pool"""
+    databases = g.setdefault('_databases', {})
+    db = databases.get(shard)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row  # Enable dictionary-style access
+        db = databases[shard] = db_pool(shard).acquire()
     return db
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    for shard, db in g.pop('_databases', {}).items():
+        db_pool(shard).release(db)
+
+
+blocking_executor = BlockingExecutor(BLOCKING_THREADS)
+
+
+def offloaded(view):
+    """Serve `view` as an async view whose body runs on blocking_executor.
+
+    The view runs in a copy of the request context, which pushes an app context
+    of its own on the pool thread: each task gets its own `g`, so the get_db()
+    connections it takes are its own and go back to their pools when it ends.
+    """
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        return await blocking_executor.run(copy_current_request_context(view), *args, **kwargs)
+    return wrapper
+
+
+user_directory = UserDirectory(DIRECTORY_DATABASE, USER_SHARDS)
+# With one shard and no files left over from a wider layout, every user is on shard 0 and none
+# is being moved, so the directory needn't be asked on each request
+SINGLE_SHARD = USER_SHARDS == 1 and not any(os.path.exists(shard_path(DATABASE, shard)) for shard in range(1, 10))
+
+
+def user_shard(user_id, for_write=False):
+    """Shard holding a user's rows; for_write raises ShardMigrating while they are being moved"""
+    if SINGLE_SHARD:
+        return 0
+    return user_directory.shard_of(user_id, for_write)
+
+
+def user_db(user_id):
+    return get_db(user_shard(user_id))
+
+
+def add_column_if_missing(cursor, table, column, definition):
+    """Add a column to an existing table unless it is already there"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
 
 
-def init_db():
-    with app.app_context():
-        db = get_db()
+def parse_rating(value):
+    """Convert a stored rating ("8.30", "9.2", "94%") to a 0-10 score"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        if value.endswith('%'):
+            # Percent scores (e.g. Rotten Tomatoes) map onto the 10 point scale
+            return round(float(value[:-1]) / 10, 2)
+        return round(float(value), 2)
+    except ValueError:
+        return None
+
+
+def parse_year(value):
+    """Pull the four digit year out of values like '2019' or '2019-'"""
+    match = re.search(r'\d{4}', str(value or ''))
+    return int(match.group()) if match else None
+
+
+def normalize_catalog_columns(cursor):
+    """Backfill rating_score, year_int and title_key from the text columns"""
+    changed = 0
+    for table in ('anime', 'movies'):
+        cursor.execute(f'''
+            SELECT id, rating, year, title FROM {table}
+            WHERE rating_score IS NULL OR year_int IS NULL OR title_key IS NULL
+        ''')
+        updates = [(parse_rating(row[1]), parse_year(row[2]), title_key(row[3]), row[0]) for row in cursor.fetchall()]
+        cursor.executemany(f'UPDATE {table} SET rating_score = ?, year_int = ?, title_key = ? WHERE id = ?', updates)
+        changed += len(updates)
+    return changed
+
+
+def seed_title_aliases(cursor):
+    """Point each TITLE_ALIASES entry at its title; returns how many were added"""
+    added = 0
+    for alias, (media_type, title) in TITLE_ALIASES.items():
+        table = 'anime' if media_type == 'anime' else 'movies'
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO title_aliases (alias_key, media_type, media_id)
+            SELECT ?, ?, id FROM {table} WHERE title_key = ? ORDER BY id LIMIT 1
+        ''', (title_key(alias), media_type, title_key(title)))
+        added += cursor.rowcount
+    return added
+
+
+def migrate_watchlist_layout(cursor):
+    """Rewrite an old (anime_id, title, year, rating, image) watchlist into the compact layout"""
+    cursor.execute('PRAGMA table_info(watchlist)')
+    if 'anime_id' not in [row[1] for row in cursor.fetchall()]:
+        return
+    # One explicit transaction, so a crash part way leaves the old table as it was; a
+    # watchlist_compact left by an earlier build without it is dropped first
+    cursor.connection.commit()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        _migrate_watchlist_layout(cursor)
+    except BaseException:
+        cursor.execute('ROLLBACK')
+        raise
+    cursor.execute('COMMIT')
+
+
+def _migrate_watchlist_layout(cursor):
+    cursor.execute('DROP TABLE IF EXISTS watchlist_compact')
+    cursor.execute('''
+        CREATE TABLE watchlist_compact (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            media_type TEXT NOT NULL,
+            media_id INTEGER NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # Anime and movie ids don't overlap, so the id says which table it came from.
+    # Duplicate saves of the same title keep the earliest row.
+    cursor.execute('''
+        INSERT INTO watchlist_compact (id, user_id, media_type, media_id, added_at)
+        SELECT MIN(id), user_id,
+               CASE WHEN EXISTS (SELECT 1 FROM anime WHERE anime.id = watchlist.anime_id)
+                    THEN 'anime' ELSE 'movie' END,
+               anime_id, MIN(added_at)
+        FROM watchlist
+        GROUP BY user_id, anime_id
+    ''')
+    cursor.execute('DROP TABLE watchlist')
+    cursor.execute('ALTER TABLE watchlist_compact RENAME TO watchlist')
+
+
+# Adds within this window count towards title_stats.recent_adds
+RECENT_ADDS_WINDOW = 7 * 24 * 60 * 60
+
+
+def reconcile_title_stats(db):
+    """Recompute title_stats from the watchlist and event log, fixing any drift.
+
+    recent_adds also needs this to age out adds that left the window.
+    Returns the number of rows that had to be corrected.
+    """
+    cursor = db.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('''
+            SELECT media_type, media_id, COUNT(*)
+            FROM watchlist
+            GROUP BY media_type, media_id
+        ''')
+        actual = {(row[0], row[1]): [row[2], 0, None] for row in cursor.fetchall()}
+
+        cursor.execute('''
+            SELECT media_type, media_id, COUNT(*), MAX(created_at)
+            FROM watchlist_events
+            WHERE action = 'add' AND created_at >= ?
+            GROUP BY media_type, media_id
+        ''', (time.time() - RECENT_ADDS_WINDOW,))
+        for media_type, media_id, adds, last_added_at in cursor.fetchall():
+            stats = actual.setdefault((media_type, media_id), [0, 0, None])
+            stats[1] = adds
+            stats[2] = last_added_at
+
+        cursor.execute('SELECT media_type, media_id, save_count, recent_adds, last_added_at FROM title_stats')
+        stored = {(row[0], row[1]): list(row[2:]) for row in cursor.fetchall()}
+
+        fixes = []
+        for key, (save_count, recent_adds, last_added_at) in actual.items():
+            current = stored.pop(key, None)
+            if current is None or current[:2] != [save_count, recent_adds]:
+                # Keep the newest add we know about; old events may already be pruned
+                if current and current[2] and (last_added_at is None or current[2] > last_added_at):
+                    last_added_at = current[2]
+                fixes.append((key[0], key[1], save_count, recent_adds, last_added_at))
+        cursor.executemany('''
+            INSERT OR REPLACE INTO title_stats (media_type, media_id, save_count, recent_adds, last_added_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', fixes)
+        cursor.executemany('DELETE FROM title_stats WHERE media_type = ? AND media_id = ?', list(stored))
+        db.commit()
+        return len(fixes) + len(stored)
+    except Exception:
+        db.rollback()
+        raise
+
+
+def init_db(shard=0):
+    # A plain connection: shard 0 connections attach the other shards, which may not exist yet
+    with closing(sqlite3.connect(shard_path(DATABASE, shard))) as db:
         cursor = db.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -38,21 +336,144 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        # Create watchlist table
+        # Create watchlist table; display fields come from the catalog, not the row
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS watchlist (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
-                anime_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                year TEXT,
-                rating TEXT,
-                image TEXT,
+                media_type TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
                 added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
         ''')
 
+        # Small key/value table for app state such as checkpoints
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+
+        # Append-only log of watchlist adds/removes, tailed by the trending engine
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS watchlist_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                media_type TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
+                action TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                version INTEGER
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_watchlist_events_created ON watchlist_events (created_at)')
+
+        # Per-user watchlist version; each event carries the version it produced
+        add_column_if_missing(cursor, 'users', 'watchlist_version', 'INTEGER NOT NULL DEFAULT 0')
+        add_column_if_missing(cursor, 'watchlist_events', 'version', 'INTEGER')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_watchlist_events_user_version
+            ON watchlist_events (user_id, version)
+        ''')
+
+        # Checkpointed trending scores so restarts don't start from zero
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trending_scores (
+                window TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (window, media_type, media_id)
+            )
+        ''')
+
+        # Per-title popularity counters, kept current by a trigger on the event log
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS title_stats (
+                media_type TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
+                save_count INTEGER NOT NULL DEFAULT 0,
+                recent_adds INTEGER NOT NULL DEFAULT 0,
+                last_added_at REAL,
+                PRIMARY KEY (media_type, media_id)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_title_stats_saves ON title_stats (media_type, save_count)')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_watchlist_events_title_stats
+            AFTER INSERT ON watchlist_events
+            BEGIN
+                INSERT INTO title_stats (media_type, media_id, save_count, recent_adds, last_added_at)
+                VALUES (NEW.media_type, NEW.media_id,
+                        NEW.action = 'add', NEW.action = 'add',
+                        CASE WHEN NEW.action = 'add' THEN NEW.created_at END)
+                ON CONFLICT (media_type, media_id) DO UPDATE SET
+                    save_count = MAX(save_count + CASE NEW.action WHEN 'add' THEN 1 WHEN 'remove' THEN -1 ELSE 0 END, 0),
+                    recent_adds = recent_adds + (NEW.action = 'add'),
+                    last_added_at = CASE WHEN NEW.action = 'add' THEN NEW.created_at ELSE last_added_at END;
+            END
+        ''')
+
+        # Top titles per user, written by the recommendation job; recommendations_version
+        # is the watchlist_version they were computed from
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_recommendations (
+                user_id INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                media_type TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                generation INTEGER NOT NULL,
+                PRIMARY KEY (user_id, rank)
+            )
+        ''')
+        add_column_if_missing(cursor, 'users', 'recommendations_version', 'INTEGER')
+
+        # Databases created before the compact layout still copy title/year/rating/image
+        migrate_watchlist_layout(cursor)
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_watchlist_user_media
+            ON watchlist (user_id, media_type, media_id)
+        ''')
+
+        db.commit()
+
+        reconcile_title_stats(db)
+
+
+# Catalog columns copied from a user database that still holds the catalog tables
+LEGACY_CATALOG_COLUMNS = {
+    'anime': 'id, title, year, rating, image, modalImage, category, description, insights',
+    'movies': 'id, title, year, rating, image, modalImage, category, description, insights, director, duration',
+    'title_aliases': 'alias_key, media_type, media_id',
+}
+
+
+def copy_legacy_catalog(db, legacy_database):
+    """Copy catalog rows out of a user database from before the catalog had its own file"""
+    cursor = db.cursor()
+    cursor.execute('ATTACH DATABASE ? AS legacy', (legacy_database,))
+    try:
+        cursor.execute("SELECT name FROM legacy.sqlite_master WHERE type = 'table'")
+        tables = {row[0] for row in cursor.fetchall()}
+        for table, columns in LEGACY_CATALOG_COLUMNS.items():
+            if table in tables:
+                cursor.execute(f'INSERT OR IGNORE INTO {table} ({columns}) SELECT {columns} FROM legacy.{table}')
+        db.commit()
+    finally:
+        cursor.execute('DETACH DATABASE legacy')
+
+
+def build_catalog(db, legacy_database=None):
+    """Create, fill and index the catalog tables on a new catalog file (see publish_catalog).
+
+    Rows come from `legacy_database` when given, so ids saved in watchlists keep
+    pointing at the same titles; an empty catalog is seeded from the literals below.
+    """
+    cursor = db.cursor()
+    with db:
         # Create anime table
         cursor.execute('''
                     CREATE TABLE IF NOT EXISTS anime (
@@ -68,9 +489,6 @@ def init_db():
                     )
                 ''')
 
-
-
-
         # Create movie table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS movies (
@@ -87,8 +505,38 @@ def init_db():
                 duration TEXT NOT NULL
             )
         ''')
+
+        # Small key/value table; publish_catalog() records catalog_version here
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+
+        # Typed rating/year columns so the catalog can be filtered and sorted in SQL
+        for table in ('anime', 'movies'):
+            add_column_if_missing(cursor, table, 'rating_score', 'REAL')
+            add_column_if_missing(cursor, table, 'year_int', 'INTEGER')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_rating_year ON {table} (rating_score, year_int)')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_year_rating ON {table} (year_int, rating_score)')
+            # Normalized title for exact-name lookups (see catalog.title_key)
+            add_column_if_missing(cursor, table, 'title_key', 'TEXT')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_title_key ON {table} (title_key)')
+
+        # Shorthand names ("aot", "jjk") for titles, keyed like title_key
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS title_aliases (
+                alias_key TEXT PRIMARY KEY,
+                media_type TEXT NOT NULL,
+                media_id INTEGER NOT NULL
+            )
+        ''')
         db.commit()
 
+        if legacy_database:
+            copy_legacy_catalog(db, legacy_database)
+
         # Populate anime table if empty
         cursor.execute("SELECT COUNT(*) FROM anime")
         if cursor.fetchone()[0] == 0:
@@ -1329,34 +1777,769 @@ def init_db():
                     ))
                 db.commit()
 
-        # ... rest of the existing code ...
+        # Fill rating_score/year_int/title_key and point the aliases at their titles
+        normalize_catalog_columns(cursor)
+        seed_title_aliases(cursor)
+
+
+# Columns an upsert may set; rating_score, year_int and title_key are derived from them
+CATALOG_UPSERT_FIELDS = {
+    'anime': ('title', 'year', 'rating', 'image', 'modalImage', 'category', 'description', 'insights'),
+    'movie': ('title', 'year', 'rating', 'image', 'modalImage', 'category', 'description', 'insights',
+              'director', 'duration'),
+}
+CATALOG_OPTIONAL_FIELDS = {'year', 'rating'}
+
+
+def upsert_catalog_titles(db, items):
+    """Insert or update titles, and their aliases, on a copy of the catalog; returns the changed keys.
+
+    An item names its title by media_type plus id, or by exact title when it
+    already exists. New titles get the next id unused by any anime or movie,
+    since ids alone tell the two apart. Raises ValueError for an invalid item.
+    """
+    cursor = db.cursor()
+    changed = []
+    with db:
+        cursor.execute('SELECT MAX(id) FROM (SELECT id FROM anime UNION ALL SELECT id FROM movies)')
+        next_id = (cursor.fetchone()[0] or 0) + 1
+        for position, item in enumerate(items, start=1):
+            if not isinstance(item, dict):
+                raise ValueError(f"Item {position}: expected an object")
+            media_type = item.get('media_type')
+            if media_type not in CATALOG_UPSERT_FIELDS:
+                raise ValueError(f"Item {position}: media_type must be 'anime' or 'movie'")
+            table = CATALOG_TABLES[media_type]
+            fields = {field: item[field] for field in CATALOG_UPSERT_FIELDS[media_type] if field in item}
+            unknown = set(item) - set(fields) - {'media_type', 'id', 'aliases'}
+            if unknown:
+                raise ValueError(f"Item {position}: unknown fields {', '.join(sorted(unknown))}")
 
-        # Add endpoint to fetch movie data
-        @app.route('/api/movies')
-        def get_movies():
             try:
-                db = get_db()
-                cursor = db.cursor()
-                cursor.execute('SELECT * FROM movies')
-                movies_list = [dict(row) for row in cursor.fetchall()]
-                return jsonify(movies_list)
-            except Exception as e:
-                return jsonify({"error": str(e)}), 500
+                media_id = int(item['id']) if item.get('id') is not None else None
+            except (TypeError, ValueError):
+                raise ValueError(f"Item {position}: id must be an integer")
+            if media_id is None and fields.get('title'):
+                cursor.execute(f'SELECT id FROM {table} WHERE title_key = ? ORDER BY id LIMIT 1',
+                               (title_key(fields['title']),))
+                row = cursor.fetchone()
+                media_id = row[0] if row else None
+
+            cursor.execute(f'SELECT 1 FROM {table} WHERE id = ?', (media_id,))
+            if cursor.fetchone():
+                if fields:
+                    # Cleared derived columns are refilled by normalize_catalog_columns below
+                    assignments = ', '.join(f'{field} = ?' for field in fields)
+                    cursor.execute(f'''
+                        UPDATE {table} SET {assignments}, rating_score = NULL, year_int = NULL, title_key = NULL
+                        WHERE id = ?
+                    ''', (*fields.values(), media_id))
+            else:
+                missing = [field for field in CATALOG_UPSERT_FIELDS[media_type]
+                           if field not in CATALOG_OPTIONAL_FIELDS and not fields.get(field)]
+                if missing:
+                    raise ValueError(f"Item {position}: new titles need {', '.join(missing)}")
+                if media_id is None:
+                    media_id = next_id
+                else:
+                    other = 'movies' if table == 'anime' else 'anime'
+                    cursor.execute(f'SELECT 1 FROM {other} WHERE id = ?', (media_id,))
+                    if cursor.fetchone():
+                        raise ValueError(f"Item {position}: id {media_id} belongs to a title in {other}")
+                next_id = max(next_id, media_id + 1)
+                cursor.execute(f'''
+                    INSERT INTO {table} (id, {', '.join(fields)}) VALUES (?, {', '.join('?' * len(fields))})
+                ''', (media_id, *fields.values()))
+
+            for alias in item.get('aliases') or ():
+                cursor.execute('INSERT OR REPLACE INTO title_aliases (alias_key, media_type, media_id) VALUES (?, ?, ?)',
+                               (title_key(alias), media_type, media_id))
+            changed.append((media_type, media_id))
+        normalize_catalog_columns(cursor)
+    return changed
+
+
+def publish_catalog_updates(items):
+    """Upsert `items` into a copy of the live catalog and publish it; returns (version, changed keys)"""
+    changed = []
+
+    def build(db):
+        changed.extend(upsert_catalog_titles(db, items))
+        return changed
+
+    version = publish_catalog(CATALOG_DATABASE, build, incremental=True)
+    return version, changed
+
+
+def ensure_catalog():
+    """Publish the catalog file on first start, importing the catalog tables of an older user database"""
+    if not os.path.exists(CATALOG_DATABASE):
+        legacy_database = DATABASE if os.path.exists(DATABASE) else None
+        publish_catalog(CATALOG_DATABASE, lambda db: build_catalog(db, legacy_database))
+
+
+@app.cli.command('reshard')
+@click.option('--shards', type=int, required=True, help='Shard count to rebalance users onto')
+@click.option('--batch', type=int, default=100, help='Users marked read-only and moved together')
+@click.option('--grace', type=float, default=5.0, help='Seconds to let in-flight writes finish before a batch moves')
+def reshard_command(shards, batch, grace):
+    """Move every user to the shard their id hashes to under --shards.
+
+    Run it after deploying with USER_SHARDS=<shards> (so new users are already
+    placed that way); when shrinking, run it again once that deploy is out.
+    """
+    for shard in range(shards):
+        init_db(shard)
+    directory = UserDirectory(DIRECTORY_DATABASE, shards)
+
+    def connect(shard):
+        db = sqlite3.connect(shard_path(DATABASE, shard), timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    moved = reshard(directory, shards, connect, batch_size=batch, grace=grace)
+    # Saves moved with their users; title_stats only follow the event log, so recount them
+    for shard in range(10):
+        if os.path.exists(shard_path(DATABASE, shard)):
+            with closing(sqlite3.connect(shard_path(DATABASE, shard), timeout=30)) as db:
+                reconcile_title_stats(db)
+    print(f"Moved {moved} users onto {shards} shards")
+
+
+@app.cli.command('upsert-titles')
+@click.argument('source', type=click.File('rb'))
+def upsert_titles_command(source):
+    """Add or edit the titles in a JSON file (a list, or {"items": [...]}) and publish them incrementally"""
+    data = app.json.loads(source.read())
+    items = data.get('items') if isinstance(data, dict) else data
+    version, changed = publish_catalog_updates(items)
+    print(f"Published catalog version {version} with {len(changed)} changed titles")
+
+
+@app.cli.command('publish-catalog')
+@click.option('--source', help='Database to copy catalog rows from instead of the seed data')
+def publish_catalog_command(source):
+    """Build a new catalog file and atomically swap it in for running workers"""
+    version = publish_catalog(CATALOG_DATABASE, lambda db: build_catalog(db, source))
+    print(f"Published catalog version {version} to {CATALOG_DATABASE}")
+
+
+@app.cli.command('enable-incremental-vacuum')
+def enable_incremental_vacuum_command():
+    """Rewrite each user shard once so scheduled maintenance can return its free pages incrementally"""
+    for scheduler in maintenance:
+        with closing(scheduler.connect()) as conn:
+            result = scheduler.convert(conn)
+        print(f"{scheduler.database}: {result['action']}, {result.get('freed_bytes', 0)} bytes freed")
+
+
+@app.cli.command('recommend')
+@click.option('--full', is_flag=True, help='Rescore every user, not just those whose watchlist changed')
+@click.option('--processes', type=int, default=os.cpu_count(), help='Worker processes scoring users (0 scores inline)')
+@click.option('--chunk', type=int, default=500, help='Users per task handed to a worker')
+def recommend_command(full, processes, chunk):
+    """Precompute every user's recommendations into user_recommendations on their shard"""
+    job = RecommendationJob(SHARD_DATABASES, processes=processes, chunk_size=chunk)
+    try:
+        report = job.run(catalog_cache.get(), full=full, log=print)
+    finally:
+        job.close()
+    if report is None:
+        print("No watchlist changed since the last run")
+    else:
+        print(f"Generation {report['generation']}: scored {report['users']} users in {report['seconds']}s")
+
+
+# Initialize the databases; the catalog first, since user connections attach it
+ensure_catalog()
+for shard in range(USER_SHARDS):
+    init_db(shard)
+user_directory.init(SHARD_DATABASES)
+rate_limit_store = RateLimitStore(RATE_LIMIT_DATABASE)
+rate_limit_store.init()
+
+
+# Watchlist events older than this are pruned at checkpoint time
+EVENT_RETENTION = 30 * 24 * 60 * 60
+
+# The file's identity is stat()ed each interval; the catalog is only opened once it changes
+catalog_cache = CatalogCache(connect_catalog_db, stamp=catalog_generation)
+trending_engine = TrendingEngine(SHARD_DATABASES)
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+# One writer and one maintenance leader per shard, since each file has its own write lock
+watchlist_writers = {}
+maintenance = [MaintenanceScheduler(database) for database in SHARD_DATABASES]
+recommendation_job = RecommendationJob(SHARD_DATABASES, processes=RECOMMENDATION_PROCESSES)
+# (scope, requests per second, burst) buckets per client
+admissions = {
+    'chatbot': Admission('chatbot', rate_limit_store, [('session', 1.0, 10), ('ip', 5.0, 30)],
+                         concurrency=CHATBOT_CONCURRENCY, queue_timeout=ADMISSION_QUEUE_TIMEOUT),
+    'auth': Admission('auth', rate_limit_store, [('ip', 0.2, 10), ('username', 0.05, 5)],
+                      concurrency=AUTH_CONCURRENCY, queue_timeout=ADMISSION_QUEUE_TIMEOUT),
+}
+
+
+def watchlist_writer(shard):
+    writer = watchlist_writers.get(shard)
+    if writer is None:
+        writer = watchlist_writers.setdefault(shard, GroupCommitWriter(shard_path(DATABASE, shard)))
+    return writer
+
+
+def checkpoint_trending():
+    # The leader's checkpoint stands for every worker, and it prunes the event logs for all of them
+    if not trending_engine.checkpoint_as_leader():
+        return
+    for database in SHARD_DATABASES:
+        db = sqlite3.connect(database)
+        try:
+            with db:
+                db.execute('DELETE FROM watchlist_events WHERE created_at < ?', (time.time() - EVENT_RETENTION,))
+        finally:
+            db.close()
 
-    # Add this endpoint to fetch anime data
-    @app.route('/api/anime')
-    def get_anime():
+
+def reconcile_stats_job():
+    for database in SHARD_DATABASES:
+        db = sqlite3.connect(database, timeout=30)
         try:
-            db = get_db()
-            cursor = db.cursor()
-            cursor.execute('SELECT * FROM anime')
-            anime_list = [dict(row) for row in cursor.fetchall()]
-            return jsonify(anime_list)
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            reconcile_title_stats(db)
+        finally:
+            db.close()
+
+
+def refresh_autocomplete():
+    # Re-rank with current save counts; catalog changes are picked up on the request path
+    autocomplete_cache.refresh()
+
+
+def maintenance_job():
+    for scheduler in maintenance:
+        scheduler.tick()
+
+
+def prune_rate_limits():
+    # A bucket left alone this long has refilled completely
+    rate_limit_store.prune(idle=3600)
+
+
+def recommendations_job():
+    # Only the worker holding the lease runs it
+    recommendation_job.tick(catalog_cache.get())
+
+
+BACKGROUND_TASKS = [
+    PeriodicTask('trending-poll', 2.0, trending_engine.poll),
+    PeriodicTask('trending-checkpoint', 60.0, checkpoint_trending),
+    PeriodicTask('title-stats-reconcile', 600.0, reconcile_stats_job),
+    PeriodicTask('sqlite-maintenance', 60.0, maintenance_job),
+    PeriodicTask('autocomplete-refresh', 300.0, refresh_autocomplete),
+    PeriodicTask('rate-limit-prune', 600.0, prune_rate_limits),
+]
+if RECOMMENDATION_PROCESSES > 0:
+    BACKGROUND_TASKS.append(PeriodicTask('recommendations', RECOMMENDATION_INTERVAL, recommendations_job))
+
+
+@app.before_request
+def start_background_tasks():
+    for task in BACKGROUND_TASKS:
+        task.ensure_running()
+    # Only from the serving path: CLI commands import this module and must not warm up or run jobs
+    warmup.ensure_started()
+    # Lets the maintenance leader wait for a quiet moment; probes and warm-up aren't traffic
+    if request.endpoint not in HEALTH_ENDPOINTS and not request.environ.get(WARMUP_ENVIRON):
+        for scheduler in maintenance:
+            scheduler.note_request()
+
+
+def record_watchlist_event(cursor, user_id, media_type, media_id, action):
+    """Log a watchlist change in the caller's transaction and bump the user's version"""
+    cursor.execute('UPDATE users SET watchlist_version = watchlist_version + 1 WHERE id = ?', (user_id,))
+    version = read_watchlist_version(cursor, user_id)
+    cursor.execute('''
+        INSERT INTO watchlist_events (user_id, media_type, media_id, action, created_at, version)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, media_type, media_id, action, time.time(), version))
+
+
+def read_watchlist_version(cursor, user_id):
+    cursor.execute('SELECT watchlist_version FROM users WHERE id = ?', (user_id,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def hydrate_watchlist(rows):
+    """Fill in display fields for watchlist rows from the cached catalog"""
+    catalog = catalog_cache.get()
+    items = []
+    for row in rows:
+        title = catalog.get(row['media_type'], row['media_id']) or {}
+        items.append({
+            "id": row['id'],
+            "anime_id": row['media_id'],
+            "media_type": row['media_type'],
+            "media_id": row['media_id'],
+            "title": title.get('title', ''),
+            "year": title.get('year', ''),
+            "rating": title.get('rating', ''),
+            "image": title.get('image', ''),
+        })
+    return items
+
+
+NDJSON_CHUNK_SIZE = 500
+
+
+def stream_ndjson(query, params, transform=None, shard=0):
+    """Stream query results as newline-delimited JSON without materializing them.
+
+    Rows are pulled with fetchmany so memory stays flat however large the result.
+    The generator owns its connection, since the request's get_db() connection is
+    closed at teardown before the body has finished streaming.
+    """
+    def generate():
+        for item in iter_query(query, params, transform, shard):
+            yield app.json.encode(item) + b'\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def iter_query(query, params, transform=None, shard=0):
+    """Yield result rows as dicts, fetchmany chunk by chunk, on a private connection to `shard`"""
+    db = connect_db(shard)
+    try:
+        cursor = db.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(NDJSON_CHUNK_SIZE)
+            if not rows:
+                break
+            yield from (transform(rows) if transform else map(dict, rows))
+    finally:
+        db.close()
+
+
+CATALOG_SORTS = {
+    'rating': 'rating_score DESC',
+    'year': 'year_int DESC, rating_score DESC',
+    'title': 'title COLLATE NOCASE',
+    'popular': 'save_count DESC, rating_score DESC',
+}
+
+CATALOG_MEDIA_TYPES = {'anime': 'anime', 'movies': 'movie'}
+
+
+def title_stats_source():
+    """title_stats as seen from a shard 0 connection: summed over every shard when there are several"""
+    if USER_SHARDS == 1:
+        return 'title_stats'
+    tables = ['main.title_stats'] + [f'shard{shard}.title_stats' for shard in range(1, USER_SHARDS)]
+    union = ' UNION ALL '.join(f'SELECT media_type, media_id, save_count, recent_adds FROM {table}'
+                               for table in tables)
+    return f'''(
+            SELECT media_type, media_id, SUM(save_count) AS save_count, SUM(recent_adds) AS recent_adds
+            FROM ({union})
+            GROUP BY media_type, media_id
+        )'''
+
+
+class InvalidArgument(ValueError):
+    """A query string argument that is present but does not parse"""
+
+
+def numeric_arg(name, cast, default=None):
+    """?name= converted with cast (int or float), default when it is missing or empty"""
+    value = request.args.get(name, '').strip()
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        kind = 'an integer' if cast is int else 'a number'
+        raise InvalidArgument(f"'{name}' must be {kind}, got '{value}'") from None
+
+
+def range_args():
+    """The year_from/year_to/min_rating/max_rating filters shared by the catalog endpoints"""
+    return {
+        'year_from': numeric_arg('year_from', int),
+        'year_to': numeric_arg('year_to', int),
+        'min_rating': numeric_arg('min_rating', float),
+        'max_rating': numeric_arg('max_rating', float),
+    }
+
+
+def query_catalog(table):
+    """Run a catalog listing with the optional min_rating/year_from/year_to/sort/limit filters"""
+    where_clause = []
+    params = []
+    try:
+        min_rating = numeric_arg('min_rating', float)
+        year_from = numeric_arg('year_from', int)
+        year_to = numeric_arg('year_to', int)
+        limit = numeric_arg('limit', int)
+    except InvalidArgument as e:
+        return jsonify({"error": str(e)}), 400
+    sort = request.args.get('sort')
+    if sort and sort not in CATALOG_SORTS:
+        return jsonify({"error": f"Unknown sort '{sort}'"}), 400
+
+    if min_rating is not None:
+        where_clause.append("rating_score >= ?")
+        params.append(min_rating)
+    if year_from is not None:
+        where_clause.append("year_int >= ?")
+        params.append(year_from)
+    if year_to is not None:
+        where_clause.append("year_int <= ?")
+        params.append(year_to)
+
+    # SQL picks and orders the ids; the title fields come from the in-memory catalog
+    query = f'''
+        SELECT {table}.id,
+               COALESCE(title_stats.save_count, 0) AS save_count,
+               COALESCE(title_stats.recent_adds, 0) AS recent_adds
+        FROM catalog.{table} AS {table}
+        LEFT JOIN {title_stats_source()} AS title_stats
+            ON title_stats.media_type = '{CATALOG_MEDIA_TYPES[table]}' AND title_stats.media_id = {table}.id
+    '''
+    if where_clause:
+        query += " WHERE " + " AND ".join(where_clause)
+    # Without an explicit order SQLite returns rows in whatever index it reads, so pin it to the id
+    query += " ORDER BY " + (CATALOG_SORTS[sort] if sort else f"{table}.id")
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(max(limit, 0))
+
+    hydrate = hydrate_catalog_rows(CATALOG_MEDIA_TYPES[table])
+    if request.args.get('format') == 'ndjson':
+        return stream_ndjson(query, params, transform=hydrate)
+
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute(query, params)
+    return jsonify(hydrate(cursor.fetchall()))
+
+
+CATALOG_COUNTER_FIELDS = ('recent_adds', 'save_count')
+
+
+def hydrate_catalog_rows(media_type):
+    """Transform for (id, save_count, recent_adds) rows into full catalog listings.
+
+    Each title's fields are encoded once per catalog version and only the live
+    counters are encoded per request.
+    """
+    def hydrate(rows):
+        catalog = catalog_cache.get()
+        items = RawJSONList()
+        for row in rows:
+            template = catalog.template(media_type, row['id'], CATALOG_COUNTER_FIELDS, app.json.template)
+            if template is not None:
+                counters = {"recent_adds": row['recent_adds'], "save_count": row['save_count']}
+                items.append(RawJSON(app.json.fill(template, counters)))
+        return items
+    return hydrate
+
+
+@app.route('/api/anime')
+@offloaded
+def get_anime():
+    """Anime catalog, optionally filtered by ?min_rating=&year_from=&year_to=&sort=, or ?format=ndjson to stream"""
+    try:
+        return query_catalog('anime')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/movies')
+@offloaded
+def get_movies():
+    """Movie catalog, optionally filtered by ?min_rating=&year_from=&year_to=&sort=, or ?format=ndjson to stream"""
+    try:
+        return query_catalog('movies')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/trending')
+@offloaded
+def get_trending():
+    """Top titles by time-decayed watchlist activity, served from memory"""
+    window = request.args.get('window', 'day')
+    media_type = request.args.get('media_type') or None
+    limit = request.args.get('limit', type=int)
+
+    if window not in TRENDING_WINDOWS:
+        return jsonify({"error": f"Unknown window '{window}'"}), 400
+    if media_type and media_type not in MEDIA_TYPES:
+        return jsonify({"error": f"Unknown media_type '{media_type}'"}), 400
+
+    try:
+        return jsonify(trending_engine.top(window, media_type, limit))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def load_title_popularity():
+    """Save count of every saved title, summed over the shards"""
+    db = connect_db()
+    try:
+        rows = db.execute(f'SELECT media_type, media_id, save_count FROM {title_stats_source()}').fetchall()
+    finally:
+        db.close()
+    return {(media_type, media_id): save_count for media_type, media_id, save_count in rows}
+
+
+autocomplete_cache = AutocompleteCache(catalog_cache, load_title_popularity)
+
+
+@app.route('/api/autocomplete')
+@offloaded
+def autocomplete():
+    """Titles whose name, alias or a word of the name starts with ?q=, most saved and best rated first.
+
+    ?limit= (default 10, at most 20) and ?media_type=anime|movie narrow the results.
+    """
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', 10, type=int)
+    media_type = request.args.get('media_type')
+    if media_type not in (None, 'anime', 'movie'):
+        return jsonify({"error": f"Unknown media_type '{media_type}'"}), 400
+    try:
+        index = autocomplete_cache.get()
+        return jsonify(index.results(index.complete(query, limit, media_type)))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/genres')
+@offloaded
+def get_genres():
+    """Genre counts per media type, optionally within ?year_from=&year_to=&min_rating=&max_rating="""
+    try:
+        ranges = range_args()
+    except InvalidArgument as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        catalog = catalog_cache.get()
+        facets = catalog.facets().counts(**ranges)
+        facets['version'] = catalog.version
+        return jsonify(facets)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def split_arg(name):
+    return [value for value in request.args.get(name, '').split(',') if value.strip()]
+
+
+# Added to each /api/filter card: its media type and canonical genre keys
+FILTER_CARD_FIELDS = ('media_type', 'genres')
+
+
+@app.route('/api/filter')
+@offloaded
+def filter_catalog():
+    """Boolean facet search: ?genres=fantasy,romance&exclude=isekai&year_from=2016&min_rating=8
+
+    genres must all match, any needs at least one match, exclude must not match.
+    Each result carries the title's card fields plus media_type and its genre keys.
+    """
+    media_type = request.args.get('media_type') or None
+    if media_type and media_type not in MEDIA_TYPES:
+        return jsonify({"error": f"Unknown media_type '{media_type}'"}), 400
+    try:
+        offset = max(numeric_arg('offset', int, 0), 0)
+        limit = min(max(numeric_arg('limit', int, 20), 0), 100)
+        ranges = range_args()
+    except InvalidArgument as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        catalog = catalog_cache.get()
+        index = catalog.bitmaps()
+        bits = index.filter(
+            all_of=split_arg('genres'),
+            any_of=split_arg('any'),
+            none_of=split_arg('exclude'),
+            media_type=media_type,
+            **ranges,
+        )
+        results = RawJSONList()
+        for mt, media_id in index.page(bits, offset, limit):
+            template = catalog.template(mt, media_id, FILTER_CARD_FIELDS, app.json.template)
+            genres = list(catalog.items[(mt, media_id)].genres)
+            results.append(RawJSON(app.json.fill(template, {"media_type": mt, "genres": genres})))
+        return jsonify({"count": bits.bit_count(), "offset": offset, "results": results, "version": catalog.version})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def shard_metrics(shard):
+    writer = watchlist_writers.get(shard)
+    return {
+        "shard": shard,
+        "maintenance": maintenance[shard].metrics(get_db(shard)),
+        "pool": db_pool(shard).metrics(),
+        "watchlist_writer": {"batches": writer.batches, "writes": writer.writes} if writer else None,
+    }
+
+
+# Bearer token for /api/admin/catalog; the endpoint is off while it is unset
+CATALOG_ADMIN_TOKEN = os.environ.get('CATALOG_ADMIN_TOKEN')
 
-# Initialize the database
-init_db()
+
+@app.route('/api/admin/catalog', methods=['POST'])
+def upsert_catalog():
+    """Add or edit titles and publish them as the next catalog version; body is a list or {"items": [...]}"""
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not CATALOG_ADMIN_TOKEN or not secrets.compare_digest(token, CATALOG_ADMIN_TOKEN):
+        return jsonify({"error": "Forbidden"}), 403
+
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Expected a non-empty list of titles"}), 400
+
+    try:
+        version, changed = publish_catalog_updates(items)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    # This worker picks the new version up right away, the others within the check interval
+    catalog_cache.refresh()
+    return jsonify({"version": version, "changed": [{"media_type": mt, "id": media_id} for mt, media_id in changed]})
+
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Counters of this worker's caches and writers, plus the last SQLite maintenance run"""
+    try:
+        return jsonify({
+            "maintenance": maintenance[0].metrics(get_db()),
+            "image_cache": {"hits": image_cache.hits, "misses": image_cache.misses},
+            "watchlist_writer": {
+                "batches": sum(writer.batches for writer in watchlist_writers.values()),
+                "writes": sum(writer.writes for writer in watchlist_writers.values()),
+            },
+            "chatbot_cache": chatbot_cache.metrics(),
+            "catalog": catalog_cache.metrics(),
+            "recommendations": recommendation_job.metrics(get_db()),
+            "admission": {name: admission.metrics() for name, admission in admissions.items()},
+            "rate_limit_store": {"errors": rate_limit_store.errors, "pool": rate_limit_store.pool.metrics()},
+            "shards": [shard_metrics(shard) for shard in range(USER_SHARDS)],
+            "blocking": blocking_executor.metrics(),
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/img/<media_type>/<int:media_id>/<variant>')
+def proxy_image(media_type, media_id, variant):
+    """Catalog image fetched once from upstream and served from the local cache"""
+    if variant not in IMAGE_VARIANTS:
+        return jsonify({"error": f"Unknown variant '{variant}'"}), 404
+    field, width = IMAGE_VARIANTS[variant]
+    title = catalog_cache.get().get(media_type, media_id)
+    if not title or not title.get(field):
+        return jsonify({"error": "Image not found"}), 404
+
+    url = title[field]
+    try:
+        # One open file for sniffing and sending, so an eviction can't remove it in between
+        f = image_cache.open(f'{variant}:{url}', url, width)
+    except Exception as e:
+        return jsonify({"error": f"Upstream image unavailable: {str(e)}"}), 502
+
+    try:
+        mimetype = sniff_content_type(f.read(12))
+        f.seek(0)
+        # Cache files are named after a hash of variant and source URL, which makes a stable ETag;
+        # the mtime can't be used because cache hits bump it for LRU
+        response = send_file(f, mimetype=mimetype, etag=os.path.basename(f.name), max_age=IMAGE_MAX_AGE)
+        # send_file only sizes paths and in-memory files, and Range support needs the length
+        size = os.fstat(f.fileno()).st_size
+        response.content_length = size
+        response = response.make_conditional(request, accept_ranges=True, complete_length=size)
+    except BaseException:
+        f.close()
+        raise
+    response.cache_control.public = True
+    return response
+
+
+def admit(name, template=None):
+    """Run a view's POSTs under admissions[name]: 429 past a client's rate, 503 while the class stays full.
+
+    Rejections render `template` with the message for form pages, and are JSON
+    with a "response" message (as the chatbot UI shows) otherwise.
+    """
+    admission = admissions[name]
+
+    def reject(status, message, retry_after):
+        if template:
+            response = app.make_response((render_template(template, error=message), status))
+        else:
+            response = jsonify({"error": message, "response": message})
+            response.status_code = status
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response
+
+    def enter():
+        """None once the request holds a slot, else the rejection to send"""
+        retry_after = admission.check_rate({
+            "ip": request.remote_addr,
+            "session": session.get('user_id'),
+            "username": request.form.get('username'),
+        })
+        if retry_after:
+            return reject(429, "Too many requests, please slow down and try again shortly.", retry_after)
+        if not admission.enter():
+            return reject(503, "We're busy right now, please try again in a moment.", admission.queue_timeout)
+        return None
+
+    def leave(response):
+        response = app.make_response(response)
+        # A streamed body is still being produced, so its slot is held until the server closes it
+        if response.is_streamed:
+            response.call_on_close(admission.leave)
+        else:
+            admission.leave()
+        return response
+
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                if request.method != 'POST':
+                    return await view(*args, **kwargs)
+                rejection = enter()
+                if rejection is not None:
+                    return rejection
+                try:
+                    response = await view(*args, **kwargs)
+                except BaseException:
+                    admission.leave()
+                    raise
+                return leave(response)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'POST':
+                return view(*args, **kwargs)
+            rejection = enter()
+            if rejection is not None:
+                return rejection
+            try:
+                response = view(*args, **kwargs)
+            except BaseException:
+                admission.leave()
+                raise
+            return leave(response)
+        return wrapper
+    return decorator
 
 
 @app.route('/')
@@ -1366,16 +2549,21 @@ def index():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@admit('auth', template='login.html')
 def login():
     """User login page"""
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
 
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute('SELECT id, password FROM users WHERE username = ?', (username,))
-        user = cursor.fetchone()
+        # The directory says which shard holds the account
+        user = None
+        found = user_directory.find(username)
+        if found:
+            user_id, shard = found
+            cursor = get_db(shard).cursor()
+            cursor.execute('SELECT id, password FROM users WHERE id = ?', (user_id,))
+            user = cursor.fetchone()
 
         if user and check_password_hash(user['password'], password):
             session['user_id'] = user['id']
@@ -1389,6 +2577,7 @@ def login():
 
 
 @app.route('/signup', methods=['GET', 'POST'])
+@admit('auth', template='signup.html')
 def signup():
     """User registration page"""
     if request.method == 'POST':
@@ -1403,11 +2592,17 @@ def signup():
         hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
 
         try:
-            db = get_db()
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
-                           (username, email, hashed_password))
-            db.commit()
+            # The directory allocates the id and enforces unique usernames/emails across shards
+            user_id, shard = user_directory.register(username, email)
+            try:
+                db = get_db(shard)
+                cursor = db.cursor()
+                cursor.execute('INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)',
+                               (user_id, username, email, hashed_password))
+                db.commit()
+            except Exception:
+                user_directory.unregister(user_id)
+                raise
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
             return render_template('signup.html', error="Username or email already exists")
@@ -1465,161 +2660,447 @@ def logout():
     return redirect(url_for('index'))
 
 
+# Fields of each title included in chatbot recommendations
+RECOMMENDATION_FIELDS = ('title', 'year', 'rating', 'description', 'image')
+
+# Answers that are the same for every user, for the current catalog version:
+# ('answer', message) -> encoded title/greeting reply or None, ('pool', media_type, genre) -> titles
+chatbot_cache = LFUCache(maxsize=1024)
+
+
+def sync_chatbot_cache(catalog):
+    """Follow the catalog version, keeping the cached answers no changed title could affect"""
+    if chatbot_cache.generation == catalog.version:
+        return
+    changes = catalog.changed_since(chatbot_cache.generation) if chatbot_cache.generation is not None else None
+    if changes is None:
+        chatbot_cache.sync(catalog.version)
+        return
+
+    # A message's answer can change if it names a changed title or is part of one's name
+    names = set()
+    fragments = []
+    media_types = set()
+    keys = set()
+    for pair in changes:
+        for item in pair:
+            if item is not None:
+                media_types.add(item.media_type)
+                keys.add((item.media_type, item.id))
+                names.add(item.title_key)
+                names.update(title_key_variants(item.title))
+                fragments.append(item.title.casefold())
+    names.update(alias_key for alias_key, key in catalog.aliases.items() if key in keys)
+
+    def stale(key):
+        if key[0] == 'pool':
+            return key[1] in media_types
+        message = key[1].casefold()
+        return title_key(message) in names or any(message in fragment for fragment in fragments)
+
+    chatbot_cache.advance(catalog.version, stale)
+
+
+def chatbot_title_answer(catalog, message):
+    """Encoded reply for a greeting or a title the message names, or None to try other intents"""
+    # Exact title or alias: one hash probe, tried before anything else
+    result = catalog.lookup_title(message)
+    if result is None:
+        # Handle greetings
+        if any(word in message for word in ['hello', 'hi', 'hey', 'greetings']):
+            return app.json.encode(
+                {"response": "👋 Hello! I'm ChatBuddy, your anime and movie assistant. How can I help you today?"})
+
+        # Handle title search without keywords; anime first, then movies
+        result = catalog.search_title(message)
+
+    if result is None:
+        return None
+    response = f"🎥 Here's information about <strong>{result['title']}</strong>:\n\n"
+    response += f"📅 Year: {result['year']}\n"
+    response += f"⭐ Rating: {result['rating']}\n"
+    response += f"📝 Description: {result['description']}\n"
+    if 'insights' in result:
+        response += f"\n💡 Insights: {result['insights']}\n"
+    item = RawJSON(catalog.encoded(result.media_type, result.id, app.json.encode))
+    return app.json.fill(app.json.template({"response": response, "type": "info"}, ('item',)), {"item": item})
+
+
+def chatbot_answer(catalog, message):
+    """Cached encoded reply for a greeting or a named title, or None to try other intents"""
+    answer = chatbot_cache.get(('answer', message))
+    if answer is MISSING:
+        answer = chatbot_title_answer(catalog, message)
+        chatbot_cache.put(('answer', message), answer)
+    return answer
+
+
+def wants_recommendations(message):
+    return any(word in message for word in ['recommend', 'suggest', 'what to watch'])
+
+
+def wants_watchlist(message):
+    return any(word in message for word in ['show watchlist', 'my watchlist', 'whats in my watchlist'])
+
+
+def chatbot_recommendations(catalog, message, user_id):
+    """Up to three titles for a recommendation request"""
+    # Check for genre specification
+    genres = ['action', 'fantasy', 'romance', 'comedy', 'drama', 'sci-fi', 'horror', 'shonen', 'seinen',
+              'shojo']
+    genre = next((g for g in genres if g in message), None)
+
+    # Check for type specification; default to anime if no type specified
+    media_type = 'movie' if 'movie' in message and 'anime' not in message else 'anime'
+
+    # The user's precomputed list first; otherwise a random pick from the cached pool
+    results = [item for item, score in read_recommendations(user_id, media_type, genre)[:3]]
+    if not results:
+        candidates = chatbot_cache.get(('pool', media_type, genre))
+        if candidates is MISSING:
+            candidates = catalog.titles(media_type, genre)
+            chatbot_cache.put(('pool', media_type, genre), candidates)
+        results = random.sample(candidates, min(3, len(candidates)))
+    return results
+
+
+def recommendation_line(item):
+    return f"\n- <strong>{item['title']}</strong> ({item['year']}) ⭐ {item['rating']}\n{item['description']}\n"
+
+
+def watchlist_line(item):
+    return f"- <strong>{item['title']}</strong> ({item['year']}) ⭐ {item['rating']}\n"
+
+
+CHATBOT_WATCHLIST_QUERY = '''
+    SELECT id, media_type, media_id
+    FROM watchlist
+    WHERE user_id = ?
+    ORDER BY added_at DESC
+'''
+CHATBOT_EMPTY_MESSAGE = "Please type something so I can help you!"
+CHATBOT_NO_RECOMMENDATIONS = "I couldn't find any recommendations. Try being more specific!"
+CHATBOT_RECOMMENDATIONS_INTRO = "🎬 Here are some recommendations for you:\n"
+CHATBOT_EMPTY_WATCHLIST = "Your watchlist is empty. Add some anime or movies to get started!"
+CHATBOT_WATCHLIST_INTRO = "📋 Here's your watchlist:\n\n"
+CHATBOT_HELP = ("I'm here to help you with anime and movie recommendations and information! "
+                "Try asking about a specific title or asking for recommendations.")
+CHATBOT_ERROR = "Sorry, I encountered an error. Please try again later."
+
+
+def chat_message():
+    data = request.get_json(silent=True) or {}
+    return ' '.join(str(data.get('message', '')).lower().split())
+
+
 @app.route('/chatbot', methods=['POST'])
+@admit('chatbot')
+@offloaded
 def chatbot():
     if 'user_id' not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
-    data = request.get_json()
-    message = data.get('message', '').strip().lower()
+    message = chat_message()
 
     if not message:
-        return jsonify({"response": "Please type something so I can help you!"})
-
-    db = get_db()
-    cursor = db.cursor()
+        return jsonify({"response": CHATBOT_EMPTY_MESSAGE})
 
     try:
-        # Handle greetings
-        if any(word in message for word in ['hello', 'hi', 'hey', 'greetings']):
-            return jsonify(
-                {"response": "👋 Hello! I'm ChatBuddy, your anime and movie assistant. How can I help you today?"})
+        catalog = catalog_cache.get()
+        sync_chatbot_cache(catalog)
 
-        # Handle title search without keywords
-        found_title = None
+        answer = chatbot_answer(catalog, message)
+        if answer is not None:
+            return app.response_class(answer + b'\n', mimetype='application/json')
 
-        # Search in anime table
-        cursor.execute("SELECT * FROM anime WHERE LOWER(title) LIKE ? LIMIT 1", (f'%{message}%',))
-        result = cursor.fetchone()
+        # Handle recommendations
+        elif wants_recommendations(message):
+            results = chatbot_recommendations(catalog, message, session['user_id'])
 
-        # If not found in anime, search in movies
-        if not result:
-            cursor.execute("SELECT * FROM movies WHERE LOWER(title) LIKE ? LIMIT 1", (f'%{message}%',))
-            result = cursor.fetchone()
+            if not results:
+                return jsonify({"response": CHATBOT_NO_RECOMMENDATIONS})
 
-        if result:
-            found_title = result['title']
-            response = f"🎥 Here's information about <strong>{result['title']}</strong>:\n\n"
-            response += f"📅 Year: {result['year']}\n"
-            response += f"⭐ Rating: {result['rating']}\n"
-            response += f"📝 Description: {result['description']}\n"
-            if 'insights' in result:
-                response += f"\n💡 Insights: {result['insights']}\n"
-            return jsonify({"response": response, "type": "info", "item": dict(result)})
+            response = CHATBOT_RECOMMENDATIONS_INTRO + ''.join(recommendation_line(item) for item in results)
 
-        # Handle recommendations
-        elif any(word in message for word in ['recommend', 'suggest', 'what to watch']):
-            # Check for genre specification
-            genres = ['action', 'fantasy', 'romance', 'comedy', 'drama', 'sci-fi', 'horror', 'shonen', 'seinen',
-                      'shojo']
-            genre = next((g for g in genres if g in message), None)
-
-            # Check for type specification
-            media_type = 'anime' if 'anime' in message else 'movie' if 'movie' in message else None
-
-            # Build query based on parameters
-            query = "SELECT title, year, rating, description, image FROM "
-            where_clause = []
-            params = []
-
-            if media_type == 'anime':
-                query += "anime"
-            elif media_type == 'movie':
-                query += "movies"
-            else:
-                # Default to anime if no type specified
-                query += "anime"
-                media_type = 'anime'
+            return jsonify({"response": response, "type": "recommendations",
+                            "results": [item.as_dict(RECOMMENDATION_FIELDS) for item in results]})
 
-            if genre:
-                where_clause.append("category LIKE ?")
-                params.append(f'%{genre}%')
+        # Handle watchlist viewing; personal, so never cached
+        elif wants_watchlist(message):
+            cursor = user_db(session['user_id']).cursor()
+            cursor.execute(CHATBOT_WATCHLIST_QUERY, (session['user_id'],))
 
-            if where_clause:
-                query += " WHERE " + " AND ".join(where_clause)
+            watchlist = hydrate_watchlist(cursor.fetchall())
 
-            query += " ORDER BY RANDOM() LIMIT 3"
+            if not watchlist:
+                return jsonify({"response": CHATBOT_EMPTY_WATCHLIST})
 
-            cursor.execute(query, params)
-            results = cursor.fetchall()
+            response = CHATBOT_WATCHLIST_INTRO + ''.join(watchlist_line(item) for item in watchlist)
 
-            if not results:
-                return jsonify({"response": "I couldn't find any recommendations. Try being more specific!"})
+            return jsonify({"response": response, "type": "watchlist", "items": watchlist})
 
-            response = "🎬 Here are some recommendations for you:\n"
+        # Handle unknown requests
+        else:
+            return jsonify({"response": CHATBOT_HELP})
+
+    except Exception as e:
+        print(f"Chatbot error: {str(e)}")
+        return jsonify({"response": CHATBOT_ERROR}), 500
+
+
+# Seconds of silence after which a chat stream sends an SSE comment, so proxies keep it open
+CHAT_STREAM_HEARTBEAT = 10.0
+# Events a stream buffers ahead of a slow client before the producer waits
+CHAT_STREAM_BUFFER = 64
+
+
+def chatbot_events(message, user_id):
+    """(event, data) pairs answering a chat message, produced as the answer is worked out.
+
+    'ack' comes first and names the reply type with its opening text (for a
+    title, the whole answer). Each result then follows as an 'item' as soon as
+    it is read, and 'done' ends the reply, replacing the text when nothing was
+    found.
+    """
+    if not message:
+        yield 'ack', {"response": CHATBOT_EMPTY_MESSAGE}
+    else:
+        catalog = catalog_cache.get()
+        sync_chatbot_cache(catalog)
+        answer = chatbot_answer(catalog, message)
+        if answer is not None:
+            yield 'ack', RawJSON(answer)
+        elif wants_recommendations(message):
+            yield 'ack', {"response": CHATBOT_RECOMMENDATIONS_INTRO, "type": "recommendations"}
+            results = chatbot_recommendations(catalog, message, user_id)
+            if not results:
+                yield 'done', {"response": CHATBOT_NO_RECOMMENDATIONS}
+                return
             for item in results:
-                response += f"\n- <strong>{item['title']}</strong> ({item['year']}) ⭐ {item['rating']}\n{item['description']}\n"
+                yield 'item', {"item": item.as_dict(RECOMMENDATION_FIELDS), "text": recommendation_line(item)}
+        elif wants_watchlist(message):
+            yield 'ack', {"response": CHATBOT_WATCHLIST_INTRO, "type": "watchlist"}
+            empty = True
+            for item in iter_query(CHATBOT_WATCHLIST_QUERY, (user_id,), hydrate_watchlist, user_shard(user_id)):
+                empty = False
+                yield 'item', {"item": item, "text": watchlist_line(item)}
+            if empty:
+                yield 'done', {"response": CHATBOT_EMPTY_WATCHLIST}
+                return
+        else:
+            yield 'ack', {"response": CHATBOT_HELP}
+    yield 'done', {}
 
-            return jsonify({"response": response, "type": "recommendations", "results": [dict(row) for row in results]})
 
+def sse_event(event, data):
+    # Compact JSON has no raw newlines, so the payload is always a single data: line
+    return b'event: %s\ndata: %s\n\n' % (event.encode(), app.json.encode(data))
 
-        # Handle watchlist viewing
-        elif any(word in message for word in ['show watchlist', 'my watchlist', 'whats in my watchlist']):
-            cursor.execute('''
-                SELECT id, title, year, rating, image 
-                FROM watchlist 
-                WHERE user_id = ?
-                ORDER BY added_at DESC
-            ''', (session['user_id'],))
 
-            watchlist = cursor.fetchall()
+@app.route('/chatbot/stream', methods=['POST'])
+@admit('chatbot')
+def chatbot_stream():
+    """The chatbot's reply as Server-Sent Events (see chatbot_events), with comment lines as heartbeats.
 
-            if not watchlist:
-                return jsonify({"response": "Your watchlist is empty. Add some anime or movies to get started!"})
+    The reply is worked out on a producer thread that hands events over a small
+    queue, so heartbeats keep flowing while it waits on the database. When the
+    client goes away the server closes the body, which stops the producer.
+    """
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
 
-            response = "📋 Here's your watchlist:\n\n"
-            for item in watchlist:
-                response += f"- <strong>{item['title']}</strong> ({item['year']}) ⭐ {item['rating']}\n"
+    message = chat_message()
+    user_id = session['user_id']
+    events = queue.Queue(maxsize=CHAT_STREAM_BUFFER)
+    cancelled = threading.Event()
 
-            return jsonify({"response": response, "type": "watchlist", "items": [dict(row) for row in watchlist]})
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                events.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        # Its own app context: get_db() connections here are the producer's, released when it ends
+        with app.app_context():
+            try:
+                with closing(chatbot_events(message, user_id)) as replies:
+                    for reply in replies:
+                        if not put(reply):
+                            return
+            except Exception as e:
+                print(f"Chatbot error: {str(e)}")
+                put(('error', {"response": CHATBOT_ERROR}))
+            finally:
+                put(None)
 
-        # Handle unknown requests
+    def generate():
+        threading.Thread(target=produce, name='chatbot-stream', daemon=True).start()
+        try:
+            while True:
+                try:
+                    reply = events.get(timeout=CHAT_STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield b': heartbeat\n\n'
+                    continue
+                if reply is None:
+                    return
+                yield sse_event(*reply)
+        finally:
+            cancelled.set()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tell nginx-style proxies not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Watchlist mutations take a cursor and return False when there was nothing to do,
+# so they can run either on the request's connection or inside a group commit
+def add_watchlist_item(cursor, user_id, media_type, media_id):
+    cursor.execute('''
+        INSERT OR IGNORE INTO watchlist (user_id, media_type, media_id)
+        VALUES (?, ?, ?)
+    ''', (user_id, media_type, media_id))
+    # Nothing inserted means it was already in the watchlist
+    if cursor.rowcount == 0:
+        return False
+    record_watchlist_event(cursor, user_id, media_type, media_id, 'add')
+    return True
+
+
+def remove_watchlist_item(cursor, user_id, item_id):
+    cursor.execute('''
+        SELECT media_type, media_id FROM watchlist 
+        WHERE id = ? AND user_id = ?
+    ''', (item_id, user_id))
+    item = cursor.fetchone()
+    if not item:
+        return False
+
+    cursor.execute('DELETE FROM watchlist WHERE id = ?', (item_id,))
+    record_watchlist_event(cursor, user_id, item[0], item[1], 'remove')
+    return True
+
+
+def remove_watchlist_media(cursor, user_id, media_type, media_id):
+    cursor.execute('''
+        DELETE FROM watchlist 
+        WHERE user_id = ? AND media_type = ? AND media_id = ?
+    ''', (user_id, media_type, media_id))
+    if cursor.rowcount == 0:
+        return False
+    record_watchlist_event(cursor, user_id, media_type, media_id, 'remove')
+    return True
+
+
+def clear_watchlist(cursor, user_id):
+    cursor.execute('SELECT media_type, media_id FROM watchlist WHERE user_id = ?', (user_id,))
+    items = cursor.fetchall()
+    cursor.execute('DELETE FROM watchlist WHERE user_id = ?', (user_id,))
+    for media_type, media_id in items:
+        record_watchlist_event(cursor, user_id, media_type, media_id, 'remove')
+    return len(items)
+
+
+WATCHLIST_BATCH_ERRORS = {
+    'add': "Already in watchlist",
+    'remove': "Item not found",
+    'remove_item': "Item not found",
+}
+
+
+def apply_watchlist_batch(cursor, user_id, operations):
+    """Apply normalized (index, op, *args) operations; returns {index: result}"""
+    results = {}
+    for index, op, *args in operations:
+        if op == 'add':
+            done = add_watchlist_item(cursor, user_id, *args)
+        elif op == 'remove':
+            done = remove_watchlist_media(cursor, user_id, *args)
+        elif op == 'remove_item':
+            done = remove_watchlist_item(cursor, user_id, *args)
         else:
-            return jsonify({
-                               "response": "I'm here to help you with anime and movie recommendations and information! Try asking about a specific title or asking for recommendations."})
+            results[index] = {"success": True, "removed": clear_watchlist(cursor, user_id)}
+            continue
+        results[index] = {"success": True} if done else {"success": False, "error": WATCHLIST_BATCH_ERRORS[op]}
+    return results
+
+
+def resolve_watchlist_title(catalog, item):
+    """(media_type, media_id) for an import/batch item given by id or by exact title"""
+    media_type = item.get('media_type') or None
+    try:
+        media_id = int(item.get('media_id') or item.get('anime_id') or 0)
+    except (TypeError, ValueError):
+        media_id = 0
+    if media_id:
+        media_type = media_type or catalog.resolve_media_type(media_id)
+        return (media_type, media_id) if catalog.get(media_type, media_id) else None
+    return catalog.find_title(item.get('title'), media_type)
+
+
+# Seconds a client is told to wait after a watchlist write was refused with a 503
+WRITE_RETRY_AFTER = 1
+
+
+def write_unavailable(error, **fields):
+    """503 for a write refused by a full or stalled writer queue or a shard move"""
+    response = jsonify(success=False, error=str(error), **fields)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(WRITE_RETRY_AFTER)
+    return response
+
+
+def run_watchlist_write(func, user_id, *args):
+    """Apply a watchlist mutation on the user's shard and return once it is committed"""
+    shard = user_shard(user_id, for_write=True)
+    if WATCHLIST_GROUP_COMMIT:
+        return watchlist_writer(shard).submit(func, user_id, *args)
+    db = get_db(shard)
+    try:
+        result = func(db.cursor(), user_id, *args)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return result
+
 
-    except Exception as e:
-        print(f"Chatbot error: {str(e)}")
-        return jsonify({"response": "Sorry, I encountered an error. Please try again later."}), 500
 # Watchlist API Endpoints
 @app.route('/add_to_watchlist', methods=['POST'])
+@offloaded
 def add_to_watchlist():
     """Add anime to user's watchlist"""
     if 'user_id' not in session:
         return jsonify(success=False, error="Not logged in"), 401
 
     data = request.get_json()
-    anime_id = data.get('anime_id')
-    title = data.get('title')
+    try:
+        anime_id = int(data.get('anime_id') or 0)
+    except (TypeError, ValueError):
+        anime_id = 0
 
-    if not anime_id or not title:
+    if not anime_id:
         return jsonify(success=False, error="Missing required data"), 400
 
-    year = data.get('year', '')
-    rating = data.get('rating', '')
-    image = data.get('image', '')
-
     try:
-        db = get_db()
-        cursor = db.cursor()
-
-        # Check if already in watchlist
-        cursor.execute('''
-            SELECT id FROM watchlist 
-            WHERE user_id = ? AND anime_id = ?
-        ''', (session['user_id'], anime_id))
-        existing = cursor.fetchone()
-
-        if existing:
+        # Title, year, rating and image are looked up from the catalog on read
+        catalog = catalog_cache.get()
+        media_type = data.get('media_type') or catalog.resolve_media_type(anime_id)
+        if not catalog.get(media_type, anime_id):
+            return jsonify(success=False, error="Unknown title"), 404
+
+        added = run_watchlist_write(add_watchlist_item, session['user_id'], media_type, anime_id)
+        if not added:
             return jsonify(success=False, error="Already in watchlist"), 409
-
-        # Add to watchlist
-        cursor.execute('''
-            INSERT INTO watchlist (user_id, anime_id, title, year, rating, image)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (session['user_id'], anime_id, title, year, rating, image))
-        db.commit()
         return jsonify(success=True)
+    except (WriterOverloaded, ShardMigrating) as e:
+        return write_unavailable(e)
     except sqlite3.IntegrityError:
         return jsonify(success=False, error="Database error"), 500
     except Exception as e:
@@ -1627,49 +3108,436 @@ def add_to_watchlist():
 
 
 @app.route('/remove_from_watchlist/<int:item_id>', methods=['DELETE'])
+@offloaded
 def remove_from_watchlist(item_id):
     """Remove item from watchlist"""
     if 'user_id' not in session:
         return jsonify(success=False, error="Not logged in"), 401
 
     try:
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute('''
-            DELETE FROM watchlist 
-            WHERE id = ? AND user_id = ?
-        ''', (item_id, session['user_id']))
-
-        if cursor.rowcount == 0:
+        if not run_watchlist_write(remove_watchlist_item, session['user_id'], item_id):
             return jsonify(success=False, error="Item not found"), 404
-
-        db.commit()
         return jsonify(success=True)
+    except (WriterOverloaded, ShardMigrating) as e:
+        return write_unavailable(e)
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+
+
+# Operations accepted by one /api/watchlist/batch request
+WATCHLIST_BATCH_LIMIT = 1000
+WATCHLIST_IMPORT_CHUNK = 500
+WATCHLIST_EXPORT_FIELDS = ['media_type', 'media_id', 'title', 'year', 'rating', 'added_at']
+
+
+@app.route('/api/watchlist/batch', methods=['POST'])
+@offloaded
+def watchlist_batch():
+    """Apply many add/remove/clear operations in one transaction.
+
+    Body: {"operations": [{"op": "add", "media_id": 3}, {"op": "remove", "id": 12},
+    {"op": "remove", "media_type": "movie", "media_id": 80}, {"op": "clear"}]}
+    Each operation gets its own entry in "results", in request order.
+    """
+    if 'user_id' not in session:
+        return jsonify(success=False, error="Not logged in"), 401
+
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list):
+        return jsonify(success=False, error="Expected an 'operations' list"), 400
+    if len(operations) > WATCHLIST_BATCH_LIMIT:
+        return jsonify(success=False, error=f"At most {WATCHLIST_BATCH_LIMIT} operations per batch"), 413
+
+    catalog = catalog_cache.get()
+    results = {}
+    normalized = []
+    for index, item in enumerate(operations):
+        op = item.get('op') if isinstance(item, dict) else None
+        if op == 'clear':
+            normalized.append((index, 'clear'))
+        elif op == 'remove' and item.get('id') is not None:
+            if isinstance(item['id'], int) and not isinstance(item['id'], bool):
+                normalized.append((index, 'remove_item', item['id']))
+            else:
+                results[index] = {"success": False, "error": "id must be an integer"}
+        elif op in ('add', 'remove'):
+            key = resolve_watchlist_title(catalog, item)
+            if key:
+                normalized.append((index, op) + key)
+            else:
+                results[index] = {"success": False, "error": "Unknown title"}
+        else:
+            results[index] = {"success": False, "error": "Unknown operation"}
+
+    try:
+        if normalized:
+            results.update(run_watchlist_write(apply_watchlist_batch, session['user_id'], normalized))
+    except (WriterOverloaded, ShardMigrating) as e:
+        return write_unavailable(e)
     except Exception as e:
         return jsonify(success=False, error=str(e)), 500
+    return jsonify(success=True, results=[results[index] for index in range(len(operations))])
+
+
+@app.route('/api/watchlist/export')
+@offloaded
+def export_watchlist():
+    """Download the watchlist as ?format=csv (default), json or ndjson, streamed"""
+    if 'user_id' not in session:
+        return jsonify(success=False, error="Not logged in"), 401
+
+    export_format = request.args.get('format', 'csv')
+    query = '''
+        SELECT id, media_type, media_id, added_at 
+        FROM watchlist 
+        WHERE user_id = ?
+        ORDER BY added_at DESC
+    '''
+    params = (session['user_id'],)
+    shard = user_shard(session['user_id'])
+
+    def with_added_at(rows):
+        for row, item in zip(rows, hydrate_watchlist(rows)):
+            item['added_at'] = row['added_at']
+            yield {field: item[field] for field in WATCHLIST_EXPORT_FIELDS}
+
+    if export_format == 'ndjson':
+        response = stream_ndjson(query, params, transform=with_added_at, shard=shard)
+    elif export_format == 'json':
+        def generate():
+            yield b'['
+            for i, item in enumerate(iter_query(query, params, with_added_at, shard)):
+                yield (b',' if i else b'') + app.json.encode(item)
+            yield b']'
+        response = Response(generate(), mimetype='application/json')
+    elif export_format == 'csv':
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=WATCHLIST_EXPORT_FIELDS)
+            writer.writeheader()
+            for item in iter_query(query, params, with_added_at, shard):
+                writer.writerow(item)
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        response = Response(generate(), mimetype='text/csv')
+    else:
+        return jsonify(success=False, error=f"Unknown format '{export_format}'"), 400
+
+    response.headers['Content-Disposition'] = f'attachment; filename=watchlist.{export_format}'
+    return response
+
+
+def read_import_items():
+    """Yield dicts from a CSV, NDJSON or JSON request body, read as it arrives"""
+    content_type = request.mimetype
+    lines = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig')
+    if content_type == 'application/json':
+        yield from iter_json_list(lines)
+    elif content_type == 'application/x-ndjson':
+        for line in lines:
+            if line.strip():
+                yield app.json.loads(line)
+    else:
+        yield from csv.DictReader(lines)
+
+
+@app.route('/api/watchlist/import', methods=['POST'])
+@offloaded
+def import_watchlist():
+    """Add titles from an exported (or third-party) list, matched by media_id or exact title.
+
+    The body is consumed as a stream and applied WATCHLIST_IMPORT_CHUNK rows per transaction.
+    """
+    if 'user_id' not in session:
+        return jsonify(success=False, error="Not logged in"), 401
+
+    catalog = catalog_cache.get()
+    summary = {"added": 0, "skipped": 0, "failed": 0, "errors": []}
+    chunk = []
+
+    def flush():
+        results = run_watchlist_write(apply_watchlist_batch, session['user_id'], chunk)
+        for result in results.values():
+            summary['added' if result['success'] else 'skipped'] += 1
+        chunk.clear()
+
+    try:
+        for line, item in enumerate(read_import_items(), start=1):
+            key = resolve_watchlist_title(catalog, item) if isinstance(item, dict) else None
+            if key is None:
+                summary['failed'] += 1
+                if len(summary['errors']) < 100:
+                    summary['errors'].append({"line": line, "error": "Unknown title"})
+                continue
+            chunk.append((line, 'add') + key)
+            if len(chunk) >= WATCHLIST_IMPORT_CHUNK:
+                flush()
+        if chunk:
+            flush()
+    except (WriterOverloaded, ShardMigrating) as e:
+        return write_unavailable(e, **summary)
+    except (ValueError, csv.Error) as e:
+        return jsonify(success=False, error=f"Could not parse import: {str(e)}", **summary), 400
+    except Exception as e:
+        return jsonify(success=False, error=str(e), **summary), 500
+    return jsonify(success=True, **summary)
 
 
 @app.route('/get_watchlist')
+@offloaded
 def get_watchlist():
-    """Get user's watchlist"""
+    """Get user's watchlist (?format=ndjson streams it one item per line)"""
     if 'user_id' not in session:
         return jsonify(success=False, error="Not logged in"), 401
 
+    query = '''
+        SELECT id, media_type, media_id 
+        FROM watchlist 
+        WHERE user_id = ?
+        ORDER BY added_at DESC
+    '''
+    if request.args.get('format') == 'ndjson':
+        return stream_ndjson(query, (session['user_id'],), transform=hydrate_watchlist,
+                             shard=user_shard(session['user_id']))
+
     try:
-        db = get_db()
+        db = user_db(session['user_id'])
         cursor = db.cursor()
-        cursor.execute('''
-            SELECT id, anime_id, title, year, rating, image 
-            FROM watchlist 
-            WHERE user_id = ?
-            ORDER BY added_at DESC
-        ''', (session['user_id'],))
-
-        watchlist = [dict(row) for row in cursor.fetchall()]
-        return jsonify(watchlist)
+        # Version first: a write landing in between is replayed by the next
+        # /api/watchlist/changes call instead of being missed
+        version = read_watchlist_version(cursor, session['user_id'])
+        cursor.execute(query, (session['user_id'],))
+        response = jsonify(hydrate_watchlist(cursor.fetchall()))
+        response.headers['X-Watchlist-Version'] = str(version)
+        return response
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+
+
+# Titles looked up per query when hydrating additions (two bound parameters each)
+WATCHLIST_CHANGES_CHUNK = 400
+
+
+@app.route('/api/watchlist/changes')
+@offloaded
+def get_watchlist_changes():
+    """Adds and removes since ?since=<version>, or 304 when the watchlist hasn't changed.
+
+    Versions are per user and go up by one per change, so the log covers the gap
+    exactly when it holds (current - since) events above `since`. If retention has
+    pruned part of it (or the version is unknown) the response is a full reset.
+    """
+    if 'user_id' not in session:
+        return jsonify(success=False, error="Not logged in"), 401
+
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return jsonify(success=False, error="'since' must be a non-negative version"), 400
+
+    user_id = session['user_id']
+    try:
+        db = user_db(user_id)
+        cursor = db.cursor()
+        # One read transaction so the version, the log and the rows agree
+        cursor.execute('BEGIN')
+        version = read_watchlist_version(cursor, user_id)
+        etag = f'W/"watchlist-{version}"'
+        if since == version:
+            db.rollback()
+            response = Response(status=304)
+            response.headers['ETag'] = etag
+            return response
+
+        events = []
+        if since < version:
+            cursor.execute('''
+                SELECT media_type, media_id, action
+                FROM watchlist_events
+                WHERE user_id = ? AND version > ?
+                ORDER BY version
+            ''', (user_id, since))
+            events = cursor.fetchall()
+
+        if since > version or len(events) != version - since:
+            cursor.execute('''
+                SELECT id, media_type, media_id 
+                FROM watchlist 
+                WHERE user_id = ?
+                ORDER BY added_at DESC
+            ''', (user_id,))
+            items = hydrate_watchlist(cursor.fetchall())
+            db.rollback()
+            response = jsonify(version=version, reset=True, items=items)
+            response.headers['ETag'] = etag
+            return response
+
+        # Only the last action per title matters to the client
+        latest = {}
+        for media_type, media_id, action in events:
+            latest.pop((media_type, media_id), None)
+            latest[(media_type, media_id)] = action
+        added_keys = [key for key, action in latest.items() if action == 'add']
+        removed = [{"media_type": mt, "media_id": mid} for (mt, mid), action in latest.items() if action == 'remove']
+
+        rows = []
+        for start in range(0, len(added_keys), WATCHLIST_CHANGES_CHUNK):
+            chunk = added_keys[start:start + WATCHLIST_CHANGES_CHUNK]
+            cursor.execute(f'''
+                SELECT id, media_type, media_id, added_at 
+                FROM watchlist 
+                WHERE user_id = ? AND (media_type, media_id) IN ({', '.join(['(?, ?)'] * len(chunk))})
+            ''', (user_id, *[value for key in chunk for value in key]))
+            rows.extend(cursor.fetchall())
+        db.rollback()
+        rows.sort(key=lambda row: row['added_at'], reverse=True)
+        added = hydrate_watchlist(rows)
+
+        response = jsonify(version=version, reset=False, added=added, removed=removed)
+        response.headers['ETag'] = etag
+        return response
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+
+
+def read_recommendations(user_id, media_type=None, genre=None):
+    """(title, score) pairs of a user's precomputed list, best first, skipping titles no longer in the catalog"""
+    catalog = catalog_cache.get()
+    genre = genre.casefold() if genre else None
+    rows = user_db(user_id).execute('''
+        SELECT media_type, media_id, score FROM user_recommendations WHERE user_id = ? ORDER BY rank
+    ''', (user_id,)).fetchall()
+    results = []
+    for row in rows:
+        item = catalog.get(row['media_type'], row['media_id'])
+        if item is None or media_type not in (None, row['media_type']):
+            continue
+        if genre is None or genre in (item.category or '').casefold():
+            results.append((item, row['score']))
+    return results
+
+
+RECOMMENDATION_SCORE_FIELDS = ('media_type', 'score')
+
+
+@app.route('/api/recommendations')
+@offloaded
+def get_recommendations():
+    """The user's precomputed recommendations, best first (?media_type=anime|movie, ?limit= up to 20)"""
+    if 'user_id' not in session:
+        return jsonify(success=False, error="Not logged in"), 401
+    media_type = request.args.get('media_type')
+    if media_type not in (None, 'anime', 'movie'):
+        return jsonify(success=False, error=f"Unknown media_type '{media_type}'"), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 0), 20)
+
+    try:
+        catalog = catalog_cache.get()
+        items = RawJSONList()
+        for item, score in read_recommendations(session['user_id'], media_type)[:limit]:
+            template = catalog.template(item.media_type, item.id, RECOMMENDATION_SCORE_FIELDS, app.json.template)
+            items.append(RawJSON(app.json.fill(template, {"media_type": item.media_type, "score": score})))
+        return jsonify(items)
     except Exception as e:
         return jsonify(success=False, error=str(e)), 500
 
 
+def warm_templates():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def warm_catalog():
+    """Load the catalog and build everything derived from it: facets, bitmaps, title lookup, JSON fragments"""
+    catalog = catalog_cache.get()
+    catalog.facets()
+    catalog.bitmaps()
+    catalog.find_title('')
+    for media_type, media_id in catalog.items:
+        catalog.encoded(media_type, media_id, app.json.encode)
+    autocomplete_cache.get()
+
+
+def warm_database():
+    """Pull the hot tables of every shard into the page cache and start the long-lived connections"""
+    for shard in range(USER_SHARDS):
+        db = connect_db(shard)
+        try:
+            for table in ('users', 'watchlist', 'watchlist_events', 'title_stats', 'catalog.anime', 'catalog.movies'):
+                db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()
+        finally:
+            db.close()
+        if WATCHLIST_GROUP_COMMIT:
+            watchlist_writer(shard).ensure_running()
+    trending_engine.poll()
+
+
+# Requests the catalog pages issue on load, run once through the full stack
+WARMUP_REQUESTS = [
+    '/api/anime',
+    '/api/movies',
+    '/api/anime?sort=rating&limit=20',
+    '/api/movies?sort=popular&limit=20',
+    '/api/genres',
+    '/api/filter?genres=action',
+    '/api/trending',
+    '/api/autocomplete?q=a',
+]
+
+
+# WSGI environ key set on warm-up requests, which are not user traffic
+WARMUP_ENVIRON = 'chibibytes.warmup'
+
+
+def warm_requests():
+    client = app.test_client()
+    client.environ_base[WARMUP_ENVIRON] = True
+    for url in WARMUP_REQUESTS:
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} returned {response.status_code}")
+
+
+warmup = Warmup([
+    ('templates', warm_templates),
+    ('catalog', warm_catalog),
+    ('database', warm_database),
+    ('requests', warm_requests),
+])
+
+HEALTH_ENDPOINTS = {'healthz', 'readyz'}
+
+# Readiness fails when a trivial query takes longer than this
+READYZ_MAX_DB_MS = 1000
+
+
+def probe_database():
+    """Milliseconds to take a pooled connection to every shard and read the attached catalog through it"""
+    started = time.monotonic()
+    for shard in range(USER_SHARDS):
+        get_db(shard).execute("SELECT value FROM catalog.app_meta WHERE key = 'catalog_version'").fetchone()
+    return round((time.monotonic() - started) * 1000, 3)
+
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the worker is up and answering"""
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: warm-up has finished and the database answers quickly"""
+    status = warmup.status()
+    try:
+        latency = probe_database()
+        status['db'] = {"ok": latency <= READYZ_MAX_DB_MS, "latency_ms": latency}
+    except Exception as e:
+        status['db'] = {"ok": False, "error": str(e)}
+    ready = status['ready'] and status['db']['ok']
+    return jsonify(status), 200 if ready else 503
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001, debug=True)
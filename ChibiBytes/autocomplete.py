@@ -0,0 +1,145 @@
+import bisect
+import heapq
+import threading
+
+from catalog import title_key
+
+# Most results one lookup returns
+MAX_RESULTS = 20
+# Fields of a title in autocomplete results
+RESULT_FIELDS = ('id', 'title', 'year', 'rating', 'image')
+
+
+class AutocompleteIndex:
+    """Prefix lookup over the title keys, aliases and alternate names of one catalog version.
+
+    Every name (and every word-boundary suffix of a title, so "kaisen" finds
+    Jujutsu Kaisen) is kept in one sorted list, and the names starting with a
+    prefix are the contiguous range found by two bisects. Each entry carries a
+    score: titles whose own name matches come first, then the rest, each by save
+    count and then rating. A min segment tree over the scores yields the best
+    entry of any range in O(log n), so the top `limit` titles of even a
+    one-letter prefix cost O(limit log n) rather than a pass over its range.
+    """
+
+    def __init__(self, catalog, popularity=None):
+        popularity = popularity or {}
+        self.version = catalog.version
+        self.catalog = catalog
+        ordered = sorted(catalog.items, key=lambda key: (-popularity.get(key, 0),
+                                                         -(catalog.items[key].rating_score or 0), key))
+        rank = {key: position for position, key in enumerate(ordered)}
+
+        entries = set()
+        for name, keys in catalog.title_keys().items():
+            entries.update((name, key) for key in keys)
+        for key, item in catalog.items.items():
+            words = item.title_key.split()
+            entries.update((' '.join(words[i:]), key) for i in range(1, len(words)))
+        entries = sorted(entries)
+        self.names = [name for name, key in entries]
+        self.keys = [key for name, key in entries]
+
+        # score * count + position keeps values distinct, so a minimum also says where it is
+        count = len(entries)
+        self.count = count
+        self.tree = [float('inf')] * count + [
+            ((name != catalog.items[key].title_key) * len(rank) + rank[key]) * count + position
+            for position, (name, key) in enumerate(entries)
+        ]
+        for node in range(count - 1, 0, -1):
+            self.tree[node] = min(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def _min(self, start, end):
+        """Smallest tree value over entries [start, end)"""
+        tree = self.tree
+        best = float('inf')
+        start += self.count
+        end += self.count
+        while start < end:
+            if start & 1:
+                best = min(best, tree[start])
+                start += 1
+            if end & 1:
+                end -= 1
+                best = min(best, tree[end])
+            start >>= 1
+            end >>= 1
+        return best
+
+    def complete(self, query, limit=10, media_type=None):
+        """Up to `limit` catalog keys with a name starting with `query`, best first"""
+        prefix = title_key(query)
+        limit = max(0, min(limit, MAX_RESULTS))
+        if not prefix or not limit:
+            return []
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix + '\uffff', start)
+        if start == end:
+            return []
+
+        # Best-first over the range: take its minimum, then split around it
+        results = []
+        seen = set()
+        heap = [(self._min(start, end), start, end)]
+        while heap and len(results) < limit:
+            value, start, end = heapq.heappop(heap)
+            position = value % self.count
+            key = self.keys[position]
+            if key not in seen and (media_type is None or key[0] == media_type):
+                results.append(key)
+            seen.add(key)
+            if start < position:
+                heapq.heappush(heap, (self._min(start, position), start, position))
+            if position + 1 < end:
+                heapq.heappush(heap, (self._min(position + 1, end), position + 1, end))
+        return results
+
+    def results(self, keys):
+        return [dict(self.catalog.items[key].as_dict(RESULT_FIELDS), media_type=key[0]) for key in keys]
+
+
+class AutocompleteCache:
+    """The AutocompleteIndex of the current catalog, rebuilt off the request path.
+
+    Only the very first get() builds an index inline. After that, a new catalog
+    version starts a rebuild on a background thread and lookups keep using the
+    previous index until it is done. refresh() rebuilds with fresh save counts
+    and is meant for a periodic task.
+    """
+
+    def __init__(self, catalog_cache, popularity):
+        self.catalog_cache = catalog_cache
+        self.popularity = popularity
+        self.index = None
+        self.builds = 0
+        self.building = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        catalog = self.catalog_cache.get()
+        index = self.index
+        if index is None:
+            with self.lock:
+                if self.index is None:
+                    self.index = self._build(catalog)
+                return self.index
+        if index.version != catalog.version and not self.building:
+            with self.lock:
+                if not self.building:
+                    self.building = True
+                    threading.Thread(target=self.refresh, name='autocomplete-build', daemon=True).start()
+        return index
+
+    def refresh(self):
+        try:
+            index = self._build(self.catalog_cache.get())
+            with self.lock:
+                if self.index is None or self.index.version <= index.version:
+                    self.index = index
+        finally:
+            self.building = False
+
+    def _build(self, catalog):
+        self.builds += 1
+        return AutocompleteIndex(catalog, self.popularity())
@@ -0,0 +1,42 @@
+import os
+import threading
+
+
+class PeriodicTask:
+    """Run a function every few seconds on a daemon thread.
+
+    Gunicorn forks workers after the app module is imported and threads do not
+    survive a fork, so the thread is started lazily with ensure_running() and
+    restarted whenever it is called from a new process.
+    """
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure_running(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop = threading.Event()
+            thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
+        self._pid = None
+
+    def _run(self):
+        stop = self._stop
+        while not stop.wait(self.interval):
+            try:
+                self.func()
+            except Exception as e:
+                print(f"{self.name} error: {str(e)}")
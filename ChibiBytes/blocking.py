@@ -0,0 +1,60 @@
+import asyncio
+import concurrent.futures
+import functools
+import os
+import threading
+
+
+class BlockingExecutor:
+    """Bounded thread pool for the blocking work (SQLite, password hashing) of async views.
+
+    An async view awaits run(), which hands the call to one of at most
+    `max_workers` threads, so however many requests are in flight, no more than
+    that many SQLite calls run at once per worker process. Like PeriodicTask,
+    the pool is created lazily and again after a fork, since gunicorn forks
+    workers after the app is imported.
+    """
+
+    def __init__(self, max_workers=8, name='blocking'):
+        self.max_workers = max_workers
+        self.name = name
+        self.submitted = 0
+        self.running = 0
+        self.peak_running = 0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers,
+                                                                           thread_name_prefix=self.name)
+                    self._pid = os.getpid()
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """Result of func(*args, **kwargs), computed on the pool without blocking the event loop"""
+        with self._lock:
+            self.submitted += 1
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor(), functools.partial(self._call, func, args, kwargs))
+
+    def _call(self, func, args, kwargs):
+        with self._lock:
+            self.running += 1
+            self.peak_running = max(self.peak_running, self.running)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def metrics(self):
+        return {
+            "max_workers": self.max_workers,
+            "submitted": self.submitted,
+            "running": self.running,
+            "peak_running": self.peak_running,
+        }
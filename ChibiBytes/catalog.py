@@ -0,0 +1,720 @@
+import bisect
+import functools
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+# Catalog tables and the media_type name used for them everywhere else
+CATALOG_TABLES = {'anime': 'anime', 'movie': 'movies'}
+
+# Spellings in the seeded categories that mean the same genre
+GENRE_ALIASES = {
+    'slice of life': 'slice-of-life',
+    'science fiction': 'sci-fi',
+    'scifi': 'sci-fi',
+    'shounen': 'shonen',
+    'shoujo': 'shojo',
+    'dram': 'drama',
+}
+
+# Category entries that are curation labels rather than genres
+CATALOG_TAGS = {'popular', 'top', 'new', 'featured', 'award', 'ghibli', 'movie', 'animation'}
+
+DASHES = re.compile(r'[\u2010-\u2015\u2212]')
+
+# Shorthand fans type for titles: alias -> (media_type, title)
+TITLE_ALIASES = {
+    'aot': ('anime', 'Attack on Titan'),
+    'snk': ('anime', 'Attack on Titan'),
+    'shingeki no kyojin': ('anime', 'Attack on Titan'),
+    'fma': ('anime', 'Fullmetal Alchemist: Brotherhood'),
+    'fmab': ('anime', 'Fullmetal Alchemist: Brotherhood'),
+    'jjk': ('anime', 'Jujutsu Kaisen'),
+    'mha': ('anime', 'My Hero Academia'),
+    'bnha': ('anime', 'My Hero Academia'),
+    'boku no hero academia': ('anime', 'My Hero Academia'),
+    'hxh': ('anime', 'Hunter × Hunter (2011)'),
+    'kny': ('anime', 'Demon Slayer: Kimetsu no Yaiba'),
+    'opm': ('anime', 'One Punch Man'),
+    'csm': ('anime', 'Chainsaw Man'),
+    'dbz': ('anime', 'Dragon Ball Z'),
+    'yyh': ('anime', 'Yu Yu Hakusho'),
+    'sxf': ('anime', 'Spy × Family'),
+    'mp100': ('anime', 'Mob Psycho 100'),
+    'rezero': ('anime', 'Re:Zero - Starting Life in Another World'),
+    'kimi no na wa': ('movie', 'Your Name'),
+    'sen to chihiro no kamikakushi': ('movie', 'Spirited Away'),
+    'koe no katachi': ('movie', 'A Silent Voice'),
+}
+
+# Characters that stand for a letter in titles ("Hunter × Hunter")
+TITLE_LETTERS = str.maketrans({'×': 'x'})
+PARENTHETICAL = re.compile(r'\s*\(([^)]*)\)\s*')
+
+
+def canonical_genre(raw):
+    """Fold a category entry ("Slice‑of‑life", "sci-fi", "Sci-Fi") to one lowercase key"""
+    key = unicodedata.normalize('NFKC', raw)
+    key = DASHES.sub('-', key)
+    key = ' '.join(key.split()).casefold()
+    return GENRE_ALIASES.get(key, key)
+
+
+def title_key(text):
+    """Fold a title or query to its lookup key: NFKC, casefold, no diacritics or punctuation.
+
+    "Spider‑Man: Into the Spider‑Verse" and "spider-man into the spider verse" share
+    a key, as do "Kuroko’s Basketball" and "kurokos basketball".
+    """
+    key = unicodedata.normalize('NFKC', text or '').casefold().translate(TITLE_LETTERS)
+    key = unicodedata.normalize('NFKD', key)
+    chars = []
+    for ch in key:
+        category = unicodedata.category(ch)
+        if category == 'Mn' or ch in "'’":
+            continue
+        chars.append(' ' if category[0] in 'PSZC' else ch)
+    return ' '.join(''.join(chars).split())
+
+
+def title_key_variants(title):
+    """Extra keys a title answers to: its name without and within parentheses, and before a colon"""
+    variants = []
+    bare = PARENTHETICAL.sub(' ', title or '')
+    variants.append(bare)
+    variants.extend(PARENTHETICAL.findall(title or ''))
+    if ':' in bare:
+        variants.append(bare.split(':', 1)[0])
+    # Too-short leftovers ("Re" of "Re:Zero", a bare year) would shadow real queries
+    return [key for key in map(title_key, variants) if len(key) >= 4 and not key.isdigit()]
+
+
+def genre_display_name(key):
+    words = re.split(r'([ -])', key)
+    return ''.join(word if word in (' ', '-', 'of') else word[:1].upper() + word[1:] for word in words)
+
+
+@functools.lru_cache(maxsize=4096)
+def split_categories(category):
+    """Distinct canonical keys of a comma separated category string, in order"""
+    keys = []
+    for raw in (category or '').split(','):
+        key = canonical_genre(raw)
+        if key and key not in keys:
+            keys.append(key)
+    return tuple(keys)
+
+
+class CatalogTitle:
+    """One catalog row, stored in slots instead of a per-title dict.
+
+    Columns that repeat across titles (category, director, year, rating, duration)
+    are interned so every title with the same value shares one string object.
+    It answers get()/[] like the sqlite3.Row dicts it replaces.
+    """
+
+    __slots__ = ('media_type', 'id', 'title', 'year', 'rating', 'image', 'modalImage', 'category',
+                 'description', 'insights', 'director', 'duration', 'rating_score', 'year_int', 'title_key',
+                 'genres')
+
+    # Columns of each table, in table order, as they appear in API responses
+    COLUMNS = {
+        'anime': ('id', 'title', 'year', 'rating', 'image', 'modalImage', 'category', 'description',
+                  'insights', 'rating_score', 'year_int'),
+        'movie': ('id', 'title', 'year', 'rating', 'image', 'modalImage', 'category', 'description',
+                  'insights', 'director', 'duration', 'rating_score', 'year_int'),
+    }
+    INTERNED = ('year', 'rating', 'category', 'director', 'duration')
+
+    def __init__(self, media_type, row):
+        self.media_type = media_type
+        keys = row.keys()
+        for column in self.__slots__[1:-1]:
+            value = row[column] if column in keys else None
+            if column in self.INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, column, value)
+        if self.title_key is None:
+            self.title_key = title_key(self.title)
+        self.genres = split_categories(self.category)
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, value):
+        # Like sqlite3.Row, which is a sequence: `in` looks at the values, not the column names
+        return any(getattr(self, column) == value for column in self.COLUMNS[self.media_type])
+
+    def as_dict(self, columns=None):
+        return {column: getattr(self, column) for column in columns or self.COLUMNS[self.media_type]}
+
+
+def read_catalog_version(conn):
+    row = conn.execute("SELECT value FROM app_meta WHERE key = 'catalog_version'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def read_base_version(conn):
+    """Oldest catalog_version that catalog_changes leads on from, or None if changes aren't recorded"""
+    row = conn.execute("SELECT value FROM app_meta WHERE key = 'catalog_base_version'").fetchone()
+    return int(row[0]) if row else None
+
+
+def read_aliases(conn):
+    return {
+        alias_key: (media_type, media_id)
+        for alias_key, media_type, media_id in conn.execute(
+            'SELECT alias_key, media_type, media_id FROM title_aliases')
+    }
+
+
+# Patches a Catalog remembers, so caches a few versions behind can catch up selectively
+CATALOG_HISTORY = 16
+
+
+class Catalog:
+    """Per-worker, read-only copy of the anime and movie tables.
+
+    The catalog only changes when a new catalog file is published (with a new
+    catalog_version), so every worker keeps one copy in memory and hydrates
+    watchlist rows, API listings, chatbot answers and facets from it instead of
+    going back to SQLite. Titles are CatalogTitle records keyed by (media_type, id).
+
+    An incremental publish lists the titles it touched in catalog_changes, and
+    load() then derives the new Catalog from the previous one: only those titles
+    are re-read, re-encoded and moved in the title lookup, facets and bitmaps.
+    `history` keeps the (old, new) CatalogTitle pairs of recent patches for
+    caches layered on top (see changed_since).
+    """
+
+    def __init__(self, items, version=0, aliases=None):
+        self.items = items
+        self.version = version
+        self.aliases = aliases or {}
+        self.history = []
+        self._facets = None
+        self._bitmaps = None
+        self._titles = None
+        self._search = None
+        self._encoded = {}
+        self._templates = {}
+
+    @classmethod
+    def load(cls, conn, previous=None):
+        """Read the catalog, patching `previous` when the changes since its version are recorded"""
+        version = read_catalog_version(conn)
+        base = read_base_version(conn)
+        if previous is not None and base is not None and base <= previous.version < version:
+            changed = {
+                (media_type, media_id)
+                for media_type, media_id in conn.execute(
+                    'SELECT media_type, media_id FROM catalog_changes WHERE version > ?', (previous.version,))
+            }
+            return previous.patched(conn, version, changed)
+        items = {}
+        for media_type, table in CATALOG_TABLES.items():
+            for row in conn.execute(f'SELECT * FROM {table}'):
+                items[(media_type, row['id'])] = CatalogTitle(media_type, row)
+        return cls(items, version, read_aliases(conn))
+
+    def patched(self, conn, version, changed):
+        """A Catalog for `version` that differs from this one only in the `changed` titles"""
+        updated = {}
+        for media_type, table in CATALOG_TABLES.items():
+            ids = sorted(media_id for mt, media_id in changed if mt == media_type)
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                for row in conn.execute(f'SELECT * FROM {table} WHERE id IN ({", ".join("?" * len(chunk))})', chunk):
+                    updated[(media_type, row['id'])] = CatalogTitle(media_type, row)
+
+        items = dict(self.items)
+        pairs = []
+        for key in sorted(changed):
+            pairs.append((self.items.get(key), updated.get(key)))
+            if key in updated:
+                items[key] = updated[key]
+            else:
+                items.pop(key, None)
+        catalog = Catalog(items, version, read_aliases(conn))
+        catalog.history = (self.history + [(self.version, pairs)])[-CATALOG_HISTORY:]
+        catalog._encoded = {key: data for key, data in self._encoded.items() if key not in changed}
+        catalog._templates = {key: data for key, data in self._templates.items() if key[:2] not in changed}
+        if self._titles is not None:
+            catalog._titles = self._patched_titles(catalog, changed)
+        if self._facets is not None:
+            catalog._facets = self._facets.patched(pairs)
+        if self._bitmaps is not None:
+            catalog._bitmaps = self._bitmaps.patched(pairs)
+        return catalog
+
+    def changed_since(self, version):
+        """(old, new) title pairs changed after `version`, or None if that version isn't in the history"""
+        if version == self.version:
+            return []
+        for i, (from_version, _) in enumerate(self.history):
+            if from_version == version:
+                return [pair for _, pairs in self.history[i:] for pair in pairs]
+        return None
+
+    def get(self, media_type, media_id):
+        return self.items.get((media_type, media_id))
+
+    def encoded(self, media_type, media_id, encode):
+        """JSON bytes of a title's as_dict(), encoded once per catalog version"""
+        key = (media_type, media_id)
+        data = self._encoded.get(key)
+        if data is None:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            data = self._encoded[key] = encode(item.as_dict())
+        return data
+
+    def template(self, media_type, media_id, fields, make_template):
+        """A title's as_dict() encoded around slots for `fields`, once per catalog version"""
+        key = (media_type, media_id, fields)
+        template = self._templates.get(key)
+        if template is None:
+            item = self.items.get(key[:2])
+            if item is None:
+                return None
+            template = self._templates[key] = make_template(item.as_dict(), fields)
+        return template
+
+    def title_keys(self):
+        """title_key -> catalog keys, exact titles first, then aliases and derived names"""
+        if self._titles is None:
+            titles = {}
+            for key, item in self.items.items():
+                titles.setdefault(item.title_key, []).append(key)
+            for alias_key, key in self.aliases.items():
+                if key in self.items and key not in titles.get(alias_key, ()):
+                    titles.setdefault(alias_key, []).append(key)
+            for key, item in self.items.items():
+                for variant in title_key_variants(item.title):
+                    if key not in titles.get(variant, ()):
+                        titles.setdefault(variant, []).append(key)
+            self._titles = titles
+        return self._titles
+
+    def _patched_titles(self, catalog, changed):
+        """This catalog's title_keys() moved over to `catalog`, touching only the affected keys"""
+        titles = dict(self._titles)
+        affected = set()
+        for key in changed:
+            for item in (self.items.get(key), catalog.items.get(key)):
+                if item is not None:
+                    affected.update((name, key) for name in [item.title_key] + title_key_variants(item.title))
+        for alias_key in set(self.aliases) | set(catalog.aliases):
+            if self.aliases.get(alias_key) != catalog.aliases.get(alias_key) or catalog.aliases.get(alias_key) in changed:
+                affected.update((alias_key, key) for key in (self.aliases.get(alias_key), catalog.aliases.get(alias_key))
+                                if key is not None)
+
+        for name, key in affected:
+            keys = titles.get(name, [])
+            item = catalog.items.get(key)
+            wanted = item is not None and (
+                item.title_key == name or catalog.aliases.get(name) == key or name in title_key_variants(item.title))
+            if wanted and key not in keys:
+                keys = list(keys)
+                if item.title_key == name:
+                    # Exact titles stay ahead of aliases and derived names
+                    position = 0
+                    while position < len(keys) and catalog.items[keys[position]].title_key == name:
+                        position += 1
+                    keys.insert(position, key)
+                else:
+                    keys.append(key)
+                titles[name] = keys
+            elif not wanted and key in keys:
+                keys = [other for other in keys if other != key]
+                if keys:
+                    titles[name] = keys
+                else:
+                    del titles[name]
+        return titles
+
+    def find_title(self, title, media_type=None):
+        """Catalog key for an exact title, alias or alternate name, or None"""
+        for key in self.title_keys().get(title_key(title), ()):
+            if media_type is None or key[0] == media_type:
+                return key
+        return None
+
+    def lookup_title(self, text):
+        """The title `text` names exactly (one hash probe), or None"""
+        key = self.find_title(text)
+        return self.items[key] if key else None
+
+    def search_title(self, fragment, media_types=tuple(CATALOG_TABLES)):
+        """First title containing `fragment` (case-insensitive), anime before movies"""
+        if self._search is None:
+            search = {media_type: [] for media_type in CATALOG_TABLES}
+            for item in self.items.values():
+                search[item.media_type].append((item.title.casefold(), item))
+            self._search = max((len(title) for titles in search.values() for title, _ in titles), default=0), search
+        longest, search = self._search
+        fragment = fragment.casefold()
+        # Most chat messages are sentences longer than any title, which can't match
+        if len(fragment) > longest:
+            return None
+        for media_type in media_types:
+            for title, item in search[media_type]:
+                if fragment in title:
+                    return item
+        return None
+
+    def titles(self, media_type=None, genre=None):
+        """Titles of one media type and/or with a category containing `genre`"""
+        genre = genre.casefold() if genre else None
+        return [
+            item for item in self.items.values()
+            if (media_type is None or item.media_type == media_type) and
+               (genre is None or genre in (item.category or '').casefold())
+        ]
+
+    def resolve_media_type(self, media_id):
+        """Anime and movie ids don't overlap, so the id alone tells us which table it's in"""
+        for media_type in CATALOG_TABLES:
+            if (media_type, media_id) in self.items:
+                return media_type
+        return None
+
+    def __len__(self):
+        return len(self.items)
+
+    def footprint(self):
+        """Approximate bytes held by the titles: records, the key dict and each distinct value once"""
+        seen = set()
+        total = sys.getsizeof(self.items)
+        for key, item in self.items.items():
+            total += sys.getsizeof(key) + sys.getsizeof(item)
+            for column in CatalogTitle.__slots__:
+                value = getattr(item, column)
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+        return {
+            "titles": len(self.items),
+            "bytes": total,
+            "bytes_per_title": round(total / len(self.items)) if self.items else 0,
+        }
+
+    def facets(self):
+        """Genre/tag histograms for this catalog version, built in one pass on first use"""
+        if self._facets is None:
+            self._facets = GenreFacets(self.items.items())
+        return self._facets
+
+    def bitmaps(self):
+        """Facet bitmaps for this catalog version, built on first use"""
+        if self._bitmaps is None:
+            self._bitmaps = BitmapIndex(self.items.items())
+        return self._bitmaps
+
+
+class GenreFacets:
+    """Per-genre title counts, bucketed by media type, year and rating.
+
+    Each (genre, media_type) keeps a histogram keyed by (year_int, rating in hundredths),
+    so range-restricted counts are a sum over a handful of buckets rather than a
+    pass over the catalog.
+    """
+
+    def __init__(self, items):
+        self.histograms = {}
+        self.names = {}
+        for (media_type, media_id), item in items:
+            cell = (item.get('year_int'), _rating_bucket(item.get('rating_score')))
+            for key in item.genres:
+                histogram = self.histograms.setdefault(key, {}).setdefault(media_type, {})
+                histogram[cell] = histogram.get(cell, 0) + 1
+                self.names.setdefault(key, genre_display_name(key))
+
+    def patched(self, pairs):
+        """Copy of these facets with each (old, new) title pair's counts moved; either side may be None"""
+        facets = GenreFacets(())
+        facets.histograms = {key: {media_type: dict(histogram) for media_type, histogram in per_type.items()}
+                             for key, per_type in self.histograms.items()}
+        facets.names = dict(self.names)
+        for old, new in pairs:
+            for item, delta in ((old, -1), (new, 1)):
+                if item is None:
+                    continue
+                cell = (item.get('year_int'), _rating_bucket(item.get('rating_score')))
+                for key in item.genres:
+                    histogram = facets.histograms.setdefault(key, {}).setdefault(item.media_type, {})
+                    histogram[cell] = histogram.get(cell, 0) + delta
+                    if not histogram[cell]:
+                        del histogram[cell]
+                        if not histogram:
+                            del facets.histograms[key][item.media_type]
+                            if not facets.histograms[key]:
+                                del facets.histograms[key]
+                    facets.names.setdefault(key, genre_display_name(key))
+        return facets
+
+    def counts(self, year_from=None, year_to=None, min_rating=None, max_rating=None):
+        """{'genres': [...], 'tags': [...]} with per-media-type counts, largest first"""
+        unfiltered = year_from is None and year_to is None and min_rating is None and max_rating is None
+        low = _rating_bucket(min_rating)
+        high = _rating_bucket(max_rating)
+        genres, tags = [], []
+        for key, per_type in self.histograms.items():
+            counts = {media_type: 0 for media_type in CATALOG_TABLES}
+            for media_type, histogram in per_type.items():
+                for (year, rating), n in histogram.items():
+                    if unfiltered or (
+                            (year_from is None or (year is not None and year >= year_from)) and
+                            (year_to is None or (year is not None and year <= year_to)) and
+                            (low is None or (rating is not None and rating >= low)) and
+                            (high is None or (rating is not None and rating <= high))):
+                        counts[media_type] += n
+            counts['total'] = sum(counts.values())
+            entry = {"key": key, "name": self.names[key], "counts": counts}
+            (tags if key in CATALOG_TAGS else genres).append(entry)
+        genres.sort(key=lambda entry: (-entry['counts']['total'], entry['key']))
+        tags.sort(key=lambda entry: (-entry['counts']['total'], entry['key']))
+        return {"genres": genres, "tags": tags}
+
+
+def _rating_bucket(rating):
+    return None if rating is None else int(round(rating * 100))
+
+
+def _rating_order(rating):
+    """Sort key putting titles best rated first and unrated ones last"""
+    return (1, 0) if rating is None else (0, -rating)
+
+
+class BitmapIndex:
+    """One bitset per genre, media type and year over catalog ordinals.
+
+    Bitsets are Python ints, so AND/OR/NOT run word-at-a-time in C and cost depends
+    on catalog size in bits, not on rows scanned. Ordinals are assigned best rated
+    first (unrated titles last), so the lowest set bits of a result are also its
+    top-rated titles, and any rating range is a contiguous run of ordinals found
+    by bisecting the sorted ratings. Year filters use cumulative "at least"
+    bitsets, making any range two lookups and an AND NOT.
+
+    The bitsets are not compressed. Ordinals are dense (0..n-1 over the titles
+    that exist), so a bitset costs n/8 bytes: about 13 for today's hundred titles,
+    and 12 KB each at 100,000. Run-length or roaring containers pay off for sparse
+    ids over a much larger space, and would add a dependency and per-operation
+    overhead that an int AND of a few machine words doesn't have.
+    """
+
+    def __init__(self, items):
+        ordered = sorted(items, key=lambda entry: (_rating_order(entry[1].get('rating_score')), entry[0]))
+        self.keys = [key for key, item in ordered]
+        self.all = (1 << len(self.keys)) - 1
+        # Negated rating buckets of the rated titles, which hold ordinals 0..n-1, ascending
+        self.ratings = [-_rating_bucket(item.get('rating_score')) for key, item in ordered
+                        if item.get('rating_score') is not None]
+        # Collect ordinals first; OR-ing bits into growing ints one at a time is quadratic
+        genres = {}
+        media_types = {}
+        years = {}
+        for ordinal, ((media_type, media_id), item) in enumerate(ordered):
+            media_types.setdefault(media_type, []).append(ordinal)
+            for key in item.genres:
+                genres.setdefault(key, []).append(ordinal)
+            if item.get('year_int') is not None:
+                years.setdefault(item['year_int'], []).append(ordinal)
+        size = len(self.keys)
+        self.genres = {key: _bitset(ordinals, size) for key, ordinals in genres.items()}
+        self.media_types = {key: _bitset(ordinals, size) for key, ordinals in media_types.items()}
+        self.years_at_least = _cumulative({key: _bitset(ordinals, size) for key, ordinals in years.items()})
+
+    def patched(self, pairs):
+        """Copy with edited titles' bits moved, or None when ordinals would change.
+
+        Adding or removing a title, or changing its rating, changes the best-rated
+        ordering, so those patches leave the index to be rebuilt on next use.
+        """
+        ordinals = {key: ordinal for ordinal, key in enumerate(self.keys)}
+        for old, new in pairs:
+            if old is None or new is None or old.get('rating_score') != new.get('rating_score'):
+                return None
+        index = BitmapIndex(())
+        index.keys = self.keys
+        index.all = self.all
+        index.media_types = self.media_types
+        index.ratings = self.ratings
+        index.genres = dict(self.genres)
+        index.years_at_least = self.years_at_least
+        for old, new in pairs:
+            bit = 1 << ordinals[(new.media_type, new.id)]
+            for key in set(old.genres) - set(new.genres):
+                index.genres[key] &= ~bit
+                if not index.genres[key]:
+                    del index.genres[key]
+            for key in set(new.genres) - set(old.genres):
+                index.genres[key] = index.genres.get(key, 0) | bit
+            if old.get('year_int') != new.get('year_int'):
+                index.years_at_least = _move_bit(index.years_at_least, bit, old.get('year_int'), new.get('year_int'))
+        return index
+
+    def genre(self, key):
+        return self.genres.get(canonical_genre(key), 0)
+
+    def filter(self, all_of=(), any_of=(), none_of=(), media_type=None,
+               year_from=None, year_to=None, min_rating=None, max_rating=None):
+        """Bitset of titles matching every condition"""
+        result = self.all
+        for key in all_of:
+            result &= self.genre(key)
+        if any_of:
+            either = 0
+            for key in any_of:
+                either |= self.genre(key)
+            result &= either
+        for key in none_of:
+            result &= ~self.genre(key)
+        if media_type:
+            result &= self.media_types.get(media_type, 0)
+        if year_from is not None or year_to is not None:
+            result &= _range(self.years_at_least, year_from, None if year_to is None else year_to + 1)
+        if min_rating is not None or max_rating is not None:
+            result &= self.rating_range(min_rating, max_rating)
+        return result & self.all
+
+    def rating_range(self, min_rating=None, max_rating=None):
+        """Bitset of rated titles with min_rating <= rating <= max_rating (to the bucket); either may be None"""
+        ratings = self.ratings
+        start = 0 if max_rating is None else bisect.bisect_left(ratings, -_rating_bucket(max_rating))
+        end = len(ratings) if min_rating is None else bisect.bisect_right(ratings, -_rating_bucket(min_rating))
+        return ((1 << max(end - start, 0)) - 1) << start
+
+    def page(self, bits, offset=0, limit=20):
+        """Catalog keys for the set bits in [offset, offset + limit), in ordinal order"""
+        if offset:
+            # Drop the first `offset` set bits: bisect for the shortest low prefix holding that many
+            low, high = 0, bits.bit_length()
+            while low < high:
+                middle = (low + high) // 2
+                if (bits & ((1 << middle) - 1)).bit_count() < offset:
+                    low = middle + 1
+                else:
+                    high = middle
+            bits = bits >> low << low
+        keys = []
+        while bits and len(keys) < limit:
+            lowest = bits & -bits
+            keys.append(self.keys[lowest.bit_length() - 1])
+            bits ^= lowest
+        return keys
+
+
+def _bitset(ordinals, size):
+    data = bytearray(size // 8 + 1)
+    for ordinal in ordinals:
+        data[ordinal >> 3] |= 1 << (ordinal & 7)
+    return int.from_bytes(data, 'little')
+
+
+def _cumulative(buckets):
+    """Sorted bucket values and, for each, the bitset of titles in that bucket or above"""
+    values = sorted(buckets)
+    at_least = []
+    running = 0
+    for value in reversed(values):
+        running |= buckets[value]
+        at_least.append(running)
+    at_least.reverse()
+    return values, at_least
+
+
+def _move_bit(cumulative, bit, old, new):
+    """Cumulative bitsets with one title moved from bucket `old` to bucket `new` (either may be None)"""
+    values, at_least = list(cumulative[0]), list(cumulative[1])
+    if new is not None and new not in values:
+        position = bisect.bisect_left(values, new)
+        values.insert(position, new)
+        at_least.insert(position, at_least[position] if position < len(at_least) else 0)
+    for i, value in enumerate(values):
+        if old is not None and value <= old:
+            at_least[i] &= ~bit
+        if new is not None and value <= new:
+            at_least[i] |= bit
+    return values, at_least
+
+
+def _at_least(cumulative, value):
+    values, at_least = cumulative
+    i = bisect.bisect_left(values, value)
+    return at_least[i] if i < len(values) else 0
+
+
+def _range(cumulative, low, high):
+    """Titles with low <= bucket < high; either bound may be None"""
+    bits = _at_least(cumulative, low) if low is not None else (cumulative[1][0] if cumulative[0] else 0)
+    if high is not None:
+        bits &= ~_at_least(cumulative, high)
+    return bits
+
+
+class CatalogCache:
+    """Lazily loaded Catalog shared by all threads of a worker.
+
+    At most once per `check_interval` seconds the cache calls `stamp()` (for
+    example the catalog file's inode and mtime) and only when that changed opens
+    the catalog to compare catalog_version. A bump makes get() load the new
+    Catalog, patched from the current one when the publish was incremental.
+    """
+
+    def __init__(self, connect, check_interval=5.0, stamp=None):
+        self.connect = connect
+        self.check_interval = check_interval
+        self.stamp = stamp or (lambda: None)
+        self.catalog = None
+        self.checked_at = 0.0
+        self.loaded_stamp = None
+        self.loads = 0
+        self.patches = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        catalog = self.catalog
+        if catalog is None or time.monotonic() - self.checked_at > self.check_interval:
+            with self.lock:
+                if self.catalog is None or time.monotonic() - self.checked_at > self.check_interval:
+                    stamp = self.stamp()
+                    if self.catalog is None or stamp is None or stamp != self.loaded_stamp:
+                        self._reload(stamp)
+                    self.checked_at = time.monotonic()
+                catalog = self.catalog
+        return catalog
+
+    def _reload(self, stamp):
+        conn = self.connect()
+        try:
+            if self.catalog is None or self.catalog.version != read_catalog_version(conn):
+                catalog = Catalog.load(conn, previous=self.catalog)
+                if catalog.history and self.catalog is not None and catalog.history[-1][0] == self.catalog.version:
+                    self.patches += 1
+                else:
+                    self.loads += 1
+                self.catalog = catalog
+        finally:
+            conn.close()
+        self.loaded_stamp = stamp
+
+    def refresh(self):
+        """Check for a new catalog on the next get(), whatever the interval"""
+        self.checked_at = 0.0
+
+    def metrics(self):
+        catalog = self.catalog
+        return {"version": catalog.version if catalog else None, "loads": self.loads, "patches": self.patches}
+
+    def invalidate(self):
+        self.catalog = None
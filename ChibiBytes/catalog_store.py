@@ -0,0 +1,131 @@
+import contextlib
+import os
+import sqlite3
+import tempfile
+import urllib.request
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; publishers there must not run concurrently
+    fcntl = None
+
+from catalog import read_base_version, read_catalog_version
+
+# Versions of per-title changes kept in catalog_changes; workers further behind reload in full
+CHANGE_HISTORY = 256
+
+
+def catalog_uri(path):
+    """URI that opens the catalog read-only and tells SQLite the file never changes.
+
+    immutable=1 skips locking and change detection entirely, which is only safe
+    because published files are never written in place: publish_catalog() swaps
+    in a new file, and connections opened before the swap keep reading the old one.
+    """
+    return f'file:{urllib.request.pathname2url(os.path.abspath(path))}?mode=ro&immutable=1'
+
+
+def connect_catalog(path):
+    conn = sqlite3.connect(catalog_uri(path), uri=True)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def attach_catalog(conn, path, schema='catalog'):
+    """Make the catalog tables available as `schema`.anime etc. on a user-database connection"""
+    conn.execute('ATTACH DATABASE ? AS ' + schema, (catalog_uri(path),))
+
+
+def published_version(path):
+    if not os.path.exists(path):
+        return 0
+    conn = connect_catalog(path)
+    try:
+        return read_catalog_version(conn)
+    finally:
+        conn.close()
+
+
+@contextlib.contextmanager
+def publish_lock(path):
+    """Serialize publishers of one catalog, so two never build the same next version"""
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def record_changes(conn, version, changed):
+    """Log the titles `version` touched, or start a fresh history for a full build (changed=None)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_changes (
+            version INTEGER NOT NULL,
+            media_type TEXT NOT NULL,
+            media_id INTEGER NOT NULL,
+            PRIMARY KEY (version, media_type, media_id)
+        )
+    ''')
+    if changed is None:
+        conn.execute('DELETE FROM catalog_changes')
+        base = version
+    else:
+        conn.executemany('INSERT OR IGNORE INTO catalog_changes (version, media_type, media_id) VALUES (?, ?, ?)',
+                         [(version, media_type, media_id) for media_type, media_id in changed])
+        base = max(read_base_version(conn) or 0, version - CHANGE_HISTORY)
+        conn.execute('DELETE FROM catalog_changes WHERE version <= ?', (base,))
+    conn.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('catalog_base_version', ?)", (base,))
+
+
+def publish_catalog(path, build, incremental=False):
+    """Build a new catalog file with build(conn) and atomically swap it into `path`.
+
+    The new file gets the next catalog_version, so every worker's CatalogCache
+    notices it on its next version check. Returns that version.
+
+    With `incremental`, the new file starts as a copy of the live one and
+    build() returns the (media_type, media_id) keys it touched. They are logged
+    in catalog_changes so workers patch just those titles into their in-memory
+    catalog. A full build starts the log over, and workers reload from scratch.
+    """
+    path = os.path.abspath(path)
+    with publish_lock(path):
+        return _publish(path, build, incremental)
+
+
+def _publish(path, build, incremental):
+    version = published_version(path) + 1
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.catalog-', suffix='.db')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.row_factory = sqlite3.Row
+            if incremental:
+                live = connect_catalog(path)
+                try:
+                    live.backup(conn)
+                finally:
+                    live.close()
+            changed = build(conn)
+            record_changes(conn, version, changed if incremental else None)
+            conn.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('catalog_version', ?)", (version,))
+            conn.commit()
+            # A self-contained, compact file: no journal beside it, no free pages
+            conn.execute('PRAGMA journal_mode = DELETE')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return version
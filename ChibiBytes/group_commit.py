@@ -0,0 +1,167 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+class WriterOverloaded(Exception):
+    """The write queue is full; the caller should back off"""
+
+
+class _PendingWrite:
+    __slots__ = ('func', 'args', 'done', 'result', 'error', 'state')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # queued -> batched when the writer takes it, or queued -> cancelled when submit() gives up
+        self.state = 'queued'
+
+
+class GroupCommitWriter:
+    """Coalesce small write transactions from many requests into one commit.
+
+    Callers hand a function taking a cursor to submit(), which blocks until the
+    batch holding that write has committed and then returns the function's result
+    (or raises its exception). Because submit() only returns after COMMIT, a user
+    who reads right after their own write always sees it.
+
+    A single daemon thread per worker process drains the bounded queue, waiting at
+    most `max_delay` seconds or `max_batch` writes before committing. Each write
+    runs inside its own SAVEPOINT so one failure doesn't take the batch down with it.
+
+    A write still queued after `timeout` seconds is withdrawn and submit() raises
+    WriterOverloaded, so it never commits behind the caller's back. One already
+    taken into a batch is waited for, since it may be committing right now.
+    """
+
+    def __init__(self, database, max_batch=64, max_delay=0.005, queue_size=1024, timeout=5.0):
+        self.database = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batches = 0
+        self.writes = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        self.ensure_running()
+        pending = _PendingWrite(func, args)
+        try:
+            self.queue.put(pending, timeout=self.max_delay)
+        except queue.Full:
+            raise WriterOverloaded("Too many pending writes")
+        if not pending.done.wait(self.timeout):
+            with self._lock:
+                if pending.state == 'queued':
+                    pending.state = 'cancelled'
+                    raise WriterOverloaded("Timed out waiting for the write queue")
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def ensure_running(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A queue inherited through fork may hold writes owned by the parent
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            threading.Thread(target=self._run, name='watchlist-writer', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _claim(self, pending):
+        """Take a queued write into the batch being collected, False if its caller gave up on it"""
+        with self._lock:
+            if pending.state == 'cancelled':
+                return False
+            pending.state = 'batched'
+            return True
+
+    def _collect(self):
+        batch = []
+        while not batch:
+            pending = self.queue.get()
+            if self._claim(pending):
+                batch.append(pending)
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if self._claim(pending):
+                batch.append(pending)
+        return batch
+
+    def connect(self):
+        conn = sqlite3.connect(self.database, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = self._collect()
+            try:
+                if conn is None:
+                    conn = self.connect()
+                self._commit_batch(conn, batch)
+            except Exception as e:
+                # SAVEPOINT or ROLLBACK TO can fail too, e.g. once SQLite has rolled the whole
+                # transaction back after an I/O or disk-full error: nothing in the batch
+                # committed, and the connection is reopened for the next one
+                for pending in batch:
+                    pending.result = None
+                    pending.error = e
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+                    conn = None
+            finally:
+                for pending in batch:
+                    pending.done.set()
+
+    def _commit_batch(self, conn, batch):
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as e:
+            for pending in batch:
+                pending.error = e
+            return
+
+        for pending in batch:
+            cursor.execute('SAVEPOINT pending_write')
+            try:
+                pending.result = pending.func(cursor, *pending.args)
+                cursor.execute('RELEASE pending_write')
+            except Exception as e:
+                cursor.execute('ROLLBACK TO pending_write')
+                cursor.execute('RELEASE pending_write')
+                pending.error = e
+
+        try:
+            cursor.execute('COMMIT')
+            self.batches += 1
+            self.writes += len(batch)
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            for pending in batch:
+                if pending.error is None:
+                    pending.result = None
+                    pending.error = e
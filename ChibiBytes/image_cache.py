@@ -0,0 +1,160 @@
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import urllib.request
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it thumbnails come from the upstream CDN
+    Image = None
+
+# variant -> (catalog field holding the source URL, target width or None for original size)
+VARIANTS = {
+    'thumb': ('image', 236),
+    'card': ('image', 474),
+    'poster': ('image', None),
+    'modal': ('modalImage', None),
+}
+
+# Pinterest serves the same pin at fixed widths: /236x/, /474x/, /736x/, /1200x/, /originals/
+PINIMG_SIZE = re.compile(r'^(https?://i\.pinimg\.com/)(\d+x|originals)/')
+PINIMG_WIDTHS = (236, 474, 564, 736)
+
+CONTENT_TYPES = {
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'\x89PNG': 'image/png',
+    b'GIF8': 'image/gif',
+    b'RIFF': 'image/webp',
+}
+
+
+def upstream_url(url, width):
+    """Ask pinimg for its nearest pre-sized rendition instead of the 1200x original"""
+    if width is None or not PINIMG_SIZE.match(url):
+        return url
+    size = next((w for w in PINIMG_WIDTHS if w >= width), PINIMG_WIDTHS[-1])
+    return PINIMG_SIZE.sub(rf'\g<1>{size}x/', url, count=1)
+
+
+def sniff_content_type(data):
+    for magic, content_type in CONTENT_TYPES.items():
+        if data.startswith(magic):
+            return content_type
+    return 'application/octet-stream'
+
+
+def resize(data, width):
+    """Shrink an image to `width` pixels wide, or return it untouched without Pillow"""
+    if Image is None or width is None:
+        return data
+    with Image.open(io.BytesIO(data)) as img:
+        if img.width <= width:
+            return data
+        img.thumbnail((width, img.height * width // img.width + 1))
+        out = io.BytesIO()
+        img.convert('RGB').save(out, 'JPEG', quality=85, optimize=True)
+        return out.getvalue()
+
+
+class ImageCache:
+    """Size-bounded on-disk LRU cache for proxied catalog images.
+
+    Entries are plain files named after a hash of the cache key; a hit bumps the
+    file's mtime, and once the directory grows past `max_bytes` the least recently
+    used files are deleted. Files are written to a temp name and renamed into place,
+    so workers sharing the directory never see half-written images.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, timeout=10.0, opener=urllib.request.urlopen):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.opener = opener
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+    def path_for(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key, url, width):
+        """Path of the cached variant, fetching and resizing it on a miss"""
+        path = self.path_for(key)
+        if os.path.exists(path):
+            self.hits += 1
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return path
+
+        # One upstream fetch per key at a time within this worker
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        try:
+            with fetch_lock:
+                if not os.path.exists(path):
+                    self.misses += 1
+                    data = resize(self.fetch(upstream_url(url, width)), width)
+                    self.store(path, data)
+        finally:
+            with self._lock:
+                self._fetch_locks.pop(key, None)
+        return path
+
+    def open(self, key, url, width):
+        """The cached variant opened for reading, fetched again if it was evicted before it could be opened"""
+        try:
+            return open(self.get(key, url, width), 'rb')
+        except FileNotFoundError:
+            return open(self.get(key, url, width), 'rb')
+
+    def fetch(self, url):
+        request = urllib.request.Request(url, headers={'User-Agent': 'ChibiBytes image proxy'})
+        with self.opener(request, timeout=self.timeout) as response:
+            return response.read()
+
+    def store(self, path, data):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_usage()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.tmp-'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _disk_usage(self):
+        return sum(size for mtime, size, path in self._entries())
+
+    def _evict(self):
+        # Recount from disk since other workers write to the same directory
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, path in entries)
+        target = self.max_bytes * 0.9
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._size = total
@@ -0,0 +1,210 @@
+import json
+from operator import itemgetter
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; without it responses use the stdlib encoder
+    orjson = None
+
+
+class RawJSON:
+    """Already-encoded JSON bytes, spliced into a response as they are"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class RawJSONList(list):
+    """A list of RawJSON fragments, encoded by joining them.
+
+    Building a listing as a RawJSONList is what lets encode() skip re-encoding
+    it; the type is checked, the contents never searched.
+    """
+
+    __slots__ = ()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson when it is installed.
+
+    Responses are built as bytes end to end. A RawJSON value, or a RawJSONList of
+    them, is copied in without re-encoding, so a listing of cached catalog
+    fragments is little more than a bytes join; a RawJSON nested anywhere else is
+    decoded and encoded again by `default`, which is correct but gains nothing.
+    Output keeps Flask's defaults:
+    sorted keys, compact separators outside debug, and the same handling of
+    dates, dataclasses and __html__ objects via `default`.
+    """
+
+    def encode(self, obj, pretty=False):
+        """Serialize `obj` to UTF-8 JSON bytes"""
+        if isinstance(obj, RawJSON):
+            return obj.data
+        if isinstance(obj, RawJSONList):
+            return b'[' + b','.join(item.data for item in obj) + b']'
+        return self._encode_value(obj, pretty)
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, RawJSON):
+            return json.loads(o.data)
+        return DefaultJSONProvider.default(o)
+
+    def template(self, obj, fields):
+        """Encode the dict `obj` once around empty slots for the keys in `fields`; see fill().
+
+        For a dict sent in many responses with a few values that change per
+        response. Members of `obj` named in `fields` are left out, and with
+        sort_keys each slot sits where encoding the combined dict would put it.
+        """
+        members = [(key, self.encode({key: value})[1:-1]) for key, value in obj.items() if key not in fields]
+        members += [(key, None) for key in fields]
+        if self.sort_keys:
+            members.sort(key=itemgetter(0))
+        slots, chunks, chunk = [], [], b'{'
+        for i, (key, member) in enumerate(members):
+            if i:
+                chunk += b','
+            if member is None:
+                slots.append(key)
+                chunks.append(chunk + self._encode_value(key) + b':')
+                chunk = b''
+            else:
+                chunk += member
+        chunks.append(chunk + b'}')
+        return tuple(slots), tuple(chunks)
+
+    def fill(self, template, fields):
+        """JSON object bytes of a template() with the values in the `fields` dict encoded into its slots"""
+        slots, chunks = template
+        parts = [chunks[0]]
+        for key, chunk in zip(slots, chunks[1:]):
+            parts.append(self.encode(fields[key]))
+            parts.append(chunk)
+        return b''.join(parts)
+
+    def _encode_value(self, obj, pretty=False):
+        if orjson is not None:
+            option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            if pretty:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=self.default, option=option)
+        return json.dumps(obj, default=self.default, ensure_ascii=self.ensure_ascii, sort_keys=self.sort_keys,
+                          indent=2 if pretty else None, separators=None if pretty else (',', ':')).encode()
+
+    def dumps(self, obj, **kwargs):
+        if set(kwargs) - {'indent', 'separators'}:
+            return super().dumps(obj, **kwargs)
+        return self.encode(obj, pretty=bool(kwargs.get('indent'))).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self.encode(obj, pretty) + b'\n', mimetype=self.mimetype)
+
+
+def iter_json_list(stream, key='items', chunk_size=64 * 1024):
+    """Yield the elements of a JSON list, or of the `key` list of a JSON object, read from a text stream.
+
+    Elements are decoded as soon as they have arrived, so a large upload is never
+    held whole; other members of the object are decoded and dropped. Raises
+    ValueError for malformed JSON or when there is no such list.
+    """
+    reader = _StreamReader(stream, chunk_size)
+    if reader.expect('[{') == '[':
+        yield from reader.elements()
+    else:
+        found = False
+        if reader.peek() == '}':
+            reader.expect('}')
+        else:
+            while True:
+                name = reader.value()
+                if not isinstance(name, str):
+                    raise ValueError("expected an object key")
+                reader.expect(':')
+                if name == key and reader.peek() == '[':
+                    reader.expect('[')
+                    yield from reader.elements()
+                    found = True
+                else:
+                    reader.value()
+                if reader.expect(',}') == '}':
+                    break
+        if not found:
+            raise ValueError(f"expected a JSON list or an object with an '{key}' list")
+    if reader.peek():
+        raise ValueError("unexpected data after the JSON value")
+
+
+class _StreamReader:
+    """Buffered cursor over a text stream for iter_json_list"""
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _read(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def peek(self):
+        """Next non-whitespace character, '' at the end of the stream"""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer) or self.eof:
+                return self.buffer[self.position:self.position + 1]
+            self._read()
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"expected {' or '.join(map(repr, chars))}, got {char!r}" if char
+                             else "unexpected end of JSON")
+        self.position += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.position)
+                # A number running into the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def elements(self):
+        """Values up to the closing ']' of a list whose '[' was consumed"""
+        if self.peek() == ']':
+            self.expect(']')
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LFUCache:
+    """Bounded least-frequently-used cache with O(1) get and put.
+
+    Keys are grouped in buckets by hit count. Eviction takes the least recently
+    used key from the lowest bucket, so a burst of one-off keys only ever
+    displaces other one-off keys while the hot set stays put. The cache belongs
+    to one `generation` (for example a catalog version); sync() with a new
+    generation empties it, since frequencies earned by stale answers would
+    otherwise keep them resident.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = {}
+        self._counts = {}
+        self._buckets = {}
+        self._min_count = 0
+        self._lock = threading.Lock()
+
+    def sync(self, generation):
+        if generation != self.generation:
+            with self._lock:
+                if generation != self.generation:
+                    self._values.clear()
+                    self._counts.clear()
+                    self._buckets.clear()
+                    self._min_count = 0
+                    self.generation = generation
+
+    def advance(self, generation, stale):
+        """Move to `generation`, dropping only the keys for which stale(key) is true"""
+        with self._lock:
+            if generation == self.generation:
+                return
+            for key in [key for key in self._values if stale(key)]:
+                bucket = self._buckets[self._counts[key]]
+                del bucket[key]
+                if not bucket:
+                    del self._buckets[self._counts[key]]
+                del self._values[key]
+                del self._counts[key]
+            self._min_count = min(self._buckets) if self._buckets else 0
+            self.generation = generation
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            if key not in self._values:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._touch(key)
+            return self._values[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if key in self._values:
+                self._values[key] = value
+                self._touch(key)
+                return
+            if len(self._values) >= self.maxsize:
+                evicted, _ = self._buckets[self._min_count].popitem(last=False)
+                if not self._buckets[self._min_count]:
+                    del self._buckets[self._min_count]
+                del self._values[evicted]
+                del self._counts[evicted]
+                self.evictions += 1
+            self._values[key] = value
+            self._counts[key] = 1
+            self._buckets.setdefault(1, OrderedDict())[key] = None
+            self._min_count = 1
+
+    def _touch(self, key):
+        count = self._counts[key]
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = count + 1
+        self._counts[key] = count + 1
+        self._buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def __len__(self):
+        return len(self._values)
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._values),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "generation": self.generation,
+        }
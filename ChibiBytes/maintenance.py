@@ -0,0 +1,199 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# app_meta keys: the current leader lease and the report of the last run
+LEASE_KEY = 'maintenance_leader'
+REPORT_KEY = 'maintenance_report'
+
+# PRAGMA auto_vacuum values
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def worker_identity():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def acquire_lease(conn, key, owner, now, duration):
+    """Take or renew the lease row `key` in app_meta; False if another live owner holds it.
+
+    `conn` must be in autocommit mode (isolation_level=None).
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT value FROM app_meta WHERE key = ?', (key,)).fetchone()
+        if row:
+            holder, _, expires = row[0].rpartition('@')
+            if holder != owner and float(expires) > now:
+                conn.execute('ROLLBACK')
+                return False
+        conn.execute('INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)', (key, f'{owner}@{now + duration}'))
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    return True
+
+
+class MaintenanceScheduler:
+    """Keeps the SQLite file healthy: planner statistics, WAL size and free pages.
+
+    Every worker calls tick() periodically, but only the holder of a lease row in
+    app_meta does any work, so one process per database runs maintenance. The
+    leader waits for a quiet moment (its own request rate stands in for the
+    site's, since the load balancer spreads traffic evenly) unless a run is
+    overdue. Each run works through its steps until `budget` seconds are spent,
+    and the report of the last run is stored in app_meta so every worker can
+    serve it as metrics.
+    """
+
+    def __init__(self, database, interval=3600.0, budget=2.0, lease=300.0, max_request_rate=1.0,
+                 overdue_after=24 * 3600.0, wal_limit=16 * 1024 * 1024, vacuum_pages=256, clock=time.time):
+        self.database = database
+        self.interval = interval
+        self.budget = budget
+        self.lease = lease
+        self.max_request_rate = max_request_rate
+        self.overdue_after = overdue_after
+        self.wal_limit = wal_limit
+        self.vacuum_pages = vacuum_pages
+        self.clock = clock
+        self.requests = 0
+        self.runs = 0
+        self.skipped_busy = 0
+        self.last_report = None
+        self._last_tick = (clock(), 0)
+        self._lock = threading.Lock()
+
+    def note_request(self):
+        self.requests += 1
+
+    def identity(self):
+        return worker_identity()
+
+    def connect(self):
+        return sqlite3.connect(self.database, isolation_level=None, timeout=5.0)
+
+    def tick(self):
+        """Run maintenance if this worker is the leader, it is due, and traffic is low"""
+        now = self.clock()
+        last_time, last_requests = self._last_tick
+        self._last_tick = (now, self.requests)
+        request_rate = (self.requests - last_requests) / max(now - last_time, 1e-9)
+
+        conn = self.connect()
+        try:
+            if not self.acquire_lease(conn, now):
+                return None
+            previous = self.read_report(conn)
+            since = now - previous['finished_at'] if previous else None
+            if since is not None and since < self.interval:
+                return None
+            overdue = since is None or since >= self.overdue_after
+            if request_rate > self.max_request_rate and not overdue:
+                self.skipped_busy += 1
+                return None
+            with self._lock:
+                report = self.run(conn)
+            conn.execute('INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)',
+                         (REPORT_KEY, json.dumps(report)))
+            return report
+        finally:
+            conn.close()
+
+    def acquire_lease(self, conn, now):
+        """Take or renew the leader lease; False if another live worker holds it"""
+        return acquire_lease(conn, LEASE_KEY, self.identity(), now, self.lease)
+
+    def read_report(self, conn):
+        row = conn.execute('SELECT value FROM app_meta WHERE key = ?', (REPORT_KEY,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def run(self, conn):
+        """Run every step that fits in the time budget and return the report"""
+        started = self.clock()
+        deadline = time.monotonic() + self.budget
+        report = {"started_at": started, "leader": self.identity(), "steps": {}}
+        for name, step in (('optimize', self.optimize),
+                           ('wal_checkpoint', self.checkpoint_wal),
+                           ('vacuum', self.vacuum)):
+            if time.monotonic() >= deadline:
+                report['steps'][name] = {"skipped": "time budget spent"}
+                continue
+            step_started = time.monotonic()
+            try:
+                result = step(conn, deadline)
+            except sqlite3.Error as e:
+                result = {"error": str(e)}
+            result['seconds'] = round(time.monotonic() - step_started, 4)
+            report['steps'][name] = result
+        report['finished_at'] = self.clock()
+        report['size_bytes'] = self.file_size()
+        self.runs += 1
+        self.last_report = report
+        return report
+
+    def optimize(self, conn, deadline):
+        # analysis_limit keeps ANALYZE to a sample of each index, so it stays cheap on big tables
+        conn.execute('PRAGMA analysis_limit = 1000')
+        has_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").fetchone()
+        if has_stats:
+            conn.execute('PRAGMA optimize')
+            return {"action": "optimize"}
+        conn.execute('ANALYZE')
+        return {"action": "analyze"}
+
+    def checkpoint_wal(self, conn, deadline):
+        mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        if mode != 'wal':
+            return {"action": "none", "journal_mode": mode}
+        wal_bytes = os.path.getsize(self.database + '-wal') if os.path.exists(self.database + '-wal') else 0
+        # TRUNCATE also shrinks the file once it has grown past the limit
+        checkpoint = 'TRUNCATE' if wal_bytes > self.wal_limit else 'PASSIVE'
+        busy, log_frames, checkpointed = conn.execute(f'PRAGMA wal_checkpoint({checkpoint})').fetchone()
+        return {"action": checkpoint.lower(), "wal_bytes": wal_bytes, "busy": bool(busy),
+                "log_frames": log_frames, "checkpointed_frames": checkpointed}
+
+    def vacuum(self, conn, deadline):
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            # Switching over takes a full VACUUM, which can't be bounded by the budget (see convert)
+            return {"action": "none", "free_pages": free_before,
+                    "reason": "auto_vacuum is off; run `flask enable-incremental-vacuum`"}
+
+        free = free_before
+        while free and time.monotonic() < deadline:
+            conn.execute(f'PRAGMA incremental_vacuum({self.vacuum_pages})').fetchall()
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return {"action": "incremental", "free_pages": free,
+                "freed_bytes": (free_before - free) * page_size}
+
+    def convert(self, conn):
+        """Switch the file to incremental auto_vacuum, so runs can return free pages a few at a time.
+
+        It takes one full VACUUM, which rewrites the whole file and holds the
+        write lock until it is done, so it is only run from the command line.
+        """
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return {"action": "none", "free_pages": free_before}
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return {"action": "convert", "free_pages": free, "freed_bytes": (free_before - free) * page_size}
+
+    def file_size(self):
+        return os.path.getsize(self.database) if os.path.exists(self.database) else 0
+
+    def metrics(self, conn=None):
+        """Counters of this worker plus the last run's report, whichever worker ran it"""
+        report = self.last_report
+        if conn is not None:
+            report = self.read_report(conn) or report
+        return {"runs": self.runs, "skipped_busy": self.skipped_busy, "last_run": report}
@@ -0,0 +1,331 @@
+import collections
+import concurrent.futures
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+
+from maintenance import acquire_lease, worker_identity
+
+# Titles kept per user in user_recommendations
+TOP_N = 20
+# Users scored per task handed to a worker process
+CHUNK_SIZE = 500
+# Most saved titles of one user counted in the co-occurrence model, so huge imports don't dominate it
+MAX_PROFILE_ITEMS = 200
+# Most similar titles kept per title
+NEIGHBORS = 50
+# Best rated titles per genre that genre similarity can suggest
+GENRE_CANDIDATES = 200
+# Weights of genre overlap and rating next to co-occurrence (a cosine, 0-1 per saved title)
+GENRE_WEIGHT = 0.3
+RATING_WEIGHT = 0.05
+
+GENERATION_KEY = 'recommendations_generation'
+CATALOG_VERSION_KEY = 'recommendations_catalog_version'
+REPORT_KEY = 'recommendations_report'
+LEASE_KEY = 'recommendations_leader'
+
+
+class RecommendationModel:
+    """Title-to-title similarity from every watchlist, plus each title's genres and rating.
+
+    Two titles are similar when the same users saved both (cosine of their saver
+    sets). Genre overlap with the user's saved titles adds candidates nobody has
+    co-saved yet, and the rating breaks ties. The model is built once per run and
+    loaded by each worker process from a pickle file the run writes.
+    """
+
+    def __init__(self, titles, neighbors, genre_titles):
+        self.titles = titles
+        self.neighbors = neighbors
+        self.genre_titles = genre_titles
+
+    @classmethod
+    def build(cls, catalog, watchlists):
+        """Model for `catalog` from an iterable of saved-key lists, one per user"""
+        titles = {key: (item.genres, (item.rating_score or 0) / 10) for key, item in catalog.items.items()}
+        genre_titles = collections.defaultdict(list)
+        for key, (genres, rating) in titles.items():
+            for genre in genres:
+                genre_titles[genre].append(key)
+        genre_titles = {genre: heapq.nlargest(GENRE_CANDIDATES, keys, key=lambda key: titles[key][1])
+                        for genre, keys in genre_titles.items()}
+
+        savers = collections.Counter()
+        pairs = collections.defaultdict(collections.Counter)
+        for keys in watchlists:
+            keys = [key for key in keys if key in titles][:MAX_PROFILE_ITEMS]
+            savers.update(keys)
+            for i, key in enumerate(keys):
+                row = pairs[key]
+                for other in keys[i + 1:]:
+                    row[other] += 1
+                    pairs[other][key] += 1
+        neighbors = {
+            key: heapq.nlargest(NEIGHBORS, ((other, count / math.sqrt(savers[key] * savers[other]))
+                                            for other, count in row.items()), key=lambda entry: entry[1])
+            for key, row in pairs.items()
+        }
+        return cls(titles, neighbors, genre_titles)
+
+    def recommend(self, saved, limit=TOP_N):
+        """Best `limit` (key, score) pairs for a user who saved `saved`, excluding those"""
+        saved = {key for key in saved if key in self.titles}
+        if not saved:
+            return []
+        scores = collections.defaultdict(float)
+        for key in saved:
+            for other, similarity in self.neighbors.get(key, ()):
+                scores[other] += similarity
+
+        # Share of the user's saved titles in each genre
+        profile = collections.Counter(genre for key in saved for genre in self.titles[key][0])
+        for genre, count in profile.items():
+            weight = GENRE_WEIGHT * count / len(saved)
+            for other in self.genre_titles.get(genre, ()):
+                scores[other] += weight / math.sqrt(len(self.titles[other][0]))
+
+        for key in saved:
+            scores.pop(key, None)
+        return heapq.nlargest(limit, ((key, round(score + RATING_WEIGHT * self.titles[key][1], 6))
+                                      for key, score in scores.items()), key=lambda entry: entry[1])
+
+
+# The model of the current run in each worker process, and the file it was loaded from
+_model = None
+_model_path = None
+
+
+def _recommend_chunk(users, limit, model):
+    """[(user_id, watchlist_version, recommendations)] for [(user_id, watchlist_version, saved keys)]"""
+    return [(user_id, version, model.recommend(saved, limit)) for user_id, version, saved in users]
+
+
+def _recommend_chunk_from(model_path, users, limit):
+    """_recommend_chunk in a worker process, loading the run's model the first time it sees `model_path`"""
+    global _model, _model_path
+    if model_path != _model_path:
+        with open(model_path, 'rb') as f:
+            _model = pickle.load(f)
+        _model_path = model_path
+    return _recommend_chunk(users, limit, _model)
+
+
+def iter_watchlists(conns):
+    """Saved keys of every user with a watchlist, on every shard"""
+    for conn in conns:
+        user_id, keys = None, []
+        for row in conn.execute('SELECT user_id, media_type, media_id FROM watchlist ORDER BY user_id'):
+            if row[0] != user_id:
+                if keys:
+                    yield keys
+                user_id, keys = row[0], []
+            keys.append((row[1], row[2]))
+        if keys:
+            yield keys
+
+
+def pending_users(conn, full, chunk_size):
+    """Chunks of (user_id, watchlist_version, saved keys) whose lists need computing.
+
+    Without `full`, only users whose watchlist_version moved since their list
+    was computed. Each chunk is read in one transaction, so the version matches
+    the saved titles it goes with.
+    """
+    last_id = 0
+    while True:
+        conn.execute('BEGIN')
+        try:
+            users = conn.execute('''
+                SELECT id, watchlist_version FROM users
+                WHERE id > ? AND (? OR recommendations_version IS NOT watchlist_version)
+                ORDER BY id LIMIT ?
+            ''', (last_id, int(full), chunk_size)).fetchall()
+            saved = collections.defaultdict(list)
+            if users:
+                rows = conn.execute(f'''
+                    SELECT user_id, media_type, media_id FROM watchlist
+                    WHERE user_id IN ({", ".join("?" * len(users))})
+                    ORDER BY added_at DESC
+                ''', [user_id for user_id, _ in users])
+                for user_id, media_type, media_id in rows:
+                    saved[user_id].append((media_type, media_id))
+        finally:
+            conn.execute('COMMIT')
+        if not users:
+            return
+        yield [(user_id, version, saved[user_id]) for user_id, version in users]
+        last_id = users[-1][0]
+
+
+def has_pending_users(conn):
+    """True if any user's watchlist changed since their list was computed"""
+    return conn.execute(
+        'SELECT 1 FROM users WHERE recommendations_version IS NOT watchlist_version LIMIT 1').fetchone() is not None
+
+
+def store_recommendations(conn, results, generation):
+    """Replace each user's list and remember the watchlist_version it was computed from"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for user_id, version, recommendations in results:
+            conn.execute('DELETE FROM user_recommendations WHERE user_id = ?', (user_id,))
+            conn.executemany('''
+                INSERT INTO user_recommendations (user_id, rank, media_type, media_id, score, generation)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(user_id, rank, media_type, media_id, score, generation)
+                  for rank, ((media_type, media_id), score) in enumerate(recommendations)])
+            conn.execute('UPDATE users SET recommendations_version = ? WHERE id = ?', (version, user_id))
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def read_meta(conn, key):
+    row = conn.execute('SELECT value FROM app_meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def write_meta(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)', (key, value))
+
+
+class RecommendationJob:
+    """Precomputes every user's top titles into user_recommendations on their shard.
+
+    A run builds the model from all shards' watchlists, then scores users a
+    chunk at a time on a pool of `processes` worker processes (inline in the
+    calling thread when 0) and writes each shard's results as they come back.
+    Runs are incremental: only users whose watchlist changed since their list
+    was computed are rescored, unless the catalog changed or `full` is asked
+    for. Every run stores the next generation id with the rows it writes, and
+    claims it together with its report once it has finished, so a failed run
+    leaves the generation where it was. Bookkeeping lives in the first shard's
+    app_meta. A run with nothing to rescore stops before building the model.
+
+    The process pool is started on first use and kept for later runs; close()
+    shuts it down. Each run hands its model to the pool as a temporary pickle
+    file, which a worker process loads once and reuses for every chunk.
+    """
+
+    def __init__(self, databases, processes=1, chunk_size=CHUNK_SIZE, limit=TOP_N, lease=3600.0,
+                 clock=time.time):
+        self.databases = databases
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.lease = lease
+        self.clock = clock
+        self._executor = None
+        self._executor_pid = None
+
+    def connect(self, database):
+        return sqlite3.connect(database, isolation_level=None, timeout=30)
+
+    def tick(self, catalog):
+        """Scheduler entry point: run if this worker holds the lease"""
+        conn = self.connect(self.databases[0])
+        try:
+            if not acquire_lease(conn, LEASE_KEY, worker_identity(), self.clock(), self.lease):
+                return None
+        finally:
+            conn.close()
+        return self.run(catalog)
+
+    def executor(self):
+        """The job's process pool, started on first use and again in a forked child"""
+        if self._executor is None or self._executor_pid != os.getpid():
+            context = multiprocessing.get_context('spawn')
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.processes, mp_context=context)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def close(self):
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown()
+        self._executor = None
+
+    def run(self, catalog, full=False, log=None):
+        """Rescore the pending users; the run's report, or None if there was nobody to rescore"""
+        started = time.monotonic()
+        conns = [self.connect(database) for database in self.databases]
+        try:
+            meta = conns[0]
+            generation = int(read_meta(meta, GENERATION_KEY) or 0) + 1
+            full = full or read_meta(meta, CATALOG_VERSION_KEY) != str(catalog.version)
+            if not full and not any(has_pending_users(conn) for conn in conns):
+                return None
+
+            model = RecommendationModel.build(catalog, iter_watchlists(conns))
+            users = 0
+            if self.processes > 0:
+                users = self._run_pool(conns, full, generation, model, log)
+            else:
+                for conn in conns:
+                    users += self._run_shard(conn, full, generation, model, None, log)
+
+            report = {"generation": generation, "full": full, "users": users, "catalog_version": catalog.version,
+                      "finished_at": self.clock(), "seconds": round(time.monotonic() - started, 3)}
+            meta.execute('BEGIN IMMEDIATE')
+            try:
+                write_meta(meta, GENERATION_KEY, generation)
+                write_meta(meta, CATALOG_VERSION_KEY, catalog.version)
+                write_meta(meta, REPORT_KEY, json.dumps(report))
+            except BaseException:
+                meta.execute('ROLLBACK')
+                raise
+            meta.execute('COMMIT')
+            return report
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def _run_pool(self, conns, full, generation, model, log):
+        fd, model_path = tempfile.mkstemp(prefix='recommendations-', suffix='.pickle')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+            executor = self.executor()
+            try:
+                return sum(self._run_shard(conn, full, generation, model_path, executor, log) for conn in conns)
+            except concurrent.futures.BrokenExecutor:
+                # A worker died (killed, out of memory); the next run starts a new pool
+                self._executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+        finally:
+            os.unlink(model_path)
+
+    def _run_shard(self, conn, full, generation, model, executor, log):
+        users = 0
+        if executor is None:
+            for chunk in pending_users(conn, full, self.chunk_size):
+                users += self._store(conn, _recommend_chunk(chunk, self.limit, model), generation, log)
+            return users
+
+        # Keep a couple of chunks per process in flight, writing results in order as they finish
+        pending = collections.deque()
+        for chunk in pending_users(conn, full, self.chunk_size):
+            pending.append(executor.submit(_recommend_chunk_from, model, chunk, self.limit))
+            if len(pending) >= 2 * self.processes:
+                users += self._store(conn, pending.popleft().result(), generation, log)
+        while pending:
+            users += self._store(conn, pending.popleft().result(), generation, log)
+        return users
+
+    def _store(self, conn, results, generation, log):
+        store_recommendations(conn, results, generation)
+        if log:
+            log(f"stored {len(results)} users")
+        return len(results)
+
+    def metrics(self, conn):
+        report = read_meta(conn, REPORT_KEY)
+        return json.loads(report) if report else None
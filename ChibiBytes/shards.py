@@ -0,0 +1,302 @@
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+import zlib
+
+
+class ShardMigrating(Exception):
+    """The user's rows are being moved to another shard; the write should be retried shortly"""
+
+
+def shard_path(database, index):
+    """File holding shard `index`; shard 0 is `database` itself, so one shard is the unsharded layout"""
+    if index == 0:
+        return database
+    root, ext = os.path.splitext(database)
+    return f'{root}_shard{index}{ext}'
+
+
+def shard_for(user_id, count):
+    """Shard a user is placed on when there are `count` shards"""
+    return zlib.crc32(str(user_id).encode()) % count
+
+
+def attach_shard(conn, path, schema):
+    """Attach another shard read-only, for queries that aggregate over every shard"""
+    uri = f'file:{urllib.request.pathname2url(os.path.abspath(path))}?mode=ro'
+    conn.execute('ATTACH DATABASE ? AS ' + schema, (uri,))
+
+
+class ConnectionPool:
+    """Keeps up to `size` idle SQLite connections for reuse across requests.
+
+    Connections are created with check_same_thread=False by `connect` and are
+    only ever used by one thread between acquire() and release(). A connection
+    whose `generation` (for example the identity of an attached file) has
+    changed since it was opened is closed instead of handed out again. Idle
+    connections inherited through a fork are dropped, never shared.
+    """
+
+    def __init__(self, connect, size=8, generation=None):
+        self.connect = connect
+        self.size = size
+        self.generation = generation or (lambda: None)
+        self.created = 0
+        self.reused = 0
+        self._idle = []
+        self._opened = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        generation = self.generation()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = []
+                self._opened = {}
+                self._pid = os.getpid()
+            while self._idle:
+                conn, opened = self._idle.pop()
+                if opened == generation:
+                    self.reused += 1
+                    self._opened[id(conn)] = opened
+                    return conn
+                conn.close()
+            self.created += 1
+        conn = self.connect()
+        with self._lock:
+            self._opened[id(conn)] = generation
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            opened = self._opened.pop(id(conn), None)
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((conn, opened))
+                return
+        conn.close()
+
+    def metrics(self):
+        return {"idle": len(self._idle), "created": self.created, "reused": self.reused}
+
+
+class UserDirectory:
+    """Maps each user to the shard holding their users and watchlist rows.
+
+    User ids are allocated here, so they stay unique across shards, and
+    usernames and emails are unique here since no single shard sees every user.
+    New users go to the shard their id hashes to; afterwards the directory, not
+    the hash, is the source of truth, so changing the shard count only affects
+    new users until the reshard command has moved the existing ones.
+    """
+
+    def __init__(self, database, shard_count, pool_size=4):
+        self.database = database
+        self.shard_count = shard_count
+        self.pool = ConnectionPool(self.connect, size=pool_size)
+
+    def connect(self):
+        conn = sqlite3.connect(self.database, timeout=5.0, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _execute(self, query, params=(), commit=False):
+        conn = self.pool.acquire()
+        try:
+            cursor = conn.execute(query, params)
+            rows = cursor.fetchall()
+            if commit:
+                conn.commit()
+                return cursor.lastrowid
+            return rows
+        finally:
+            self.pool.release(conn)
+
+    def init(self, shard_databases):
+        """Create the directory, registering the users of existing shards the first time"""
+        conn = self.connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_directory (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    shard INTEGER NOT NULL,
+                    migrating INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            if conn.execute('SELECT 1 FROM user_directory LIMIT 1').fetchone():
+                return
+            for index, path in enumerate(shard_databases):
+                if not os.path.exists(path):
+                    continue
+                attach_shard(conn, path, 'shard')
+                try:
+                    with conn:
+                        conn.execute('''
+                            INSERT OR IGNORE INTO user_directory (id, username, email, shard)
+                            SELECT id, username, email, ? FROM shard.users
+                        ''', (index,))
+                finally:
+                    conn.execute('DETACH DATABASE shard')
+        finally:
+            conn.close()
+
+    def register(self, username, email):
+        """Allocate an id for a new user; returns (user_id, shard).
+
+        Raises sqlite3.IntegrityError if the username or email is taken.
+        """
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                user_id = conn.execute('INSERT INTO user_directory (username, email, shard) VALUES (?, ?, -1)',
+                                       (username, email)).lastrowid
+                shard = shard_for(user_id, self.shard_count)
+                conn.execute('UPDATE user_directory SET shard = ? WHERE id = ?', (shard, user_id))
+            return user_id, shard
+        finally:
+            self.pool.release(conn)
+
+    def unregister(self, user_id):
+        self._execute('DELETE FROM user_directory WHERE id = ?', (user_id,), commit=True)
+
+    def find(self, username):
+        """(user_id, shard) for a username, or None"""
+        rows = self._execute('SELECT id, shard FROM user_directory WHERE username = ?', (username,))
+        return (rows[0]['id'], rows[0]['shard']) if rows else None
+
+    def shard_of(self, user_id, for_write=False):
+        """Shard of a user; with for_write, raises ShardMigrating while their rows are being moved.
+
+        Users without a directory entry are reported on shard 0, where every
+        user lived before the directory existed.
+        """
+        rows = self._execute('SELECT shard, migrating FROM user_directory WHERE id = ?', (user_id,))
+        if not rows:
+            return 0
+        if for_write and rows[0]['migrating']:
+            raise ShardMigrating("Your watchlist is being moved, please retry in a few seconds")
+        return rows[0]['shard']
+
+    def misplaced(self, count):
+        """(user_id, current shard, target shard) for every user not on its hash shard among `count`"""
+        rows = self._execute('SELECT id, shard FROM user_directory WHERE shard >= 0')
+        return [(row['id'], row['shard'], shard_for(row['id'], count))
+                for row in rows if row['shard'] != shard_for(row['id'], count)]
+
+    def shards(self, user_ids):
+        """Directory shard of each of `user_ids` that has an entry"""
+        shards = {}
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            rows = self._execute(f'SELECT id, shard FROM user_directory WHERE id IN ({", ".join("?" * len(chunk))})',
+                                 chunk)
+            shards.update((row['id'], row['shard']) for row in rows)
+        return shards
+
+    def set_migrating(self, user_ids, migrating=True):
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            self._execute(f'UPDATE user_directory SET migrating = ? WHERE id IN ({", ".join("?" * len(chunk))})',
+                          (int(migrating), *chunk), commit=True)
+
+    def clear_migrating(self):
+        self._execute('UPDATE user_directory SET migrating = 0 WHERE migrating', commit=True)
+
+    def assign(self, user_id, shard):
+        self._execute('UPDATE user_directory SET shard = ?, migrating = 0 WHERE id = ?', (shard, user_id),
+                      commit=True)
+
+
+def move_user(directory, user_id, source, target, target_shard):
+    """Copy one user's rows from `source` to `target`, repoint the directory, then delete the originals.
+
+    Safe to rerun after a crash at any point: rows an unfinished move left in
+    the target are replaced, and the directory decides which copy is live.
+    Watchlist rows get new ids in the target, so the user's watchlist_version
+    is bumped (without an event) to make clients resync from scratch. Events
+    stay behind in the source, where trending has already counted them.
+    Returns False if the source has no such user.
+    """
+    user = source.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    if user is None:
+        return False
+    items = source.execute('SELECT * FROM watchlist WHERE user_id = ? ORDER BY id', (user_id,)).fetchall()
+
+    user = dict(user, watchlist_version=user['watchlist_version'] + 1)
+    with target:
+        target.execute('DELETE FROM watchlist WHERE user_id = ?', (user_id,))
+        target.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        target.execute(f'INSERT INTO users ({", ".join(user)}) VALUES ({", ".join("?" * len(user))})',
+                       tuple(user.values()))
+        if items:
+            columns = [column for column in items[0].keys() if column != 'id']
+            target.executemany(
+                f'INSERT INTO watchlist ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                [tuple(item[column] for column in columns) for item in items])
+    directory.assign(user_id, target_shard)
+    with source:
+        source.execute('DELETE FROM user_recommendations WHERE user_id = ?', (user_id,))
+        source.execute('DELETE FROM watchlist WHERE user_id = ?', (user_id,))
+        source.execute('DELETE FROM users WHERE id = ?', (user_id,))
+    return True
+
+
+def purge_strays(directory, conn, shard):
+    """Delete users (and their watchlists) that the directory places on another shard.
+
+    These are leftovers of a move interrupted after the directory was updated.
+    """
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users')]
+    strays = [user_id for user_id, live in directory.shards(user_ids).items() if live != shard]
+    with conn:
+        for user_id in strays:
+            conn.execute('DELETE FROM user_recommendations WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM watchlist WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+    return len(strays)
+
+
+def reshard(directory, count, connect, batch_size=100, grace=5.0, log=print):
+    """Move every user to the shard their id hashes to among `count` shards.
+
+    Users are moved a batch at a time. A batch is marked migrating first, so new
+    writes for it are refused with ShardMigrating, and the move waits `grace`
+    seconds for writes that started before the mark to commit. Reads keep being
+    served from the old shard until each user's directory entry flips. Only one
+    reshard should run at a time. Returns the number of users moved.
+    """
+    directory.clear_migrating()
+    moves = directory.misplaced(count)
+    log(f"{len(moves)} users to move")
+    conns = {}
+    moved = 0
+    try:
+        for start in range(0, len(moves), batch_size):
+            batch = moves[start:start + batch_size]
+            directory.set_migrating([user_id for user_id, _, _ in batch])
+            time.sleep(grace)
+            for user_id, source, target in batch:
+                for shard in (source, target):
+                    if shard not in conns:
+                        conns[shard] = connect(shard)
+                if move_user(directory, user_id, conns[source], conns[target], target):
+                    moved += 1
+                else:
+                    directory.set_migrating([user_id], False)
+            log(f"moved {moved}/{len(moves)}")
+        for shard in sorted(set(conns) | set(range(count))):
+            if shard not in conns:
+                conns[shard] = connect(shard)
+            purged = purge_strays(directory, conns[shard], shard)
+            if purged:
+                log(f"shard {shard}: removed {purged} leftover users")
+    finally:
+        for conn in conns.values():
+            conn.close()
+    return moved
@@ -0,0 +1,44 @@
+import itertools
+import os
+import sys
+
+import pytest
+
+# The app's modules are flat files next to app.py, imported by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_usernames = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def chibibytes(tmp_path_factory):
+    """The app module, imported once in a scratch directory where it creates fresh databases"""
+    directory = tmp_path_factory.mktemp('app')
+    previous = os.getcwd()
+    # Database paths are relative, so the directory stays current for the whole session
+    os.chdir(directory)
+    import app
+    yield app
+    # Threads started by requests still use the relative paths
+    for task in app.BACKGROUND_TASKS:
+        task.stop()
+    app.warmup.ready.wait(30)
+    os.chdir(previous)
+
+
+@pytest.fixture
+def client(chibibytes):
+    """A test client logged in as a new user"""
+    username = f'user{next(_usernames)}'
+    user_id, shard = chibibytes.user_directory.register(username, f'{username}@example.com')
+    with chibibytes.app.app_context():
+        db = chibibytes.get_db(shard)
+        db.execute('INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)',
+                   (user_id, username, f'{username}@example.com', 'x'))
+        db.commit()
+    client = chibibytes.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['username'] = username
+    client.user_id = user_id
+    return client
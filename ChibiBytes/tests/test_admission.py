@@ -0,0 +1,70 @@
+import itertools
+import threading
+
+import pytest
+
+from admission import Admission, RateLimitStore
+
+_logins = itertools.count()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = RateLimitStore(str(tmp_path / 'limits.db'))
+    store.init()
+    return store
+
+
+def test_bucket_refills_at_its_rate(store):
+    assert [store.take('k', rate=1.0, burst=2, now=100) for _ in range(2)] == [0, 0]
+    assert store.take('k', rate=1.0, burst=2, now=100) == pytest.approx(1.0)
+    assert store.take('k', rate=1.0, burst=2, now=100.5) == pytest.approx(0.5)
+    assert store.take('k', rate=1.0, burst=2, now=101) == 0
+    # Another key has its own bucket
+    assert store.take('other', rate=1.0, burst=2, now=101) == 0
+
+
+def test_check_rate_stops_at_the_first_empty_scope(store):
+    admission = Admission('test', store, [('ip', 1000.0, 1), ('session', 0.001, 1)])
+    assert admission.check_rate({"ip": '1.1.1.1', "session": 7}) == 0
+    assert admission.check_rate({"ip": '2.2.2.2', "session": 7}) > 0
+    assert admission.rate_limited == {'session': 1}
+    # A missing identity is not limited in that scope
+    assert admission.check_rate({"ip": '3.3.3.3'}) == 0
+
+
+def test_concurrency_cap_queues_then_rejects(store):
+    admission = Admission('test', store, concurrency=1, queue_timeout=0.05, max_waiting=1)
+    assert admission.enter()
+    assert not admission.enter()
+    assert admission.timed_out == 1
+    released = threading.Timer(0.01, admission.leave)
+    released.start()
+    admission.queue_timeout = 1.0
+    assert admission.enter()
+    released.join()
+    admission.leave()
+    assert admission.running == 0 and admission.admitted == 2
+
+
+def login(client, forwarded_for):
+    return client.post('/login', data={"username": f'nobody{next(_logins)}', "password": 'x'},
+                       headers={"X-Forwarded-For": forwarded_for}, environ_base={"REMOTE_ADDR": '10.0.0.1'})
+
+
+def test_forwarded_clients_get_their_own_buckets(chibibytes, monkeypatch):
+    monkeypatch.setattr(chibibytes.app.wsgi_app, 'x_for', 1)
+    client = chibibytes.app.test_client()
+    burst = dict((scope, burst) for scope, rate, burst in chibibytes.admissions['auth'].limits)['ip']
+    assert all(login(client, '203.0.113.1').status_code == 200 for _ in range(burst))
+    assert login(client, '203.0.113.1').status_code == 429
+    assert login(client, '203.0.113.2').status_code == 200
+
+
+def test_forwarded_header_is_ignored_without_trusted_proxies(chibibytes):
+    assert chibibytes.app.wsgi_app.x_for == 0
+    client = chibibytes.app.test_client()
+    burst = dict((scope, burst) for scope, rate, burst in chibibytes.admissions['auth'].limits)['ip']
+    forwarded = (f'198.51.100.{i}' for i in itertools.count())
+    assert all(login(client, next(forwarded)).status_code == 200 for _ in range(burst))
+    assert login(client, next(forwarded)).status_code == 429
@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+from autocomplete import AutocompleteIndex
+from catalog import title_key
+
+
+def brute_force(catalog, popularity, query, limit, media_type=None):
+    """Keys matching `query`, by own-name match first, then save count, rating and key"""
+    prefix = title_key(query)
+    names = [(name, key) for name, keys in catalog.title_keys().items() for key in keys]
+    for key, item in catalog.items.items():
+        words = item.title_key.split()
+        names += [(' '.join(words[i:]), key) for i in range(1, len(words))]
+    best = {}
+    for name, key in names:
+        if name.startswith(prefix) and (media_type is None or key[0] == media_type):
+            own = name == catalog.items[key].title_key
+            best[key] = min(best.get(key, 1), 0 if own else 1)
+    order = lambda key: (best[key], -popularity.get(key, 0), -(catalog.items[key].rating_score or 0), key)
+    return sorted(best, key=order)[:limit]
+
+
+@pytest.fixture(scope='module')
+def catalog(chibibytes):
+    return chibibytes.catalog_cache.get()
+
+
+def test_matches_brute_force(catalog):
+    rng = random.Random(3)
+    popularity = {key: rng.randrange(5) for key in catalog.items}
+    index = AutocompleteIndex(catalog, popularity)
+    prefixes = {name[:length] for name in catalog.title_keys() for length in (1, 2, 4)} | {'kaisen', 'man', 'zzz'}
+    for prefix in sorted(prefixes):
+        for limit, media_type in [(10, None), (3, None), (20, 'movie'), (5, 'anime')]:
+            assert index.complete(prefix, limit, media_type) == \
+                brute_force(catalog, popularity, prefix, limit, media_type), (prefix, limit, media_type)
+
+
+def test_word_suffixes_and_popularity(catalog):
+    jujutsu = [key for key, item in catalog.items.items() if item.title_key.startswith('jujutsu kaisen')]
+    assert AutocompleteIndex(catalog).complete('kaisen') == sorted(
+        jujutsu, key=lambda key: (-(catalog.items[key].rating_score or 0), key))
+    # Save counts outrank ratings
+    underdog = min(jujutsu, key=lambda key: catalog.items[key].rating_score or 0)
+    assert AutocompleteIndex(catalog, {underdog: 100}).complete('kaisen')[0] == underdog
+
+
+def test_endpoint(chibibytes):
+    client = chibibytes.app.test_client()
+    results = client.get('/api/autocomplete?q=Jujutsu&limit=1').get_json()
+    assert len(results) == 1 and results[0]['media_type'] == 'anime'
+    assert results[0]['title'].startswith('Jujutsu Kaisen')
+    assert client.get('/api/autocomplete?q=').get_json() == []
+    assert client.get('/api/autocomplete?q=a&media_type=book').status_code == 400
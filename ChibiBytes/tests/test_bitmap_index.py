@@ -0,0 +1,86 @@
+import itertools
+
+import pytest
+
+from catalog import split_categories
+
+# Best rated first, unrated last, as the index assigns ordinals
+TITLES = '''
+    SELECT media_type, id, category, rating_score, year_int FROM (
+        SELECT 'anime' AS media_type, id, category, rating_score, year_int FROM anime
+        UNION ALL
+        SELECT 'movie', id, category, rating_score, year_int FROM movies
+    )
+    WHERE (:media_type IS NULL OR media_type = :media_type)
+      AND (:year_from IS NULL OR year_int >= :year_from)
+      AND (:year_to IS NULL OR year_int <= :year_to)
+      AND (:min_rating IS NULL OR rating_score >= :min_rating)
+      AND (:max_rating IS NULL OR rating_score <= :max_rating)
+    ORDER BY rating_score IS NULL, rating_score DESC, media_type, id
+'''
+
+FILTERS = [
+    {},
+    {"media_type": 'anime'},
+    {"media_type": 'movie', "min_rating": 8.0},
+    {"year_from": 2015},
+    {"year_from": 2000, "year_to": 2012},
+    {"year_to": 1999},
+    {"min_rating": 8.5, "max_rating": 9.0},
+    {"max_rating": 7.9},
+    {"media_type": 'anime', "year_from": 2010, "min_rating": 8.0, "max_rating": 8.8},
+]
+
+
+@pytest.fixture(scope='module')
+def catalog(chibibytes):
+    conn = chibibytes.connect_catalog_db()
+    yield chibibytes.catalog_cache.get(), conn
+    conn.close()
+
+
+def expected(conn, all_of=(), any_of=(), none_of=(), **ranges):
+    params = dict.fromkeys(('media_type', 'year_from', 'year_to', 'min_rating', 'max_rating'))
+    params.update(ranges)
+    keys = []
+    for media_type, media_id, category, *_ in conn.execute(TITLES, params):
+        genres = set(split_categories(category))
+        if set(all_of) <= genres and (not any_of or genres & set(any_of)) and not genres & set(none_of):
+            keys.append((media_type, media_id))
+    return keys
+
+
+def test_filters_match_sql(catalog):
+    catalog, conn = catalog
+    index = catalog.bitmaps()
+    assert len(expected(conn)) == len(catalog.items)
+    genres = sorted(index.genres)
+    genre_filters = [{}, {"all_of": genres[:1]}, {"any_of": genres[1:4]}, {"none_of": genres[:2]},
+                     {"all_of": genres[2:3], "none_of": genres[4:5]}]
+    for ranges, genre_filter in itertools.product(FILTERS, genre_filters):
+        keys = expected(conn, **genre_filter, **ranges)
+        bits = index.filter(**genre_filter, **ranges)
+        assert bits.bit_count() == len(keys), (ranges, genre_filter)
+        assert index.page(bits, 0, len(keys) + 1) == keys, (ranges, genre_filter)
+
+
+def test_pages_match_sql_offsets(catalog):
+    catalog, conn = catalog
+    index = catalog.bitmaps()
+    for ranges in FILTERS:
+        keys = expected(conn, **ranges)
+        bits = index.filter(**ranges)
+        for offset, limit in [(0, 20), (1, 5), (7, 20), (20, 20), (len(keys) - 1, 5), (len(keys), 5), (500, 20)]:
+            assert index.page(bits, offset, limit) == keys[offset:offset + limit], (ranges, offset, limit)
+
+
+def test_filter_endpoint_pages_through_every_match(chibibytes, catalog):
+    catalog, conn = catalog
+    keys = expected(conn, media_type='anime', min_rating=8.0)
+    client = chibibytes.app.test_client()
+    seen = []
+    for offset in range(0, len(keys) + 7, 7):
+        body = client.get(f'/api/filter?media_type=anime&min_rating=8&offset={offset}&limit=7').get_json()
+        assert body['count'] == len(keys)
+        seen += [(item['media_type'], item['id']) for item in body['results']]
+    assert seen == keys
@@ -0,0 +1,152 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+from flask import g
+
+from blocking import BlockingExecutor
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_executor_bounds_concurrent_calls():
+    executor = BlockingExecutor(max_workers=3)
+
+    def work(n):
+        time.sleep(0.02)
+        return n * n
+
+    async def main():
+        return await asyncio.gather(*(executor.run(work, n) for n in range(20)))
+
+    assert asyncio.run(main()) == [n * n for n in range(20)]
+    assert executor.peak_running == 3
+    assert executor.metrics()['submitted'] == 20 and executor.running == 0
+
+
+def test_offloaded_tasks_get_their_own_g_and_connections(chibibytes):
+    pool = chibibytes.db_pool(0)
+    both_running = threading.Barrier(2, timeout=5)
+
+    def task(n):
+        assert 'outer' not in g
+        g.n = n
+        db = chibibytes.get_db(0)
+        # Both tasks hold their connection at the same time
+        both_running.wait()
+        return db, g.n
+
+    view = chibibytes.offloaded(task)
+    idle, created = pool.metrics()['idle'], pool.created
+    with chibibytes.app.test_request_context('/'):
+        g.outer = True
+
+        async def main():
+            return await asyncio.gather(view(1), view(2))
+
+        (first, n1), (second, n2) = asyncio.run(main())
+        assert g.outer and '_databases' not in g
+    assert (n1, n2) == (1, 2) and first is not second
+    # Both connections went back to the pool when their tasks ended
+    assert pool.metrics()['idle'] == idle + pool.created - created
+
+
+def test_admission_wraps_async_views(chibibytes, client):
+    admission = chibibytes.admissions['chatbot']
+    burst = dict((scope, burst) for scope, rate, burst in admission.limits)['session']
+    statuses = [client.post('/chatbot', json={"message": 'hello'}).status_code for _ in range(burst + 1)]
+    assert statuses == [200] * burst + [429]
+    assert admission.running == 0
+
+
+def asgi_request(asgi, path, method='GET', body=b'', headers=()):
+    path, _, query = path.partition('?')
+    scope = {
+        "type": 'http', "asgi": {"version": '3.0'}, "http_version": '1.1', "method": method, "scheme": 'http',
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": '',
+        "headers": [(name.lower().encode(), value.encode())
+                    for name, value in [*headers, ('Content-Length', str(len(body)))]],
+        "client": ('127.0.0.1', 50000), "server": ('testserver', 80),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": 'http.request', "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def call():
+        await asgi(scope, receive, send)
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+    return call()
+
+
+def test_serves_under_an_asgi_adapter(chibibytes, client):
+    asgiref_wsgi = pytest.importorskip('asgiref.wsgi')
+    asgi = asgiref_wsgi.WsgiToAsgi(chibibytes.app)
+    cookie = [('Cookie', f'session={client.get_cookie("session").value}')]
+    expected = client.get('/api/anime?limit=5').data
+
+    async def main():
+        listings = [asgi_request(asgi, '/api/anime?limit=5') for _ in range(20)]
+        adds = [asgi_request(asgi, '/add_to_watchlist', 'POST', f'{{"anime_id": {media_id}}}'.encode(),
+                             cookie + [('Content-Type', 'application/json')]) for media_id in (1, 2, 3)]
+        return await asyncio.gather(*listings, *adds)
+
+    responses = asyncio.run(main())
+    assert all(response == (200, expected) for response in responses[:20])
+    assert [status for status, _ in responses[20:]] == [200] * 3
+    assert sorted(item['media_id'] for item in client.get('/get_watchlist').get_json()) == [1, 2, 3]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_serves_under_gunicorn_gthread(tmp_path):
+    pytest.importorskip('gunicorn')
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-k', 'gthread', '--threads', '16', '-w', '1',
+                               '-b', f'127.0.0.1:{port}', '--pythonpath', APP_DIR, 'app:app'],
+                              cwd=tmp_path, env=dict(os.environ, BLOCKING_THREADS='4'),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                urllib.request.urlopen(base + '/healthz', timeout=1).read()
+                break
+            except OSError:
+                assert server.poll() is None, server.stderr.read().decode()
+                assert time.monotonic() < deadline, "gunicorn did not start"
+                time.sleep(0.2)
+
+        def get(path):
+            with urllib.request.urlopen(base + path, timeout=30) as response:
+                return response.status, response.read()
+
+        urls = ['/api/anime?limit=5', '/api/filter?genres=action', '/api/autocomplete?q=a'] * 16
+        with concurrent.futures.ThreadPoolExecutor(16) as pool:
+            responses = list(pool.map(get, urls))
+        assert all(status == 200 for status, _ in responses)
+        assert len({body for (status, body), url in zip(responses, urls) if url == urls[0]}) == 1
+
+        status, body = get('/api/metrics')
+        blocking = json.loads(body)['blocking']
+        assert blocking['max_workers'] == 4
+        assert blocking['submitted'] >= len(urls) and blocking['peak_running'] <= 4
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
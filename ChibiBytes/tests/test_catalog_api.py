@@ -0,0 +1,50 @@
+import json
+
+
+def ids(response):
+    assert response.status_code == 200
+    return [item['id'] for item in response.get_json()]
+
+
+def test_listings_default_to_id_order(client):
+    anime = ids(client.get('/api/anime'))
+    assert anime == sorted(anime)
+    assert anime[:3] == [1, 2, 3]
+    movies = ids(client.get('/api/movies'))
+    assert movies == sorted(movies)
+    # Filters narrow the list without reordering it
+    filtered = ids(client.get('/api/anime?min_rating=8&year_from=2010'))
+    assert filtered == sorted(filtered) and set(filtered) < set(anime)
+
+
+def test_ndjson_listing_keeps_the_same_order(client):
+    response = client.get('/api/anime?format=ndjson')
+    assert [line['id'] for line in map(json.loads, response.data.splitlines())] == \
+        ids(client.get('/api/anime'))
+
+
+def test_unparseable_filters_are_rejected(client):
+    for url in ('/api/anime?min_rating=abc', '/api/movies?year_from=2010s', '/api/anime?year_to=1.5',
+                '/api/anime?limit=ten', '/api/filter?max_rating=high', '/api/genres?year_from=x'):
+        response = client.get(url)
+        assert response.status_code == 400, url
+        assert 'error' in response.get_json()
+    # An empty value means no filter, as before
+    assert client.get('/api/anime?min_rating=').status_code == 200
+
+
+def test_filter_results_carry_card_fields(client):
+    response = client.get('/api/filter?media_type=anime&any=drama,romance&limit=5')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['count'] >= len(data['results']) == 5
+    anime = {item['id']: item for item in client.get('/api/anime').get_json()}
+    for result in data['results']:
+        assert result['media_type'] == 'anime'
+        assert {'drama', 'romance'} & set(result['genres'])
+        listed = anime[result['id']]
+        for field in ('title', 'year', 'rating', 'image', 'modalImage', 'category', 'description', 'insights'):
+            assert result[field] == listed[field]
+    # Pages follow on from each other
+    following = client.get('/api/filter?media_type=anime&any=drama,romance&limit=5&offset=5').get_json()
+    assert not {r['id'] for r in data['results']} & {r['id'] for r in following['results']}
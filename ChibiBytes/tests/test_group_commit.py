@@ -0,0 +1,76 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from group_commit import GroupCommitWriter, WriterOverloaded
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'writes.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE items (value INTEGER UNIQUE)')
+    return path
+
+
+def insert(cursor, value):
+    cursor.execute('INSERT INTO items (value) VALUES (?)', (value,))
+    return value
+
+
+def values(database):
+    with sqlite3.connect(database) as conn:
+        return sorted(value for value, in conn.execute('SELECT value FROM items'))
+
+
+def test_concurrent_writes_share_commits(database):
+    writer = GroupCommitWriter(database, max_delay=0.05)
+    results = []
+
+    def submit(value):
+        try:
+            results.append(writer.submit(insert, value))
+        except sqlite3.IntegrityError as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=submit, args=(value % 20,)) for value in range(21)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The duplicate fails inside its savepoint without taking its batch down
+    assert sum(isinstance(result, sqlite3.IntegrityError) for result in results) == 1
+    assert values(database) == list(range(20))
+    assert writer.writes == 21 and writer.batches < 21
+
+
+def test_timed_out_write_is_withdrawn(database):
+    writer = GroupCommitWriter(database, max_batch=1, timeout=0.2)
+    release = threading.Event()
+
+    def blocked(cursor):
+        release.wait()
+        return insert(cursor, 1)
+
+    first = threading.Thread(target=writer.submit, args=(blocked,))
+    first.start()
+    time.sleep(0.05)
+    with pytest.raises(WriterOverloaded):
+        writer.submit(insert, 2)
+    release.set()
+    first.join()
+    assert writer.submit(insert, 3) == 3
+    assert values(database) == [1, 3]
+
+
+def test_write_already_in_a_batch_is_waited_for(database):
+    writer = GroupCommitWriter(database, timeout=0.05)
+
+    def slow(cursor):
+        time.sleep(0.3)
+        return insert(cursor, 1)
+
+    assert writer.submit(slow) == 1
+    assert values(database) == [1]
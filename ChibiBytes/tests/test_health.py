@@ -0,0 +1,32 @@
+import pytest
+
+
+@pytest.fixture
+def warm(chibibytes):
+    chibibytes.warmup.ensure_started()
+    assert chibibytes.warmup.ready.wait(30)
+    return chibibytes
+
+
+def requests_noted(chibibytes):
+    return sum(scheduler.requests for scheduler in chibibytes.maintenance)
+
+
+def test_readyz_reuses_pooled_connections(warm):
+    client = warm.app.test_client()
+    assert client.get('/readyz').get_json()['db']['ok'] is True
+    pools = [warm.db_pool(shard) for shard in range(warm.USER_SHARDS)]
+    created = [pool.created for pool in pools]
+    reused = [pool.reused for pool in pools]
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert [pool.created for pool in pools] == created
+    assert all(after > before for after, before in zip((pool.reused for pool in pools), reused))
+
+
+def test_warmup_requests_are_not_counted_as_traffic(warm):
+    before = requests_noted(warm)
+    warm.warm_requests()
+    assert requests_noted(warm) == before
+    warm.app.test_client().get('/api/anime')
+    assert requests_noted(warm) == before + len(warm.maintenance)
@@ -0,0 +1,151 @@
+import http.server
+import os
+import threading
+import urllib.request
+
+import pytest
+
+import image_cache
+from image_cache import ImageCache
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 92
+JPEG = b'\xff\xd8\xff' + b'\x01' * 97
+
+
+@pytest.fixture
+def upstream():
+    """An image host on localhost: serves `upstream.images` by path and records each requested path"""
+    images = {}
+    requested = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            data = images.get(self.path)
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.images = images
+    server.requested = requested
+    server.base = f'http://127.0.0.1:{server.server_port}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_miss_then_hit(upstream, tmp_path):
+    upstream.images['/poster.png'] = PNG
+    cache = ImageCache(tmp_path)
+    url = upstream.base + '/poster.png'
+
+    path = cache.get('poster:' + url, url, None)
+    assert (cache.misses, cache.hits) == (1, 0)
+    with open(path, 'rb') as f:
+        assert f.read() == PNG
+
+    assert cache.get('poster:' + url, url, None) == path
+    assert (cache.misses, cache.hits) == (1, 1)
+    assert upstream.requested == ['/poster.png']
+    assert image_cache.sniff_content_type(PNG) == 'image/png'
+
+
+def test_evicts_least_recently_used(upstream, tmp_path):
+    for name in 'abc':
+        upstream.images[f'/{name}.png'] = PNG
+    # Room for two 100-byte images; a third evicts down to 90% of the limit
+    cache = ImageCache(tmp_path, max_bytes=250)
+    urls = {name: f'{upstream.base}/{name}.png' for name in 'abc'}
+
+    a = cache.get('a', urls['a'], None)
+    b = cache.get('b', urls['b'], None)
+    # Make the order explicit rather than relying on mtime resolution, then touch `a` with a hit
+    os.utime(a, (1, 1))
+    os.utime(b, (2, 2))
+    assert cache.get('a', urls['a'], None) == a
+    c = cache.get('c', urls['c'], None)
+
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+    assert os.path.exists(c)
+    assert cache._size == 200
+
+
+def test_fetches_presized_rendition_without_pillow(upstream, tmp_path, monkeypatch):
+    monkeypatch.setattr(image_cache, 'Image', None)
+    upstream.images['/1200x/ab/cd.jpg'] = b'\xff\xd8\xff original'
+    upstream.images['/236x/ab/cd.jpg'] = JPEG
+
+    def opener(request, timeout):
+        # Stand in for the pinimg CDN
+        url = request.full_url.replace('https://i.pinimg.com', upstream.base)
+        return urllib.request.urlopen(urllib.request.Request(url, headers=request.headers), timeout=timeout)
+
+    cache = ImageCache(tmp_path, opener=opener)
+    url = 'https://i.pinimg.com/1200x/ab/cd.jpg'
+    path = cache.get('thumb:' + url, url, 236)
+
+    assert upstream.requested == ['/236x/ab/cd.jpg']
+    with open(path, 'rb') as f:
+        assert f.read() == JPEG
+    # Original-size variants keep the URL as it is
+    assert image_cache.upstream_url(url, None) == url
+
+
+def evicting_first_get(cache):
+    """Make the cache's first get() lose its file right after returning, as a concurrent eviction would"""
+    get = cache.get
+    calls = []
+
+    def racing_get(key, url, width):
+        path = get(key, url, width)
+        calls.append(path)
+        if len(calls) == 1:
+            os.remove(path)
+        return path
+
+    cache.get = racing_get
+    return calls
+
+
+def test_open_fetches_again_after_an_eviction(upstream, tmp_path):
+    upstream.images['/poster.png'] = PNG
+    cache = ImageCache(tmp_path)
+    url = upstream.base + '/poster.png'
+    calls = evicting_first_get(cache)
+
+    with cache.open('poster:' + url, url, None) as f:
+        assert f.read() == PNG
+    assert len(calls) == 2
+    assert upstream.requested == ['/poster.png', '/poster.png']
+
+
+def test_proxy_sends_the_file_it_sniffed(upstream, tmp_path, chibibytes, monkeypatch):
+    upstream.images['/poster.png'] = PNG
+
+    def opener(request, timeout):
+        return urllib.request.urlopen(upstream.base + '/poster.png', timeout=timeout)
+
+    cache = ImageCache(tmp_path, opener=opener)
+    monkeypatch.setattr(chibibytes, 'image_cache', cache)
+    evicting_first_get(cache)
+    client = chibibytes.app.test_client()
+
+    response = client.get('/img/anime/1/poster')
+    assert response.status_code == 200
+    assert (response.mimetype, response.data) == ('image/png', PNG)
+    etag = response.headers['ETag']
+    assert client.get('/img/anime/1/poster', headers={"If-None-Match": etag}).status_code == 304
+    partial = client.get('/img/anime/1/poster', headers={"Range": 'bytes=0-7'})
+    assert (partial.status_code, partial.data) == (206, PNG[:8])
+    assert partial.headers['Content-Range'] == f'bytes 0-7/{len(PNG)}'
@@ -0,0 +1,41 @@
+import datetime
+import json
+
+import pytest
+from flask import Flask
+
+import json_provider
+from json_provider import FastJSONProvider, RawJSON, RawJSONList
+
+
+@pytest.fixture(params=['orjson', 'stdlib'])
+def provider(request, monkeypatch):
+    if request.param == 'stdlib':
+        monkeypatch.setattr(json_provider, 'orjson', None)
+    elif json_provider.orjson is None:
+        pytest.skip("orjson is not installed")
+    return FastJSONProvider(Flask(__name__))
+
+
+def test_fragment_lists_are_joined(provider):
+    fragments = RawJSONList([RawJSON(b'{"id":1}'), RawJSON(b'{"id":2}')])
+    assert provider.encode(fragments) == b'[{"id":1},{"id":2}]'
+    assert provider.encode(RawJSONList()) == b'[]'
+
+
+def test_nested_fragments_still_encode(provider):
+    obj = {"item": RawJSON(b'{"b":2,"a":[1]}'), "when": datetime.date(2024, 1, 2), "z": [RawJSON(b'3')]}
+    assert json.loads(provider.encode(obj)) == {"item": {"a": [1], "b": 2}, "when": 'Tue, 02 Jan 2024 00:00:00 GMT',
+                                                "z": [3]}
+
+
+def test_filled_template_matches_encoding_the_dict(provider):
+    template = provider.template({"title": 'Frieren', "year": 2023, "b": None}, ('rank', 'score'))
+    filled = provider.fill(template, {"rank": 1, "score": RawJSON(b'0.5')})
+    assert filled == provider.encode({"title": 'Frieren', "year": 2023, "b": None, "rank": 1, "score": 0.5})
+
+
+def test_listings_are_valid_json(chibibytes):
+    client = chibibytes.app.test_client()
+    listing = client.get('/api/anime?limit=3')
+    assert [item['id'] for item in json.loads(listing.data)] == [1, 2, 3]
@@ -0,0 +1,41 @@
+from lfu_cache import LFUCache, MISSING
+
+
+def test_one_off_keys_do_not_displace_the_hot_set():
+    cache = LFUCache(maxsize=3)
+    cache.put('hot', 1)
+    cache.put('warm', 2)
+    for _ in range(3):
+        assert cache.get('hot') == 1
+    assert cache.get('warm') == 2
+    for key in range(10):
+        cache.put(('once', key), key)
+    assert cache.get('hot') == 1 and cache.get('warm') == 2
+    # Only the latest one-off key survives, in the single slot they compete for
+    assert cache.get(('once', 9)) == 9
+    assert cache.get(('once', 8)) is MISSING
+    assert cache.evictions == 9
+
+
+def test_ties_evict_the_least_recently_used():
+    cache = LFUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.get('b')
+    cache.put('c', 3)
+    assert cache.get('a') is MISSING
+    assert (cache.get('b'), cache.get('c')) == (2, 3)
+
+
+def test_generations():
+    cache = LFUCache(maxsize=10)
+    cache.sync(1)
+    cache.put(('answer', 'hi'), 'hello')
+    cache.put(('title', 3), 'Frieren')
+    cache.advance(2, stale=lambda key: key[0] == 'title')
+    assert cache.get(('answer', 'hi')) == 'hello'
+    assert cache.get(('title', 3)) is MISSING
+    cache.sync(3)
+    assert len(cache) == 0
+    assert cache.metrics()['generation'] == 3
@@ -0,0 +1,34 @@
+import pytest
+
+from recommendations import RecommendationJob
+
+
+@pytest.fixture
+def job(chibibytes):
+    job = RecommendationJob(chibibytes.SHARD_DATABASES, processes=1)
+    yield job
+    job.close()
+
+
+def add(client, *media_ids):
+    for media_id in media_ids:
+        assert client.post('/add_to_watchlist', json={"anime_id": media_id}).get_json()['success']
+
+
+def test_runs_only_when_a_watchlist_changed_and_reuse_the_pool(chibibytes, client, job):
+    catalog = chibibytes.catalog_cache.get()
+    add(client, 1, 2, 3)
+    first = job.run(catalog)
+    assert first['users'] >= 1
+    executor = job._executor
+
+    # Nothing changed: no model is built and no generation is claimed
+    assert job.run(catalog) is None
+
+    add(client, 4)
+    second = job.run(catalog)
+    assert (second['users'], second['generation']) == (1, first['generation'] + 1)
+    assert job._executor is executor
+
+    recommended = client.get('/api/recommendations').get_json()
+    assert recommended and not {1, 2, 3, 4} & {item['id'] for item in recommended}
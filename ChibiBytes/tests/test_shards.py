@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+
+from shards import ShardMigrating, UserDirectory, move_user, reshard, shard_for, shard_path
+
+SCHEMA = '''
+    CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT, email TEXT, password TEXT,
+                        watchlist_version INTEGER NOT NULL DEFAULT 0);
+    CREATE TABLE watchlist (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, media_type TEXT,
+                            media_id INTEGER, added_at TEXT);
+    CREATE TABLE user_recommendations (user_id INTEGER, media_type TEXT, media_id INTEGER);
+'''
+
+
+@pytest.fixture
+def layout(tmp_path):
+    database = str(tmp_path / 'users.db')
+
+    def connect(shard):
+        conn = sqlite3.connect(shard_path(database, shard))
+        conn.row_factory = sqlite3.Row
+        conn.executescript(SCHEMA.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS'))
+        return conn
+
+    directory = UserDirectory(str(tmp_path / 'directory.db'), shard_count=1)
+    directory.init([])
+    return directory, connect
+
+
+def add_user(directory, connect, name, titles):
+    user_id, shard = directory.register(name, f'{name}@example.com')
+    with connect(shard) as conn:
+        conn.execute('INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)',
+                     (user_id, name, f'{name}@example.com', 'x'))
+        conn.executemany('INSERT INTO watchlist (user_id, media_type, media_id, added_at) VALUES (?, ?, ?, ?)',
+                         [(user_id, 'anime', media_id, '2024-01-01') for media_id in titles])
+    return user_id
+
+
+def test_directory_owns_ids_and_unique_names(layout):
+    directory, connect = layout
+    first = directory.register('ann', 'ann@example.com')
+    second = directory.register('bob', 'bob@example.com')
+    assert first == (1, 0) and second == (2, 0)
+    with pytest.raises(sqlite3.IntegrityError):
+        directory.register('ann', 'other@example.com')
+    assert directory.find('bob') == (2, 0)
+    # Users the directory doesn't know are on shard 0, where they all lived before it
+    assert directory.shard_of(99) == 0
+
+    directory.set_migrating([2])
+    assert directory.shard_of(2) == 0
+    with pytest.raises(ShardMigrating):
+        directory.shard_of(2, for_write=True)
+    directory.clear_migrating()
+    assert directory.shard_of(2, for_write=True) == 0
+
+
+def test_move_user_copies_then_repoints(layout):
+    directory, connect = layout
+    user_id = add_user(directory, connect, 'ann', [1, 2, 3])
+    source, target = connect(0), connect(1)
+    assert move_user(directory, user_id, source, target, 1)
+
+    assert directory.shard_of(user_id) == 1
+    assert source.execute('SELECT COUNT(*) FROM watchlist').fetchone()[0] == 0
+    assert [row['media_id'] for row in target.execute('SELECT media_id FROM watchlist ORDER BY id')] == [1, 2, 3]
+    # New row ids in the target, so clients are made to resync
+    assert target.execute('SELECT watchlist_version FROM users').fetchone()[0] == 1
+    assert not move_user(directory, user_id, source, target, 1)
+
+
+def test_reshard_places_every_user_on_its_hash_shard(layout):
+    directory, connect = layout
+    users = {add_user(directory, connect, f'user{i}', range(i % 4)): i % 4 for i in range(20)}
+    moved = reshard(directory, 3, connect, batch_size=7, grace=0, log=lambda message: None)
+    assert moved == sum(shard_for(user_id, 3) != 0 for user_id in users)
+
+    for user_id, titles in users.items():
+        shard = shard_for(user_id, 3)
+        assert directory.shard_of(user_id, for_write=True) == shard
+        with connect(shard) as conn:
+            assert conn.execute('SELECT COUNT(*) FROM watchlist WHERE user_id = ?', (user_id,)).fetchone()[0] == titles
+    counts = [connect(shard).execute('SELECT COUNT(*) FROM users').fetchone()[0] for shard in range(3)]
+    assert counts == [sum(shard_for(user_id, 3) == shard for user_id in users) for shard in range(3)]
+    # Nothing left to move
+    assert reshard(directory, 3, connect, grace=0, log=lambda message: None) == 0
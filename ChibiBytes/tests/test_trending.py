@@ -0,0 +1,64 @@
+import random
+import sqlite3
+
+import pytest
+
+import trending
+from trending import DecayedTopK, TrendingEngine
+
+
+def best(scores, k):
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+def test_heap_holds_the_top_k_through_adds_and_removals():
+    rng = random.Random(7)
+    board = DecayedTopK(half_life=3600, k=5, now=0)
+    for step in range(3000):
+        key = rng.randrange(30)
+        weight = rng.choice([1.0, 1.0, 0.5, -1.0, -0.25]) * (1 + rng.random())
+        board.add(key, weight, timestamp=step)
+        assert sorted(key for key, _ in board.top(step)) == sorted(best(board.scores, 5)), step
+        assert all(board.heap[board.pos[key]][1] == key for key in board.pos)
+
+
+def test_members_dropping_out_do_not_rebuild_the_heap(monkeypatch):
+    board = DecayedTopK(half_life=3600, k=3, now=0)
+    for key, weight in [('a', 5), ('b', 4), ('c', 3), ('d', 2), ('e', 1)]:
+        board.add(key, weight, timestamp=0)
+    monkeypatch.setattr(board, 'rebuild', lambda: pytest.fail("rebuilt the heap"))
+
+    board.add('a', -5, timestamp=0)
+    assert [key for key, _ in board.top(0)] == ['b', 'c', 'd']
+    board.add('b', -3.5, timestamp=0)
+    assert [key for key, _ in board.top(0)] == ['c', 'd', 'e']
+    board.add('e', 3, timestamp=0)
+    assert [key for key, _ in board.top(0)] == ['e', 'c', 'd']
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'shard.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE app_meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE trending_scores (window TEXT, media_type TEXT, media_id INTEGER, score REAL)')
+    return path
+
+
+def test_only_the_lease_holder_checkpoints(database, monkeypatch):
+    now = [1000.0]
+    engines = [TrendingEngine(database, clock=lambda: now[0], lease=180) for _ in range(2)]
+    for engine in engines:
+        engine.record('anime', 1, 'add', now[0])
+
+    monkeypatch.setattr(trending, 'worker_identity', lambda: 'host:1')
+    assert engines[0].checkpoint_as_leader()
+    monkeypatch.setattr(trending, 'worker_identity', lambda: 'host:2')
+    assert not engines[1].checkpoint_as_leader()
+
+    # Once the holder stops renewing, the lease passes on
+    now[0] += 181
+    assert engines[1].checkpoint_as_leader()
+    with sqlite3.connect(database) as conn:
+        checkpoint = conn.execute("SELECT value FROM app_meta WHERE key = 'trending_checkpoint'").fetchone()[0]
+        assert checkpoint.endswith(f':{now[0]}')
@@ -0,0 +1,37 @@
+import json
+
+
+def watchlist_ids(client):
+    return sorted(item['media_id'] for item in client.get('/get_watchlist').get_json())
+
+
+def test_batch_reports_a_bad_remove_id_per_operation(client):
+    response = client.post('/api/watchlist/batch', json={"operations": [
+        {"op": "add", "media_id": 3},
+        {"op": "remove", "id": {"a": 1}},
+        {"op": "remove", "id": [1]},
+        {"op": "remove", "id": True},
+        {"op": "add", "media_id": 4},
+    ]})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [result['success'] for result in results] == [True, False, False, False, True]
+    assert results[1]['error'] == results[2]['error'] == "id must be an integer"
+    assert watchlist_ids(client) == [3, 4]
+
+
+def test_json_import_is_read_incrementally(client):
+    items = [{"media_id": media_id} for media_id in range(1, 11)] + [{"title": "No such title"}]
+    body = json.dumps({"source": {"name": "elsewhere", "ids": [1, 2]}, "items": items})
+    response = client.post('/api/watchlist/import', data=body, content_type='application/json')
+    assert response.status_code == 200
+    summary = response.get_json()
+    assert (summary['added'], summary['failed']) == (10, 1)
+    assert summary['errors'] == [{"line": 11, "error": "Unknown title"}]
+    assert watchlist_ids(client) == list(range(1, 11))
+
+
+def test_malformed_json_import_is_rejected(client):
+    for body in ('{"items": 3}', '[{"media_id": 1}', '{"other": []}'):
+        response = client.post('/api/watchlist/import', data=body, content_type='application/json')
+        assert response.status_code == 400, body
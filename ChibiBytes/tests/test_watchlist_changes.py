@@ -0,0 +1,54 @@
+import sqlite3
+
+
+def version_of(client):
+    return int(client.get('/get_watchlist').headers['X-Watchlist-Version'])
+
+
+def changes(client, since):
+    return client.get(f'/api/watchlist/changes?since={since}')
+
+
+def test_unchanged_watchlist_is_not_modified(client):
+    start = version_of(client)
+    response = changes(client, start)
+    assert response.status_code == 304
+    assert response.headers['ETag'] == f'W/"watchlist-{start}"'
+
+
+def test_delta_holds_the_last_action_per_title(client):
+    start = version_of(client)
+    client.post('/api/watchlist/batch', json={"operations": [
+        {"op": "add", "media_id": 1}, {"op": "add", "media_id": 2}, {"op": "add", "media_id": 3},
+        {"op": "remove", "media_id": 2}, {"op": "add", "media_id": 80},
+    ]})
+    body = changes(client, start).get_json()
+    assert body['version'] == start + 5 and body['reset'] is False
+    assert sorted((item['media_type'], item['media_id']) for item in body['added']) == \
+        [('anime', 1), ('anime', 3), ('movie', 80)]
+    assert body['removed'] == [{"media_type": 'anime', "media_id": 2}]
+
+    # A client that already applied the first three changes only sees the rest
+    later = changes(client, start + 3).get_json()
+    assert [(item['media_type'], item['media_id']) for item in later['added']] == [('movie', 80)]
+    assert later['removed'] == [{"media_type": 'anime', "media_id": 2}]
+
+
+def test_gaps_in_the_log_reset_the_client(chibibytes, client):
+    start = version_of(client)
+    client.post('/add_to_watchlist', json={"anime_id": 5})
+    client.post('/add_to_watchlist', json={"anime_id": 6})
+    # A version from the future, e.g. after a restore, can't be patched up
+    assert changes(client, start + 10).get_json()['reset'] is True
+
+    shard = chibibytes.user_directory.shard_of(client.user_id)
+    with sqlite3.connect(chibibytes.shard_path(chibibytes.DATABASE, shard)) as conn:
+        conn.execute('DELETE FROM watchlist_events WHERE user_id = ? AND version = ?', (client.user_id, start + 1))
+    body = changes(client, start).get_json()
+    assert body['reset'] is True
+    assert sorted(item['media_id'] for item in body['items']) == [5, 6]
+
+
+def test_since_is_required(client):
+    assert changes(client, 'abc').status_code == 400
+    assert client.get('/api/watchlist/changes').status_code == 400
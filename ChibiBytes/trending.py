@@ -0,0 +1,305 @@
+import heapq
+import math
+import sqlite3
+import threading
+import time
+
+from maintenance import acquire_lease, worker_identity
+
+# Half-life of a watchlist add for each trending window, in seconds
+WINDOWS = {
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+}
+MEDIA_TYPES = ('anime', 'movie')
+
+# Weight of one event; removals take momentum away but never push a title below zero
+EVENT_WEIGHTS = {'add': 1.0, 'remove': -1.0}
+
+# Rebase scores before exp() gets anywhere near float overflow
+MAX_EXPONENT = 50.0
+MIN_SCORE = 1e-6
+
+# app_meta key of the worker that writes the checkpoint
+LEASE_KEY = 'trending_leader'
+
+
+class DecayedTopK:
+    """Exponentially decayed scores for one window plus a top-K min-heap.
+
+    Scores use forward decay: an event at time t adds weight * e^(rate * (t - landmark)),
+    so stored values never need touching as time passes and their order is stable.
+    The heap keeps a position map so a member whose score changes is re-sifted in
+    O(log K). Every member outranks every title outside the heap, so only a member
+    that drops to the bottom can be overtaken, and only by the best outsider; that
+    one is found with a pass over the scores, and swapped in. A member whose score
+    reaches zero is taken out and the best outsider takes its place the same way.
+    """
+
+    def __init__(self, half_life, k, now):
+        self.rate = math.log(2) / half_life
+        self.k = k
+        self.landmark = now
+        self.scores = {}
+        self.heap = []
+        self.pos = {}
+
+    def add(self, key, weight, timestamp):
+        if self.rate * (timestamp - self.landmark) > MAX_EXPONENT:
+            self.rebase(timestamp)
+        delta = weight * math.exp(self.rate * (timestamp - self.landmark))
+        score = max(self.scores.get(key, 0.0) + delta, 0.0)
+        if score > 0:
+            self.scores[key] = score
+        else:
+            self.scores.pop(key, None)
+
+        if key in self.pos:
+            i = self.pos[key]
+            if score <= 0:
+                self._remove(i)
+                self._promote_outsider()
+            else:
+                self.heap[i][0] = score
+                if delta >= 0:
+                    self._sift_down(i)
+                else:
+                    self._sift_up(i)
+                    if self.heap[0][1] == key:
+                        self._promote_outsider()
+        elif score > 0:
+            if len(self.heap) < self.k:
+                self.heap.append([score, key])
+                self.pos[key] = len(self.heap) - 1
+                self._sift_up(len(self.heap) - 1)
+            elif score > self.heap[0][0]:
+                del self.pos[self.heap[0][1]]
+                self.heap[0] = [score, key]
+                self.pos[key] = 0
+                self._sift_down(0)
+
+    def top(self, now):
+        """Members of the heap as (key, score at `now`), best first"""
+        factor = math.exp(-self.rate * (now - self.landmark))
+        return [(key, score * factor) for score, key in sorted(self.heap, reverse=True)]
+
+    def current_scores(self, now):
+        factor = math.exp(-self.rate * (now - self.landmark))
+        return {key: score * factor for key, score in self.scores.items()}
+
+    def load(self, scores, taken_at):
+        """Replace all scores with values that were current at `taken_at`"""
+        self.landmark = taken_at
+        self.scores = {key: score for key, score in scores.items() if score > 0}
+        self.rebuild()
+
+    def rebase(self, now):
+        """Move the landmark to `now`, rescaling scores and dropping negligible ones"""
+        factor = math.exp(-self.rate * (now - self.landmark))
+        self.landmark = now
+        self.scores = {key: score * factor for key, score in self.scores.items() if score * factor > MIN_SCORE}
+        self.rebuild()
+
+    def rebuild(self):
+        # Ascending order is a valid min-heap
+        self.heap = [[score, key] for key, score in heapq.nlargest(self.k, self.scores.items(),
+                                                                   key=lambda item: item[1])][::-1]
+        self.pos = {key: i for i, (score, key) in enumerate(self.heap)}
+
+    def _best_outsider(self):
+        best = None
+        if len(self.scores) > len(self.heap):
+            for key, score in self.scores.items():
+                if key not in self.pos and (best is None or score > best[0]):
+                    best = [score, key]
+        return best
+
+    def _promote_outsider(self):
+        """Swap the best title outside the heap in if it outranks the heap's minimum, or fill a free slot"""
+        best = self._best_outsider()
+        if best is None:
+            return
+        if len(self.heap) < self.k:
+            self.heap.append(best)
+            self.pos[best[1]] = len(self.heap) - 1
+            self._sift_up(len(self.heap) - 1)
+        elif best[0] > self.heap[0][0]:
+            del self.pos[self.heap[0][1]]
+            self.heap[0] = best
+            self.pos[best[1]] = 0
+            self._sift_down(0)
+
+    def _remove(self, i):
+        del self.pos[self.heap[i][1]]
+        last = self.heap.pop()
+        if i < len(self.heap):
+            self.heap[i] = last
+            self.pos[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self.pos[last[1]])
+
+    def _swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.pos[self.heap[i][1]] = i
+        self.pos[self.heap[j][1]] = j
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self.heap[i][0] >= self.heap[parent][0]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        size = len(self.heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and self.heap[child][0] < self.heap[smallest][0]:
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
+
+
+class TrendingEngine:
+    """In-memory trending boards fed by the watchlist_events logs.
+
+    Every worker tails the event log of each user shard (one indexed query per
+    shard per poll, none per request), so all workers converge on the same
+    boards. Boards are checkpointed to the first database together with the
+    last event id of every shard so a restart only replays the tails; since the
+    boards agree, one worker holding a lease in app_meta writes the checkpoint.
+    """
+
+    def __init__(self, databases, k=20, windows=WINDOWS, clock=time.time, lease=180.0):
+        self.databases = [databases] if isinstance(databases, str) else list(databases)
+        self.k = k
+        self.windows = windows
+        self.clock = clock
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.last_event_ids = [0] * len(self.databases)
+        self.loaded = False
+        now = clock()
+        self.boards = {
+            (window, media_type): DecayedTopK(half_life, k, now)
+            for window, half_life in windows.items()
+            for media_type in MEDIA_TYPES
+        }
+
+    def record(self, media_type, media_id, action, timestamp):
+        weight = EVENT_WEIGHTS.get(action)
+        if weight is None or media_type not in MEDIA_TYPES:
+            return
+        for window in self.windows:
+            self.boards[(window, media_type)].add(media_id, weight, timestamp)
+
+    def top(self, window, media_type=None, limit=None):
+        """Top titles as dicts of media_type, id and decayed score"""
+        limit = self.k if limit is None else min(limit, self.k)
+        media_types = [media_type] if media_type else MEDIA_TYPES
+        now = self.clock()
+        with self.lock:
+            items = [
+                {"media_type": mt, "id": media_id, "score": round(score, 4)}
+                for mt in media_types
+                for media_id, score in self.boards[(window, mt)].top(now)
+                if score > MIN_SCORE
+            ]
+        items.sort(key=lambda item: item['score'], reverse=True)
+        return items[:limit]
+
+    def connect(self, database=None):
+        return sqlite3.connect(database or self.databases[0])
+
+    def poll(self):
+        """Apply any watchlist events written to any shard since the last poll"""
+        conns = [self.connect(database) for database in self.databases]
+        try:
+            if not self.loaded:
+                self.load_checkpoint(conns)
+            applied = 0
+            for shard, conn in enumerate(conns):
+                rows = conn.execute('''
+                    SELECT id, media_type, media_id, action, created_at
+                    FROM watchlist_events
+                    WHERE id > ?
+                    ORDER BY id
+                ''', (self.last_event_ids[shard],)).fetchall()
+                with self.lock:
+                    for event_id, media_type, media_id, action, created_at in rows:
+                        self.record(media_type, media_id, action, created_at)
+                        self.last_event_ids[shard] = event_id
+                applied += len(rows)
+            return applied
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def load_checkpoint(self, conns):
+        """Warm the boards from the last checkpoint, or from existing watchlists on first run"""
+        row = conns[0].execute("SELECT value FROM app_meta WHERE key = 'trending_checkpoint'").fetchone()
+        with self.lock:
+            if row:
+                last_event_ids, taken_at = row[0].split(':')
+                per_board = {}
+                for window, media_type, media_id, score in conns[0].execute(
+                        'SELECT window, media_type, media_id, score FROM trending_scores'):
+                    per_board.setdefault((window, media_type), {})[media_id] = score
+                for key, board in self.boards.items():
+                    board.load(per_board.get(key, {}), float(taken_at))
+                # Shards added since the checkpoint replay their whole log
+                last_event_ids = [int(event_id) for event_id in last_event_ids.split(',')]
+                self.last_event_ids = (last_event_ids + [0] * len(conns))[:len(conns)]
+            else:
+                # No checkpoint yet: treat every saved title as an add at its added_at time
+                for shard, conn in enumerate(conns):
+                    rows = conn.execute('''
+                        SELECT media_type, media_id, CAST(strftime('%s', added_at) AS REAL)
+                        FROM watchlist
+                    ''').fetchall()
+                    for media_type, media_id, added_at in rows:
+                        self.record(media_type, media_id, 'add', added_at or self.clock())
+                    event_row = conn.execute('SELECT MAX(id) FROM watchlist_events').fetchone()
+                    self.last_event_ids[shard] = event_row[0] or 0
+            self.loaded = True
+
+    def checkpoint_as_leader(self):
+        """Checkpoint if this worker holds the checkpoint lease; False if another one does"""
+        conn = sqlite3.connect(self.databases[0], isolation_level=None)
+        try:
+            if not acquire_lease(conn, LEASE_KEY, worker_identity(), self.clock(), self.lease):
+                return False
+        finally:
+            conn.close()
+        self.checkpoint()
+        return True
+
+    def checkpoint(self, conn=None):
+        """Persist current scores and the last applied event id of each shard"""
+        own_conn = conn is None
+        conn = conn or self.connect()
+        try:
+            now = self.clock()
+            with self.lock:
+                rows = [
+                    (window, media_type, media_id, score)
+                    for (window, media_type), board in self.boards.items()
+                    for media_id, score in board.current_scores(now).items()
+                    if score > MIN_SCORE
+                ]
+                state = f'{",".join(map(str, self.last_event_ids))}:{now}'
+            with conn:
+                conn.execute('DELETE FROM trending_scores')
+                conn.executemany('''
+                    INSERT INTO trending_scores (window, media_type, media_id, score)
+                    VALUES (?, ?, ?, ?)
+                ''', rows)
+                conn.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('trending_checkpoint', ?)",
+                             (state,))
+        finally:
+            if own_conn:
+                conn.close()
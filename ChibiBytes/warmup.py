@@ -0,0 +1,57 @@
+import os
+import threading
+import time
+
+
+class Warmup:
+    """Run a list of warm-up steps once per worker process, off the request path.
+
+    Like PeriodicTask, the thread is started lazily by ensure_started() and again
+    after a fork. `ready` is set once every step has run; a failing step is
+    recorded in the report but does not keep the worker out of rotation, since a
+    cold cache is still better than no capacity.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.ready = threading.Event()
+        self.report = {}
+        self.started_at = None
+        self.finished_at = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.ready = threading.Event()
+            self.report = {}
+            self.finished_at = None
+            threading.Thread(target=self.run, name='warmup', daemon=True).start()
+            self._pid = os.getpid()
+
+    def run(self):
+        self.started_at = time.time()
+        for name, func in self.steps:
+            step_started = time.monotonic()
+            try:
+                func()
+                result = {"ok": True}
+            except Exception as e:
+                print(f"warmup {name} error: {str(e)}")
+                result = {"ok": False, "error": str(e)}
+            result['seconds'] = round(time.monotonic() - step_started, 4)
+            self.report[name] = result
+        self.finished_at = time.time()
+        self.ready.set()
+
+    def status(self):
+        return {
+            "ready": self.ready.is_set(),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "steps": dict(self.report),
+        }